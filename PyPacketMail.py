@@ -18,6 +18,26 @@ pack = /home/pi/Desktop/PyPacketMail/pack
 unpack = /home/pi/Desktop/PyPacketMail/unpack
 bad = /home/pi/Desktop/PyPacketMail/bad
 archive = /home/pi/Desktop/PyPacketMail/archive
+# Read packets straight out of bundles instead of extracting to unpack.
+stream_bundles = yes
+# Messages written per database commit while tossing, default 500.
+import_batch_size = 500
+# Days and entries kept in the dupe index, defaults 90 and 1000000.
+dupe_max_age = 90
+dupe_max_entries = 1000000
+# Worker processes parsing messages in parallel, default 1 tosses serially.
+toss_workers = 4
+# Outbound packets roll over to a new packet past this size in KB, default 256.
+packet_size_limit = 256
+# Counters and stage timings written here after each run, .json for JSON
+# otherwise Prometheus text format.
+metrics_file = /home/pi/Desktop/PyPacketMail/pypacketmail.prom
+# Background daemon, seconds a new bundle must stay unchanged before it is
+# tossed (default 5), between outbound scans (default 300) and between
+# inbound polls when inotify isn't available (default 10).
+toss_debounce = 5
+scan_interval = 300
+poll_interval = 10
 
 # Fido Type Network Domain names, seperate with commas.
 [fido_networks]
@@ -30,6 +50,18 @@ export_address = 46:1/100
 areas = agn_gen: general, agn_ads: bbs_ads, agn_bbs: bbs_discussion, agn_art: art, agn_dev: development,
         agn_nix: unix_linux, agn_hub: hub_stats, agn_l46: league46, agn_tst: testing, agn_sys: sysop_area
 default_area = agn_gen
+# Daily nodelist, the newest of nodelist.nnn is used with any newer
+# nodediff.nnn applied.  Compiled to nodelist.idx for address lookups.
+nodelist = /home/pi/Desktop/PyPacketMail/nodelist/agoranet
+nodediff = /home/pi/Desktop/PyPacketMail/nodelist/agorad
+# Netmail routes, a zone:net/node.point pattern with * wildcards and the
+# next hop, an address, 'direct' or 'nodelist' for the hub / host from
+# the nodelist.  The most specific pattern wins, export_address otherwise.
+routes = 46:1/145.* direct, 46:2/* 46:2/0, 46:* nodelist
+# Downlinks fed echomail, each link address followed by its areas, * for
+# every area.  Echomail also goes to the export_address.  Points get
+# everything but their own messages, they aren't listed in SEEN-BY.
+downlinks = 46:1/150 agn_gen agn_ads, 46:1/160 *, 46:1/140.1 *
 
 # Network Specific Addresses and Area -> Tag Translations.
 [fidonet]
@@ -55,48 +87,253 @@ __version__ = "1.0.0"
 __status__ = "Prototype"
 
 
+import multiprocessing
+import ctypes.util
 import collections
 import datetime
+import threading
+import traceback
+import logging
+import codecs
+import select
+import ctypes
+import mmap
+import bisect
+import json
+import zlib
+import time
+import re
 import zipfile
+import shutil
 import struct
 import glob
+import sys
 import os
 
-# Reading Binary Packet Formats
-from ctypes import LittleEndianStructure, Union, c_uint8
-
-# x84 specific
-from x84.bbs.ini import init, get_ini
-from x84.cmdline import parse_args
-
 # Database for holding FidoNet Specific Items and Kludges
 FIDO_DB = 'pymail'
 
-# Read in default .x84 INI File.
-init(*parse_args())
+# FIDO_DB table holding the next free index (high water mark).
+FIDO_SEQUENCE_TABLE = 'sequence'
+
+# FIDO_DB tables indexing records by status, eg. 'status_pending', index -> network.
+FIDO_STATUS_TABLE = 'status_{0}'
+
+# Missing msgbase indexes in a row past the high water mark before the
+# scanner stops.  Only posts made since the last scan are out there,
+# gaps below the high water mark are always scanned through.
+SCAN_GAP_LIMIT = 100
+
+# Messages committed per database transaction while tossing.
+DEFAULT_IMPORT_BATCH_SIZE = 500
+
+# FIDO_DB tables for dupe checking, dupe key -> serial and serial -> (key, time).
+FIDO_DUPE_TABLE = 'dupes'
+FIDO_DUPE_HISTORY_TABLE = 'dupe_history'
+
+# FIDO_DB tables for reply threading, MSGID -> msg idx and the replies
+# waiting for a MSGID that hasn't been imported yet, MSGID -> [msg idx].
+FIDO_MSGID_TABLE = 'msgid'
+FIDO_REPLY_PENDING_TABLE = 'reply_pending'
+
+# Dupe index eviction, entries older than max age (days) or past max entries.
+DEFAULT_DUPE_MAX_AGE = 90
+DEFAULT_DUPE_MAX_ENTRIES = 1000000
+
+# Worker processes parsing bundles, 1 tosses everything in this process.
+DEFAULT_TOSS_WORKERS = 1
+
+# Outbound packet size in KB before rolling over to a new packet.
+DEFAULT_PACKET_SIZE_LIMIT = 256
+
+# Background daemon timings in seconds.
+DEFAULT_TOSS_DEBOUNCE = 5
+DEFAULT_SCAN_INTERVAL = 300
+DEFAULT_POLL_INTERVAL = 10
+
+# Histogram buckets in seconds for the stage timings.
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Product name used in the TID kludge and tear line of exported messages.
+PRODUCT_NAME = 'PyPacketMail'
+
+# Fido address, zone:net/node[.point][@domain]
+_fido_address_pattern = re.compile(
+    r'^(?P<zone>\d+):(?P<net>\d+)/(?P<node>\d+)(?:\.(?P<point>\d+))?(?:@(?P<domain>\S+))?$')
+
+
+def parse_fido_address(address):
+    # Parse a 3D/4D/5D address string into a (zone, net, node, point)
+    # tuple, the @domain is dropped.  None if the address is not valid.
+    """
+    :type address: str
+    :rtype : tuple
+    """
+    match = _fido_address_pattern.match(address.strip())
+    if match is None:
+        return None
+    return (int(match.group('zone')), int(match.group('net')),
+            int(match.group('node')), int(match.group('point') or 0))
+
+
+# Route pattern, zone:net/node.point where any trailing part can be *
+_route_pattern = re.compile(
+    r'^(?:\*|(?P<zone>\d+):(?:\*|(?P<net>\d+)/(?:\*|(?P<node>\d+)(?:\.(?P<point>\*|\d+))?)))$')
+
+
+def parse_route_pattern(pattern):
+    # Route pattern to the address prefix it matches, eg. '46:2/*' is
+    # (46, 2), a full address is matched exactly.  None if not valid.
+    """
+    :type pattern: str
+    :rtype : tuple
+    """
+    match = _route_pattern.match(pattern.strip())
+    if match is None:
+        return None
+
+    prefix = []
+    for field in ('zone', 'net', 'node'):
+        if match.group(field) is None:
+            return tuple(prefix)
+        prefix.append(int(match.group(field)))
+
+    point = match.group('point')
+    if point == '*':
+        return tuple(prefix)
+    return tuple(prefix) + (int(point or 0),)
+
+
+def format_fido_address(address_key):
+    # (zone, net, node, point) tuple back to a 3D/4D address string
+    """
+    :type address_key: tuple
+    :rtype : str
+    """
+    zone, net, node, point = address_key
+    if point:
+        return '{0}:{1}/{2}.{3}'.format(zone, net, node, point)
+    return '{0}:{1}/{2}'.format(zone, net, node)
+
+
+# SEEN-BY and PATH lines are wrapped to fit in 79 columns.
+_net_node_line_width = 70
+
+
+def pack_net_node(address_key):
+    # (zone, net, node, point) to the net << 16 | node int used for
+    # SEEN-BY and PATH arithmetic, both only hold 2D addresses.
+    """
+    :type address_key: tuple
+    :rtype : int
+    """
+    return address_key[1] << 16 | address_key[2]
+
+
+def parse_net_nodes(lines):
+    # SEEN-BY / PATH lines to net << 16 | node ints in the order listed,
+    # a node without a net is on the same net as the one before it.
+    """
+    :type lines: list
+    :rtype : list
+    """
+    net_nodes = []
+    net = 0
+    for line in lines:
+        for field in line.split():
+            if ':' in field or '.' in field:
+                # The SEEN-BY: prefix, zones and points aren't listed.
+                continue
+            try:
+                if '/' in field:
+                    net_field, node_field = field.split('/', 1)
+                    net = int(net_field)
+                    net_nodes.append(net << 16 | int(node_field))
+                else:
+                    net_nodes.append(net << 16 | int(field))
+            except ValueError:
+                continue
+    return net_nodes
+
+
+def format_net_nodes(net_nodes, width=_net_node_line_width):
+    # net << 16 | node ints back to SEEN-BY / PATH style lines, the net is
+    # only repeated when it changes or a new line starts, eg. '1/100 140 2/5'
+    """
+    :type net_nodes: list
+    :type width: int
+    :rtype : list
+    """
+    lines = []
+    fields = []
+    length = 0
+    last_net = None
+    for net_node in net_nodes:
+        net, node = net_node >> 16, net_node & 0xffff
+        field = '{0}'.format(node) if net == last_net else '{0}/{1}'.format(net, node)
+        if fields and length + len(field) + 1 > width:
+            lines.append(' '.join(fields))
+            fields = []
+            length = 0
+            field = '{0}/{1}'.format(net, node)
+        fields.append(field)
+        length += len(field) + 1
+        last_net = net
+    if fields:
+        lines.append(' '.join(fields))
+    return lines
 
 
 class FidonetConfiguration():
     # Holds configuration values from x84 Default.ini
     # also builds up lists of areas per network and
     # their data -> tag translatons
-    def __init__(self):
+    def __init__(self, verbose=False):
+        self.__verbose = verbose     # Print settings as they are read
         self.__network_list = []     # List of Fido Networks
         self.__node_address = {}     # Your Address
         self.__export_address = {}   # Your Network Hub's Address
         self.__network_areas = {}    # Message Areas by network
         self.__default_areas = {}    # Default if no Valid Area Tag
+        self.__address_index = {}    # (zone, net, node, point) -> network
+        self.__area_index = {}       # network -> {area: tag}
+        self.__tag_index = {}        # tag -> (network, area)
+        self.__nodelist = {}         # Daily nodelist base path by network
+        self.__nodediff = {}         # Nodediff base path by network
+        self.__routes = {}           # Netmail route rules by network
+        self.__route_index = {}      # network -> {address prefix: next hop}
+        self.__route_cache = {}      # (network, address) -> next hop
+        self.__downlinks = {}        # Downlinks and their areas by network
+        self.__link_index = {}       # network -> {area or '*': set of addresses}
+        self.__link_cache = {}       # (network, area) -> set of link addresses
+        self.__bbs_name = None
+        self.__outbound_folder = None
+        self.__pack_folder = None
+        self.__packet_size_limit = None
+        self.__metrics_file = None
+        self.__toss_debounce = None
+        self.__scan_interval = None
+        self.__poll_interval = None
         self.__inbound_folder = None
         self.__unpack_folder = None
+        self.__archive_folder = None
+        self.__bad_folder = None
+        self.__stream_bundles = False
+        self.__import_batch_size = None
+        self.__dupe_max_age = None
+        self.__dupe_max_entries = None
+        self.__toss_workers = None
         self.read_configuration()    # Load All INI settings on startup.
 
     def add_network(self):
         # Everything is built from the initial network address
+        from x84.bbs.ini import get_ini
         self.__network_list = \
             get_ini(section='fido_networks', key='network_tags', split=True)
 
     def add_node_address(self):
         # Node Addresses per network
+        from x84.bbs.ini import get_ini
         if self.is_network_empty is False:
             for net in self.__network_list:
                 # Loop network list and get network section.
@@ -105,6 +342,7 @@ class FidonetConfiguration():
 
     def add_export_address(self):
         # Export {mail hub} addresses per network
+        from x84.bbs.ini import get_ini
         if self.is_network_empty is False:
             for net in self.__network_list:
                 # Loop network list and get network section.
@@ -113,6 +351,7 @@ class FidonetConfiguration():
 
     def add_network_areas(self):
         # key value area to tag translations per network
+        from x84.bbs.ini import get_ini
         if self.is_network_empty is False:
             for net in self.__network_list:
                 # Loop network list and get network section.
@@ -121,12 +360,39 @@ class FidonetConfiguration():
 
     def add_default_areas(self):
         # No Valid area, then use default area
+        from x84.bbs.ini import get_ini
         if self.is_network_empty is False:
             for net in self.__network_list:
                 # Loop network list and get network section.
                 self.__default_areas[net] = \
                     get_ini(section=net, key='default_area', split=True)
 
+    def add_nodelists(self):
+        # Optional nodelist and nodediff per network
+        from x84.bbs.ini import get_ini
+        if self.is_network_empty is False:
+            for net in self.__network_list:
+                self.__nodelist[net] = get_ini(section=net, key='nodelist') or None
+                self.__nodediff[net] = get_ini(section=net, key='nodediff') or None
+
+    def add_downlinks(self):
+        # Echomail downlinks per network, 'address area area ...'
+        from x84.bbs.ini import get_ini
+        if self.is_network_empty is False:
+            for net in self.__network_list:
+                self.__downlinks[net] = get_ini(section=net, key='downlinks', split=True)
+
+    def add_routes(self):
+        # Netmail route rules per network, 'pattern next_hop'
+        from x84.bbs.ini import get_ini
+        if self.is_network_empty is False:
+            for net in self.__network_list:
+                self.__routes[net] = get_ini(section=net, key='routes', split=True)
+
+    @property
+    def network_list(self):
+        return self.__network_list
+
     @property
     def is_network_empty(self):
         if bool(self.__network_list and True):
@@ -141,22 +407,273 @@ class FidonetConfiguration():
     def unpack_folder(self):
         return self.__unpack_folder
 
+    @property
+    def archive_folder(self):
+        return self.__archive_folder
+
+    @property
+    def bad_folder(self):
+        return self.__bad_folder
+
+    @property
+    def outbound_folder(self):
+        return self.__outbound_folder
+
+    @property
+    def pack_folder(self):
+        return self.__pack_folder
+
+    @property
+    def packet_size_limit(self):
+        return self.__packet_size_limit
+
+    @property
+    def metrics_file(self):
+        return self.__metrics_file
+
+    @property
+    def toss_debounce(self):
+        return self.__toss_debounce
+
+    @property
+    def scan_interval(self):
+        return self.__scan_interval
+
+    @property
+    def poll_interval(self):
+        return self.__poll_interval
+
+    @property
+    def bbs_name(self):
+        return self.__bbs_name
+
+    @property
+    def stream_bundles(self):
+        return self.__stream_bundles
+
+    @property
+    def import_batch_size(self):
+        return self.__import_batch_size
+
+    @property
+    def dupe_max_age(self):
+        return self.__dupe_max_age
+
+    @property
+    def dupe_max_entries(self):
+        return self.__dupe_max_entries
+
+    @property
+    def toss_workers(self):
+        return self.__toss_workers
+
+    def build_address_index(self):
+        # Compile node addresses into a (zone, net, node, point) -> network dict
+        self.__address_index = {}
+        for net, addresses in self.__node_address.items():
+            for address in addresses:
+                address_key = parse_fido_address(address)
+                if address_key is None:
+                    log.error('invalid node_address: {net}, {address}'.format(
+                        net=net, address=address))
+                    continue
+                self.__address_index[address_key] = net
+
+    def build_area_index(self):
+        # Compile 'area: tag' strings into an exact match dict per network
+        # and the reverse tag -> (network, area) dict used for exporting.
+        self.__area_index = {}
+        self.__tag_index = {}
+        for net, areas in self.__network_areas.items():
+            area_tags = self.__area_index[net] = {}
+            for area in areas:
+                if ':' not in area:
+                    log.error('invalid area: {net}, {area}'.format(net=net, area=area))
+                    continue
+                k, v = area.split(':', 1)
+                area_tags[k.strip().lower()] = v.strip()
+                self.__tag_index.setdefault(v.strip(), (net, k.strip().lower()))
+
+    def build_route_index(self):
+        # Compile the route rules into an address prefix -> next hop dict per
+        # network, the next hop is an address tuple, 'direct' or 'nodelist'.
+        self.__route_index = {}
+        self.__route_cache = {}
+        for net, routes in self.__routes.items():
+            route_table = self.__route_index[net] = {}
+            for route in routes:
+                parts = route.split()
+                prefix = parse_route_pattern(parts[0]) if len(parts) == 2 else None
+                if prefix is None:
+                    log.error('invalid route: {net}, {route}'.format(net=net, route=route))
+                    continue
+
+                next_hop = parts[1].lower()
+                if next_hop not in ('direct', 'nodelist'):
+                    next_hop = parse_fido_address(parts[1])
+                    if next_hop is None:
+                        log.error('invalid route: {net}, {route}'.format(net=net, route=route))
+                        continue
+                route_table.setdefault(prefix, next_hop)
+
+    def build_link_index(self):
+        # Compile the downlinks into area -> set of link addresses per
+        # network, links taking every area are kept under '*'.
+        self.__link_index = {}
+        self.__link_cache = {}
+        for net, downlinks in self.__downlinks.items():
+            area_links = self.__link_index[net] = {}
+            for downlink in downlinks:
+                parts = downlink.split()
+                address_key = parse_fido_address(parts[0]) if parts else None
+                if address_key is None or len(parts) < 2:
+                    log.error('invalid downlink: {net}, {link}'.format(net=net, link=downlink))
+                    continue
+                for area in parts[1:]:
+                    area_links.setdefault(area.lower(), set()).add(address_key)
+
+    def get_area_links(self, network_name, network_area):
+        # Links echomail in the area is sent to, the export_address and
+        # downlinks, as (zone, net, node, point) addresses.
+        """
+        :type network_name: str
+        :type network_area: str
+        :rtype : frozenset
+        """
+        cache_key = (network_name, network_area)
+        if cache_key not in self.__link_cache:
+            area_links = self.__link_index.get(network_name, {})
+            links = set(area_links.get('*', ())) | area_links.get(network_area, set())
+            export_address = self.get_export_address(network_name)
+            if export_address is not None:
+                links.add(export_address)
+            self.__link_cache[cache_key] = frozenset(links)
+        return self.__link_cache[cache_key]
+
+    def find_next_hop(self, network_name, address_key):
+        # Address of the link mail for address_key is packed for, the most
+        # specific route wins and the export_address is the default.
+        # Decisions are cached until the configuration or nodelist changes.
+        """
+        :type network_name: str
+        :type address_key: tuple
+        :rtype : tuple
+        """
+        cache_key = (network_name, address_key)
+        if cache_key in self.__route_cache:
+            return self.__route_cache[cache_key]
+
+        route_table = self.__route_index.get(network_name, {})
+        next_hop = None
+        for length in (4, 3, 2, 1, 0):
+            next_hop = route_table.get(address_key[:length])
+            if next_hop is not None:
+                break
+
+        if next_hop == 'direct':
+            next_hop = address_key
+        elif next_hop == 'nodelist':
+            nodelist = get_nodelist(network_name)
+            next_hop = nodelist.find_route(address_key) if nodelist is not None else None
+            if next_hop is not None and self.find_network(next_hop) == network_name:
+                # We are the hub or host, deliver it ourselves.
+                next_hop = address_key
+
+        if next_hop is None:
+            next_hop = self.get_export_address(network_name)
+
+        self.__route_cache[cache_key] = next_hop
+        return next_hop
+
+    def clear_route_cache(self):
+        self.__route_cache = {}
+
+    def find_network(self, address_key):
+        # (zone, net, node, point) tuple to network name
+        """
+        :type address_key: tuple
+        :rtype : str
+        """
+        return self.__address_index.get(address_key)
+
+    def get_node_address(self, network_name):
+        # This system's (zone, net, node, point) address on the network
+        """
+        :rtype : tuple
+        """
+        addresses = self.__node_address.get(network_name)
+        return parse_fido_address(addresses[0]) if addresses else None
+
+    def get_export_address(self, network_name):
+        # The network hub's (zone, net, node, point) address
+        """
+        :rtype : tuple
+        """
+        addresses = self.__export_address.get(network_name)
+        return parse_fido_address(addresses[0]) if addresses else None
+
+    def get_nodelist_path(self, network_name):
+        # Base path of the network's daily nodelist, None without one
+        """
+        :rtype : str
+        """
+        return self.__nodelist.get(network_name)
+
+    def get_nodediff_path(self, network_name):
+        # Base path of the network's nodediffs, None without them
+        """
+        :rtype : str
+        """
+        return self.__nodediff.get(network_name)
+
+    def get_nodelist_index(self, network_name):
+        # Compiled nodelist for the network, kept next to the nodelist.
+        """
+        :rtype : str
+        """
+        nodelist_path = self.__nodelist.get(network_name)
+        return nodelist_path + '.idx' if nodelist_path else None
+
+    def find_area(self, tag):
+        # x84 tag to (network, area), a network tag on its own
+        # maps to that network's default area.
+        """
+        :type tag: str
+        :rtype : tuple
+        """
+        if tag in self.__tag_index:
+            return self.__tag_index[tag]
+        default_area = self.__default_areas.get(tag)
+        if default_area:
+            return tag, ''.join(default_area).lower()
+        return None
+
+    def find_network_area(self, tags):
+        # First of the x84 tags that maps to a (network, area), tags are
+        # checked in sorted order so the result is always the same.
+        """
+        :type tags: set
+        :rtype : tuple
+        """
+        for tag in sorted(tags):
+            network_area = self.find_area(tag)
+            if network_area is not None:
+                return network_area
+        return None
+
     def check_network_address(self, address):
         # verify node address, return network name
-        for key, val in self.__node_address.items():
-            if address in ''.join(val):
-                return '{network}'.format(network=key)
-        return None
+        address_key = parse_fido_address(address)
+        if address_key is None:
+            return None
+        return self.find_network(address_key)
 
     def get_tag(self, network_name, network_area):
-        # transpose area to tag name
-        # seperate string value into k, v dist.
-        if self.is_network_empty is False:
-            for area in self.__network_areas[network_name]:
-                k, v = area.split(': ')
-                if network_area in k:
-                    return v
-        return None
+        # transpose area to tag name, exact match on the area
+        area_tags = self.__area_index.get(network_name)
+        if area_tags is None or network_area is None:
+            return None
+        return area_tags.get(network_area.lower())
 
     def count_network_areas(self):
         # Just gets a general count of network keys
@@ -167,58 +684,151 @@ class FidonetConfiguration():
         return count
 
     def read_configuration(self):
+        from x84.bbs.ini import get_ini
+
         # Working Folders pull from .x84 Default INI
         self.__inbound_folder = ''.join(get_ini(section='mailpacket', key='inbound', split=True))
         self.__unpack_folder = ''.join(get_ini(section='mailpacket', key='unpack', split=True))
+        self.__archive_folder = ''.join(get_ini(section='mailpacket', key='archive', split=True)) or None
+        self.__bad_folder = ''.join(get_ini(section='mailpacket', key='bad', split=True)) or None
+        self.__outbound_folder = ''.join(get_ini(section='mailpacket', key='outbound', split=True))
+        self.__pack_folder = ''.join(get_ini(section='mailpacket', key='pack', split=True))
+        self.__packet_size_limit = 1024 * (get_ini(
+            section='mailpacket', key='packet_size_limit', getter='getint') or DEFAULT_PACKET_SIZE_LIMIT)
+        self.__bbs_name = get_ini(section='system', key='bbsname') or PRODUCT_NAME
+        self.__metrics_file = get_ini(section='mailpacket', key='metrics_file') or None
+        self.__toss_debounce = get_ini(
+            section='mailpacket', key='toss_debounce', getter='getint') or DEFAULT_TOSS_DEBOUNCE
+        self.__scan_interval = get_ini(
+            section='mailpacket', key='scan_interval', getter='getint') or DEFAULT_SCAN_INTERVAL
+        self.__poll_interval = get_ini(
+            section='mailpacket', key='poll_interval', getter='getint') or DEFAULT_POLL_INTERVAL
+        self.__stream_bundles = get_ini(section='mailpacket', key='stream_bundles', getter='getboolean')
+        self.__import_batch_size = get_ini(
+            section='mailpacket', key='import_batch_size', getter='getint') or DEFAULT_IMPORT_BATCH_SIZE
+        self.__dupe_max_age = get_ini(
+            section='mailpacket', key='dupe_max_age', getter='getint') or DEFAULT_DUPE_MAX_AGE
+        self.__dupe_max_entries = get_ini(
+            section='mailpacket', key='dupe_max_entries', getter='getint') or DEFAULT_DUPE_MAX_ENTRIES
+        self.__toss_workers = max(1, get_ini(
+            section='mailpacket', key='toss_workers', getter='getint') or DEFAULT_TOSS_WORKERS)
 
         # read .x84 default.ini file for network info
         # build dicts for all networks and their associations
         self.add_network()
-        print 'network_list: ' + ', '.join(str(x) for x in self.__network_list)
-
         self.add_node_address()
+        self.add_export_address()
+        self.add_network_areas()
+        self.add_default_areas()
+        self.add_nodelists()
+        self.add_routes()
+        self.add_downlinks()
+
+        # Lookup tables used by the tosser
+        self.build_address_index()
+        self.build_area_index()
+        self.build_route_index()
+        self.build_link_index()
+
+        if self.__verbose:
+            self.print_configuration()
+
+    def print_configuration(self):
+        # Print out the settings and network info that was read
+        print ''
+        print 'network_list: ' + ', '.join(str(x) for x in self.__network_list)
         for key, val in self.__node_address.items():
             print 'node_address: {key}, {value}'.format(key=key, value=val)
-
-        self.add_export_address()
         for key, val in self.__export_address.items():
             print 'export_address: {key}, {value}'.format(key=key, value=val)
-
-        self.add_network_areas()
         for key, val in self.__network_areas.items():
             print 'network_areas: {key}, {value}'.format(key=key, value=val)
-
-        self.add_default_areas()
         for key, val in self.__default_areas.items():
             print 'default_areas: {key}, {value}'.format(key=key, value=val)
+        for key, val in self.__routes.items():
+            print 'routes: {key}, {value}'.format(key=key, value=val)
+        for key, val in self.__downlinks.items():
+            print 'downlinks: {key}, {value}'.format(key=key, value=val)
+        for key, val in self.__nodelist.items():
+            print 'nodelist: {key}, {value}, {diff}'.format(
+                key=key, value=val, diff=self.__nodediff.get(key))
+
+        print ''
+        print 'is network empty: {bool}'.format(bool=self.is_network_empty)
+        print 'num of network w/ areas: {count}'.format(count=self.count_network_areas())
+        print 'inbound_folder: {name}'.format(name=self.inbound_folder)
+        print 'unpack_folder : {name}'.format(name=self.unpack_folder)
+        print 'archive_folder: {name}'.format(name=self.archive_folder)
+        print 'bad_folder: {name}'.format(name=self.bad_folder)
+        print 'outbound_folder: {name}'.format(name=self.outbound_folder)
+        print 'pack_folder: {name}'.format(name=self.pack_folder)
+        print 'packet_size_limit: {size}'.format(size=self.packet_size_limit)
+        print 'stream_bundles: {bool}'.format(bool=self.stream_bundles)
+        print 'import_batch_size: {count}'.format(count=self.import_batch_size)
+        print 'dupe_max_age: {days}'.format(days=self.dupe_max_age)
+        print 'dupe_max_entries: {count}'.format(count=self.dupe_max_entries)
+        print 'toss_workers: {count}'.format(count=self.toss_workers)
+        print 'metrics_file: {name}'.format(name=self.metrics_file)
+        print 'toss_debounce: {seconds}'.format(seconds=self.toss_debounce)
+        print 'scan_interval: {seconds}'.format(seconds=self.scan_interval)
+        print 'poll_interval: {seconds}'.format(seconds=self.poll_interval)
+        print ''
+
+
+# Parsed Fido-net addresses and areas, loaded on first use.
+_configuration = None
+
+
+def load_configuration(verbose=False):
+    # Read and compile the Fido-net configuration, replacing the cached
+    # copy.  When not running inside x84 the default .x84 INI is read first.
+    """
+    :type verbose: bool
+    :rtype : FidonetConfiguration
+    """
+    global _configuration
+    from x84.bbs import ini
+
+    if getattr(ini, 'CFG', None) is None:
+        # Read in default .x84 INI File.
+        from x84.cmdline import parse_args
+        ini.init(*parse_args())
 
-print ''
+    cfg = FidonetConfiguration(verbose=verbose)
 
-# Parse and Setup Fido-net addresses and areas
-cfg = FidonetConfiguration()
+    # Make sure we have at least one network setup
+    assert cfg.is_network_empty is False
 
-print ''
-print 'is network empty: {bool}'.format(bool=cfg.is_network_empty)
-print 'num of network w/ areas: {count}'.format(count=cfg.count_network_areas())
-print 'inbound_folder: {name}'.format(name=cfg.inbound_folder)
-print 'unpack_folder : {name}'.format(name=cfg.unpack_folder)
-print ''
+    # Make sure we have at least one network area
+    assert cfg.count_network_areas() >= 1
 
-# Make sure we have at least one network setup
-assert cfg.is_network_empty is False
+    # Make sure the Inbound directory is valid
+    assert os.path.isdir(cfg.inbound_folder)
 
-# Make sure we have at least one network area
-assert cfg.count_network_areas() >= 1
+    # Check the Packet Folder.
+    assert os.path.isdir(cfg.unpack_folder)
 
-# Make sure the Inbound directory is valid
-assert os.path.isdir(cfg.inbound_folder)
+    _configuration = cfg
+    return cfg
 
-# Check the Packet Folder.
-assert os.path.isdir(cfg.unpack_folder)
+
+def get_configuration():
+    # Cached configuration, loaded the first time it is asked for.
+    """
+    :rtype : FidonetConfiguration
+    """
+    if _configuration is None:
+        return load_configuration()
+    return _configuration
 
 # Handle count of Areas Processed
 area_count = collections.defaultdict(int)
 
+# Handle count of Dupes skipped per Area
+dupe_count = collections.defaultdict(int)
+
+log = logging.getLogger(__name__)
+
 # Fido Packet 2 Structure
 _struct_packet_header_fields = [
     # Structure Size 58
@@ -257,76 +867,197 @@ _struct_fidonet_packet = '<{0}'.format(
 FidonetPacketHeader = collections.namedtuple(
     'FidonetPacketHeader', [field_name for _, field_name in _struct_packet_header_fields])
 
+# FSC-0045 Type-2.2 Packet Structure, points and 5D domains in place of the date.
+_struct_packet_header22_fields = [
+    # Structure Size 58
+    ('H', 'origin_node'),
+    ('H', 'destination_node'),
+    ('H', 'origin_point'),
+    ('H', 'destination_point'),
+    ('8s', 'reserved'),
+    ('H', 'sub_version'),
+    ('H', 'packet_type'),
+    ('H', 'origin_network'),
+    ('H', 'destination_network'),
+    ('B', 'prod_code'),
+    ('B', 'revision'),
+    ('8s', 'password'),
+    ('H', 'origin_zone'),
+    ('H', 'destination_zone'),
+    ('8s', 'origin_domain'),
+    ('8s', 'destination_domain'),
+    ('L', 'prod_data')
+]
+
+_struct_fidonet_packet22 = '<{0}'.format(
+    ''.join(struct_val for struct_val, _ in _struct_packet_header22_fields))
 
-class FlagBits(LittleEndianStructure):
-    # Captures the 1st Byte Set of Bit Flags in the Message Header
-    _fields_ = [
-        ('private',      c_uint8, 1),  # asByte & 1
-        ('crash',        c_uint8, 1),  # asByte & 2
-        ('received',     c_uint8, 1),  # asByte & 4
-        ('sent',         c_uint8, 1),  # asByte & 8
-        ('file_attach',  c_uint8, 1),  # asByte & 16
-        ('in_transit',   c_uint8, 1),  # asByte & 32
-        ('orphan',       c_uint8, 1),  # asByte & 64
-        ('kill_sent',    c_uint8, 1),  # asByte & 128
-    ]
-
-    def get_dict(self):
-        # return ordered fields of bits
-        return collections.OrderedDict((f, getattr(self, f)) for f, v, i in self._fields_)
-
-
-class FlagBits2(LittleEndianStructure):
-    # Captures the 2nd Byte Set of Bit Flags in the Message Header
-    _fields_ = [
-        ('local',        c_uint8, 1),  # asByte & 256
-        ('hold',         c_uint8, 1),  # asByte & 512
-        ('unused',       c_uint8, 1),  # asByte & 1024
-        ('file_request', c_uint8, 1),  # asByte & 2048
-        ('want_receipt', c_uint8, 1),  # asByte & 4096
-        ('is_receipt',   c_uint8, 1),  # asByte & 8192
-        ('audit',        c_uint8, 1),  # asByte & 16384
-        ('file_update',  c_uint8, 1),  # asByte & 32768
-    ]
-
-    def get_dict(self):
-        # return ordered fields of bits
-        return collections.OrderedDict((f, getattr(self, f)) for f, v, i in self._fields_)
-
-
-class Flags(Union):
-    # Union to set the In_Value flips the appropriate bits flags
-    # in_value can also be used to get the value of all set flags
-    _fields_ = [('bit', FlagBits),
-                ('in_value', c_uint8)]
-
-
-class Flags2(Union):
-    # Union to set the In_Value flips the appropriate bits flags
-    # in_value can also be used to get the value of all set flags
-    _fields_ = [('bit', FlagBits2),
-                ('in_value', c_uint8)]
-
-
-class SetFlags():
-    # Class to handle Bit Flags for Message Attributes
-    field = None
-    field2 = None
-
-    def __init__(self, field, field2):
-        # get flags from message header
-        """
-        :rtype : None
-        """
-        self.field = field
-        self.field2 = field2
-        self.set_flags()
+FidonetPacketHeader22 = collections.namedtuple(
+    'FidonetPacketHeader22', [field_name for _, field_name in _struct_packet_header22_fields])
+
+# The header words that tell the formats apart, baud / sub version,
+# packet type and the two FSC-0039 capability words.
+_packet_format_struct = struct.Struct('<16xHH20xH2xH')
+
+# FSC-0039 capability word bit for Type-2+
+_capability_type2plus = 0x0001
+
+
+def build_type2_header(fields):
+    # FTS-0001 Type-2, zones are in the Qzone fields and there are no
+    # points, anything past them is filler.
+    """
+    :type fields: tuple
+    :rtype : tuple
+    """
+    header = FidonetPacketHeader(*fields)
+    return header._replace(
+        origin_zone2=header.origin_zone, destination_zone2=header.destination_zone,
+        origin_point=0, destination_point=0), None, None
+
+
+def build_type2plus_header(fields):
+    # FSC-0039 / FSC-0048 Type-2+, zones come from the second zone fields
+    # when set.  A point sending with net 0xffff has its boss's net in
+    # aux_network.
+    """
+    :type fields: tuple
+    :rtype : tuple
+    """
+    header = FidonetPacketHeader(*fields)
+    origin_zone = header.origin_zone2 or header.origin_zone
+    destination_zone = header.destination_zone2 or header.destination_zone
+    origin_network = header.origin_network
+    if header.origin_point and origin_network == 0xffff:
+        origin_network = header.aux_network
+    return header._replace(
+        origin_zone=origin_zone, destination_zone=destination_zone,
+        origin_zone2=origin_zone, destination_zone2=destination_zone,
+        origin_network=origin_network), None, None
+
+
+def build_type22_header(fields):
+    # FSC-0045 Type-2.2, carried in the common header with its domains.
+    """
+    :type fields: tuple
+    :rtype : tuple
+    """
+    header = FidonetPacketHeader22(*fields)
+    return FidonetPacketHeader(
+        origin_node=header.origin_node, destination_node=header.destination_node,
+        year=0, month=0, day=0, hour=0, minute=0, second=0,
+        baud=header.sub_version, packet_type=header.packet_type,
+        origin_network=header.origin_network, destination_network=header.destination_network,
+        prod_code_low=header.prod_code, revision_major=header.revision,
+        password=header.password,
+        origin_zone=header.origin_zone, destination_zone=header.destination_zone,
+        aux_network=0, capWordA=0, prod_code_hi=0, revision_minor=0, capWordB=0,
+        origin_zone2=header.origin_zone, destination_zone2=header.destination_zone,
+        origin_point=header.origin_point, destination_point=header.destination_point,
+        prod_data=header.prod_data), \
+        header.origin_domain.rstrip('\x00').lower() or None, \
+        header.destination_domain.rstrip('\x00').lower() or None
+
+
+PacketFormat = collections.namedtuple('PacketFormat', ['name', 'header_struct', 'build_header'])
+
+# Packet formats by name, each with its precompiled header layout and the
+# builder that turns it into a FidonetPacketHeader and the domains.
+_packet_formats = {
+    '2': PacketFormat('2', struct.Struct(_struct_fidonet_packet), build_type2_header),
+    '2+': PacketFormat('2+', struct.Struct(_struct_fidonet_packet), build_type2plus_header),
+    '2.2': PacketFormat('2.2', struct.Struct(_struct_fidonet_packet22), build_type22_header),
+}
+
+
+def find_packet_format(data):
+    # Pick the format from the header words, None if it isn't a Type-2
+    # packet.  2.2 sets the sub version, 2+ has a valid capability word
+    # with its byte swapped copy.
+    """
+    :rtype : PacketFormat
+    """
+    sub_version, packet_type, capability_check, capability = _packet_format_struct.unpack_from(data, 0)
+    if packet_type != 2:
+        return None
+    if sub_version == 2:
+        return _packet_formats['2.2']
+    if capability & _capability_type2plus and \
+            capability_check == ((capability & 0xff) << 8 | capability >> 8):
+        return _packet_formats['2+']
+    return _packet_formats['2']
+
+
+# Message Attribute Bit Flags, 1st byte then 2nd byte of the
+# attribute word in the Message Header, lowest bit first.
+_attribute_flag_names1 = (
+    'private',       # asByte & 1
+    'crash',         # asByte & 2
+    'received',      # asByte & 4
+    'sent',          # asByte & 8
+    'file_attach',   # asByte & 16
+    'in_transit',    # asByte & 32
+    'orphan',        # asByte & 64
+    'kill_sent',     # asByte & 128
+)
+
+_attribute_flag_names2 = (
+    'local',         # asByte & 256
+    'hold',          # asByte & 512
+    'unused',        # asByte & 1024
+    'file_request',  # asByte & 2048
+    'want_receipt',  # asByte & 4096
+    'is_receipt',    # asByte & 8192
+    'audit',         # asByte & 16384
+    'file_update',   # asByte & 32768
+)
+
+
+def _build_attribute_table(flag_names):
+    # 256 entry table, flag byte -> frozenset of the flag names set.
+    return tuple(frozenset(name for bit, name in enumerate(flag_names) if value & (1 << bit))
+                 for value in xrange(256))
+
+_attribute_table1 = _build_attribute_table(_attribute_flag_names1)
+_attribute_table2 = _build_attribute_table(_attribute_flag_names2)
+
+# flag name -> (byte, bit mask), for encoding.
+_attribute_masks = dict(
+    [(name, (0, 1 << bit)) for bit, name in enumerate(_attribute_flag_names1)] +
+    [(name, (1, 1 << bit)) for bit, name in enumerate(_attribute_flag_names2)])
+
+# Encoded attribute sets, the exporter writes the same few sets over and over.
+_attribute_encode_cache = {}
+
+
+def decode_attributes(flags1, flags2):
+    # Message header flag bytes to a frozenset of flag names, the
+    # 2nd byte is usually clear so most messages share a table entry.
+    """
+    :type flags1: int
+    :type flags2: int
+    :rtype : frozenset
+    """
+    if not flags2:
+        return _attribute_table1[flags1]
+    return _attribute_table1[flags1] | _attribute_table2[flags2]
+
+
+def encode_attributes(attributes):
+    # Frozenset of flag names back to the two message header flag bytes.
+    """
+    :type attributes: frozenset
+    :rtype : tuple
+    """
+    flags = _attribute_encode_cache.get(attributes)
+    if flags is None:
+        flag_bytes = [0, 0]
+        for name in attributes:
+            byte, mask = _attribute_masks[name]
+            flag_bytes[byte] |= mask
+        flags = _attribute_encode_cache[attributes] = tuple(flag_bytes)
+    return flags
 
-    def set_flags(self):
-        attributes = Flags()
-        attributes.in_value = self.field
-        attributes2 = Flags2()
-        attributes2.in_value = self.field2
 
 # Fido Message Header Structure
 _struct_message_header_fields = [
@@ -347,37 +1078,90 @@ FidonetMessageHeader = collections.namedtuple(
     'FidonetMessageHeader', [field_name for _, field_name in _struct_message_header_fields])
 
 
-def read_cstring(file_object, offset):
-    # Function to read text up to null terminator
-    new_string = ""
-    # jump to offset.
-    assert isinstance(offset, object)
+# FTS-0001 maximum field lengths, these include the null terminator.
+_max_date_time_length = 20
+_max_username_length = 36
+_max_subject_length = 72
+
+# Chunk size used when scanning file objects for the null terminator.
+_read_chunk_size = 4096
+
+
+def read_cstring(source, offset, max_length=None):
+    # Function to read text up to null terminator, source can be a
+    # buffer (str / mmap) or a file object.  Returns the text and the
+    # offset just past the null terminator.
+    """
+    :type offset: int
+    :type max_length: int
+    :rtype : tuple
+    """
+    if hasattr(source, 'seek'):
+        return read_cstring_file(source, offset, max_length)
+
+    source_length = len(source)
+    end_bound = source_length
+    if max_length is not None:
+        end_bound = min(source_length, offset + max_length)
+
+    end = source.find('\x00', offset, end_bound)
+    if end == -1:
+        if end_bound < source_length:
+            # Corrupt field, don't scan past the maximum length.
+            raise ValueError('Field at offset {0} exceeds {1} bytes'.format(
+                offset, max_length))
+        end = end_bound
+    return source[offset:end], end + 1
+
+
+def read_cstring_file(file_object, offset, max_length=None):
+    # Function to read text up to null terminator from a file in chunks.
+    """
+    :type offset: int
+    :type max_length: int
+    :rtype : tuple
+    """
     file_object.seek(offset)
+    chunks = []
+    length = 0
     while True:
-        # read the file object
-        byte = file_object.read(1)
-        if not byte:
+        chunk = file_object.read(_read_chunk_size)
+        if not chunk:
             break
-        if byte in '\x00':
-            # Break on Null Terminated
+
+        end = chunk.find('\x00')
+        if end != -1:
+            chunks.append(chunk[:end])
+            length += end
             break
 
-        new_string += str(byte)
-    return new_string
+        chunks.append(chunk)
+        length += len(chunk)
+        if max_length is not None and length >= max_length:
+            break
 
+    if max_length is not None and length >= max_length:
+        # Corrupt field, don't scan past the maximum length.
+        raise ValueError('Field at offset {0} exceeds {1} bytes'.format(
+            offset, max_length))
 
-def read_message_text(file_object, offset):
-    # Function to read message text up to null terminator
-    assert isinstance(offset, object)
-    file_object.seek(offset)
+    return ''.join(chunks), offset + length + 1
 
-    message_string = ""
-    for chunk in iter(lambda: file_object.read(1), ''):
-        if chunk in '\x00':
-            break
 
-        message_string += chunk
-    return message_string
+def read_message_text(source, offset):
+    # Function to read message text up to null terminator, from a mmap
+    # the text is a buffer over the mapping, it is only copied to a
+    # string when the message is parsed.
+    """
+    :type offset: int
+    :rtype : tuple
+    """
+    if isinstance(source, mmap.mmap):
+        end = source.find('\x00', offset)
+        if end == -1:
+            end = len(source)
+        return buffer(source, offset, end - offset), end + 1
+    return read_cstring(source, offset)
 
 
 def track_area(area):
@@ -390,37 +1174,234 @@ def track_area(area):
         area_count[area] = 1
 
 
+def track_dupe(area):
+    """
+    :rtype : None
+    """
+    dupe_count[area] += 1
+
+
 def print_area_count():
     # Print out Counts of messages per area
     print ''
     total_messages = 0
     total_areas = 0
     for area in area_count:
-        print u'Area: {0} -> Total Messages: {1}'.format(
-            area, area_count[area])
+        print u'Area: {0} -> Total Messages: {1} -> Dupes: {2}'.format(
+            area, area_count[area], dupe_count[area])
         total_messages += area_count[area]
         total_areas += 1
 
-    # hard coded for now, this will be setup with dupe checking
-    total_messages_imported = total_messages
+    # Dupes are skipped before import, everything else was written.
+    total_messages_imported = total_messages - sum(dupe_count.values())
 
     print ''
     print 'Areas: {0} -> Messages: {1} -> Imported -> {2}.'.format(
         total_areas, total_messages, total_messages_imported)
 
 
+def iter_kludges(kludges):
+    # Yields (key, value) for each kludge line, kludges are a flat tuple
+    # of pairs, records saved by older versions hold a dict of lists.
+    """
+    :rtype : collections.Iterable[tuple]
+    """
+    if isinstance(kludges, dict):
+        for key, values in kludges.items():
+            for value in values:
+                yield key, value
+    else:
+        for key, value in kludges:
+            yield key, value
+
+
+def find_kludge(kludges, *keys):
+    # Values of the first kludge key found, [] if there are none.
+    """
+    :rtype : list
+    """
+    for key in keys:
+        values = [v for k, v in iter_kludges(kludges) if k == key]
+        if values:
+            return values
+    return []
+
+
+class StageHistogram(object):
+    # Timing histogram for one stage, bucket counts are kept per bucket
+    # and made cumulative when exported.
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def merge(self, other):
+        for index, bucket_count in enumerate(other.buckets):
+            self.buckets[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+
+    def cumulative(self):
+        # (upper bound, count) pairs, the last bound is '+Inf'
+        running = 0
+        for bound, bucket_count in zip(METRICS_BUCKETS + ('+Inf',), self.buckets):
+            running += bucket_count
+            yield bound, running
+
+    def __getstate__(self):
+        return self.buckets, self.count, self.total
+
+    def __setstate__(self, state):
+        self.buckets, self.count, self.total = state
+
+
+class TossMetrics(object):
+    # Counters, stage timings and per-area / per-network message totals
+    # for the last toss or scan run.  Stages are unzip, header_parse,
+    # body_parse, decode, dupe_check and db_save.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = collections.defaultdict(int)
+        self.stages = collections.defaultdict(StageHistogram)
+        self.area_totals = collections.defaultdict(int)
+        self.network_totals = collections.defaultdict(int)
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    def count_imported(self, network, area):
+        self.area_totals[(network, area)] += 1
+        self.network_totals[network] += 1
+
+    def merge(self, other):
+        # Add in the metrics a toss worker collected.
+        """
+        :type other: TossMetrics
+        """
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for stage, histogram in other.stages.items():
+            self.stages[stage].merge(histogram)
+        for key, value in other.area_totals.items():
+            self.area_totals[key] += value
+        for key, value in other.network_totals.items():
+            self.network_totals[key] += value
+
+    def __getstate__(self):
+        return (dict(self.counters), dict(self.stages),
+                dict(self.area_totals), dict(self.network_totals))
+
+    def __setstate__(self, state):
+        self.reset()
+        counters, stages, area_totals, network_totals = state
+        self.counters.update(counters)
+        self.stages.update(stages)
+        self.area_totals.update(area_totals)
+        self.network_totals.update(network_totals)
+
+    def to_dict(self):
+        """
+        :rtype : dict
+        """
+        return {
+            'counters': dict(self.counters),
+            'stages': dict((stage, {
+                'count': histogram.count,
+                'sum': histogram.total,
+                'buckets': [[str(bound), count] for bound, count in histogram.cumulative()],
+            }) for stage, histogram in self.stages.items()),
+            'areas': [{'network': network, 'area': area, 'messages': count}
+                      for (network, area), count in sorted(self.area_totals.items())],
+            'networks': dict(self.network_totals),
+        }
+
+    def to_prometheus(self):
+        # Prometheus text exposition format, eg. for node_exporter's
+        # textfile collector.
+        """
+        :rtype : str
+        """
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE pypacketmail_{0}_total counter'.format(name))
+            lines.append('pypacketmail_{0}_total {1}'.format(name, value))
+
+        lines.append('# TYPE pypacketmail_stage_seconds histogram')
+        for stage, histogram in sorted(self.stages.items()):
+            for bound, count in histogram.cumulative():
+                lines.append('pypacketmail_stage_seconds_bucket{{stage="{0}",le="{1}"}} {2}'.format(
+                    stage, bound, count))
+            lines.append('pypacketmail_stage_seconds_sum{{stage="{0}"}} {1}'.format(
+                stage, histogram.total))
+            lines.append('pypacketmail_stage_seconds_count{{stage="{0}"}} {1}'.format(
+                stage, histogram.count))
+
+        lines.append('# TYPE pypacketmail_area_messages_total counter')
+        for (network, area), count in sorted(self.area_totals.items()):
+            lines.append('pypacketmail_area_messages_total{{network="{0}",area="{1}"}} {2}'.format(
+                network, area, count))
+
+        lines.append('# TYPE pypacketmail_network_messages_total counter')
+        for network, count in sorted(self.network_totals.items()):
+            lines.append('pypacketmail_network_messages_total{{network="{0}"}} {1}'.format(
+                network, count))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+    def write(self, file_path):
+        # Write to file_path, JSON for a .json file otherwise Prometheus
+        # text.  Written to a temp file first so readers never see half.
+        """
+        :type file_path: str
+        """
+        temp_path = '{0}.tmp'.format(file_path)
+        with open(temp_path, 'w') as metrics_object:
+            if file_path.endswith('.json'):
+                json.dump(self.to_dict(), metrics_object, indent=2, sort_keys=True)
+            else:
+                metrics_object.write(self.to_prometheus())
+        os.rename(temp_path, file_path)
+
+# Metrics for the current run.
+metrics = TossMetrics()
+
+
+def write_metrics():
+    # Write the run's metrics out when a metrics_file is set.
+    metrics_file = get_configuration().metrics_file
+    if metrics_file:
+        metrics.write(metrics_file)
+
+
 class StoredFidoInfo(object):
     # Holds Fido Specific Message and Kludge Data That
     # is Absent from the standard message layout
     def __init__(self, index):
         self.idx = index
         self.__status = None
+        self.__network = None
         self.__date_processed = None
-        self.__kludge = set()
+        self.__kludge = ()
 
     def status(self, flag):
         self.__status = flag
 
+    def network(self, network_name):
+        self.__network = network_name
+
     def kludge_lines(self, k_lines):
         assert isinstance(k_lines, object)
         self.__kludge = k_lines
@@ -433,48 +1414,661 @@ class StoredFidoInfo(object):
     def check_kludge(self):
         return self.__kludge
 
+    @property
+    def check_network(self):
+        # Records saved by older versions have no network.
+        return getattr(self, '_StoredFidoInfo__network', None)
+
     def save(self):
-        # persist message index record to database
+        # persist message index record to database, keeping the
+        # status index up to date.
         from x84.bbs import DBProxy
         new = self.idx is None
 
+        # Not Used, Messages are saved first, with Fido
+        # Data save with matching index.
+        if new:
+            self.idx = reserve_fido_indexes()[0]
+        else:
+            update_fido_high_water_mark(self.idx)
+
+        key = '%d' % (self.idx,)
         with DBProxy(FIDO_DB, use_session=False) as db_index:
-            # Not Used, Messages are saved first, with Fido
-            # Data save with matching index.
-            if new:
-                self.idx = max(map(int, db_index.keys()) or [-1]) + 1
-            db_index['%d' % (self.idx,)] = self
+            previous = db_index.get(key)
+            db_index[key] = self
 
+        update_status_index({key: self}, {key: previous.check_status if previous else None})
 
-class Message(object):
 
-    # Message Object that will be pasted into.
-    def __init__(self):
-        """
-        :rtype : None
-        :type self: str
-        """
-        self.date_time = None
-        self.user_to = None
-        self.user_from = None
-        self.subject = None
+def update_status_index(fido_records, previous_status):
+    # Move records between the status tables, fido_records maps keys to
+    # their saved records and previous_status maps keys to the status
+    # they were indexed under before, None for new records.  Keys only
+    # in previous_status are removed from the index.
+    """
+    :type fido_records: dict
+    :type previous_status: dict
+    """
+    from x84.bbs import DBProxy
+
+    removed = collections.defaultdict(list)
+    added = collections.defaultdict(dict)
+    for key in set(fido_records) | set(previous_status):
+        fido_msg = fido_records.get(key)
+        old_flag = previous_status.get(key)
+        new_flag = fido_msg.check_status if fido_msg is not None else None
+        if old_flag == new_flag and old_flag is not None:
+            continue
+        if old_flag is not None:
+            removed[old_flag].append(key)
+        if new_flag is not None:
+            added[new_flag][key] = fido_msg.check_network
+
+    for flag, keys in removed.items():
+        with DBProxy(FIDO_DB, table=FIDO_STATUS_TABLE.format(flag), use_session=False) as db_status:
+            for key in keys:
+                if key in db_status:
+                    del db_status[key]
+
+    for flag, records in added.items():
+        with DBProxy(FIDO_DB, table=FIDO_STATUS_TABLE.format(flag), use_session=False) as db_status:
+            db_status.update(records)
+
+
+def build_status_index():
+    # First run on an existing database, index every stored record by
+    # its status once.  Later saves keep the index up to date.
+    from x84.bbs import DBProxy
+
+    with DBProxy(FIDO_DB, table=FIDO_SEQUENCE_TABLE, use_session=False) as db_sequence:
+        if db_sequence.get('status_indexed'):
+            return
+
+        with DBProxy(FIDO_DB, use_session=False) as db_index:
+            fido_records = dict(db_index.items())
+        update_status_index(fido_records, {})
+        db_sequence['status_indexed'] = True
+
+
+def find_fido_by_status(flag, network=None):
+    # Indexes of stored fido records with a status, optionally only for
+    # one network, oldest first.  Reads only the status table.
+    """
+    :type flag: str
+    :type network: str
+    :rtype : list
+    """
+    from x84.bbs import DBProxy
+
+    build_status_index()
+    with DBProxy(FIDO_DB, table=FIDO_STATUS_TABLE.format(flag), use_session=False) as db_status:
+        return sorted(int(key) for key, network_name in db_status.items()
+                      if network is None or network_name == network)
+
+
+def get_fido_high_water_mark(db_sequence):
+    # Next free FIDO_DB index, call with the sequence table locked.
+    """
+    :rtype : int
+    """
+    from x84.bbs import DBProxy
+    from x84.bbs.msgbase import MSGDB
+
+    next_idx = db_sequence.get('next_idx')
+    if next_idx is None:
+        # First run on an existing database, seed from the stored keys once,
+        # past the message base too so both keep the same indexes.
+        with DBProxy(MSGDB, use_session=False) as db_msg:
+            next_idx = max(map(int, db_msg.keys()) or [-1]) + 1
+        with DBProxy(FIDO_DB, use_session=False) as db_index:
+            next_idx = max(map(int, db_index.keys()) or [next_idx - 1]) + 1
+        db_sequence['next_idx'] = next_idx
+    return next_idx
+
+
+def reserve_fido_indexes(count=1):
+    # Reserve a range of FIDO_DB indexes from the persistent high water
+    # mark, allocated under the sequence table lock.  Tossed messages are
+    # saved to the msgbase with the same indexes.
+    """
+    :type count: int
+    :rtype : xrange
+    """
+    from x84.bbs import DBProxy
+
+    with DBProxy(FIDO_DB, table=FIDO_SEQUENCE_TABLE, use_session=False) as db_sequence:
+        next_idx = get_fido_high_water_mark(db_sequence)
+        db_sequence['next_idx'] = next_idx + count
+
+    return xrange(next_idx, next_idx + count)
+
+
+def update_fido_high_water_mark(last_idx):
+    # Records saved with a matching message index move the high
+    # water mark past them so reserved indexes never collide.
+    """
+    :type last_idx: int
+    """
+    from x84.bbs import DBProxy
+
+    with DBProxy(FIDO_DB, table=FIDO_SEQUENCE_TABLE, use_session=False) as db_sequence:
+        if get_fido_high_water_mark(db_sequence) <= last_idx:
+            db_sequence['next_idx'] = last_idx + 1
+
+
+class DupeIndex(object):
+    # Persistent dupe index kept in FIDO_DB.  The dupe table maps each key
+    # to a serial number for a single indexed lookup, the history table
+    # maps serials back to (key, time) so the oldest entries can be evicted
+    # from the front without scanning the whole index.
+    def __init__(self, max_age=None, max_entries=None):
+        """
+        :type max_age: int
+        :type max_entries: int
+        :rtype : None
+        """
+        cfg = get_configuration()
+        self.max_age = max_age or cfg.dupe_max_age
+        self.max_entries = max_entries or cfg.dupe_max_entries
+
+    def find_dupes(self, keys):
+        # Return the keys that are already in the index.
+        """
+        :type keys: collections.Iterable[str]
+        :rtype : set
+        """
+        from x84.bbs import DBProxy
+
+        with DBProxy(FIDO_DB, table=FIDO_DUPE_TABLE, use_session=False) as db_dupes:
+            return set(key for key in keys if key in db_dupes)
+
+    def record(self, keys):
+        # Add newly imported keys, then evict anything past the limits.
+        """
+        :type keys: list
+        :rtype : None
+        """
+        from x84.bbs import DBProxy
+
+        if not keys:
+            return
+
+        now = int(time.time())
+        with DBProxy(FIDO_DB, table=FIDO_DUPE_TABLE, use_session=False) as db_dupes, \
+                DBProxy(FIDO_DB, table=FIDO_DUPE_HISTORY_TABLE, use_session=False) as db_history, \
+                DBProxy(FIDO_DB, table=FIDO_SEQUENCE_TABLE, use_session=False) as db_sequence:
+
+            next_serial = db_sequence.get('dupe_next', 0)
+            dupe_records = {}
+            history_records = {}
+            for serial, key in enumerate(keys, next_serial):
+                dupe_records[key] = serial
+                history_records['%d' % (serial,)] = (key, now)
+
+            db_dupes.update(dupe_records)
+            db_history.update(history_records)
+            db_sequence['dupe_next'] = next_serial + len(keys)
+
+            self.evict(db_dupes, db_history, db_sequence, now)
+
+    def evict(self, db_dupes, db_history, db_sequence, now):
+        # Drop the oldest entries while the index is over its size or age
+        # limit, call with the dupe, history and sequence tables locked.
+        """
+        :type now: int
+        :rtype : int
+        """
+        next_serial = db_sequence.get('dupe_next', 0)
+        oldest = db_sequence.get('dupe_oldest', 0)
+        cutoff = now - self.max_age * 86400
+        evicted = 0
+
+        while oldest < next_serial:
+            history_key = '%d' % (oldest,)
+            key, recorded = db_history.get(history_key, (None, None))
+            if key is not None:
+                if next_serial - oldest <= self.max_entries and recorded >= cutoff:
+                    break
+                del db_history[history_key]
+                if db_dupes.get(key) == oldest:
+                    del db_dupes[key]
+                evicted += 1
+            oldest += 1
+
+        db_sequence['dupe_oldest'] = oldest
+        return evicted
+
+
+class ReplyIndex(object):
+    # Persistent MSGID index kept in FIDO_DB, so a REPLY kludge is
+    # resolved to its parent with a single lookup when it is imported.
+    # Replies tossed before their parent wait in the pending table under
+    # the parent's MSGID and are linked once the parent arrives.  One
+    # ReplyIndex is used for each ImportBatch commit.
+    def __init__(self):
+        self.msgids = {}            # MSGID -> idx, new this batch
+        self.pending = {}           # MSGID -> [idx], replies still waiting
+        self.previous_pending = {}  # MSGID -> [idx] before this batch
+        self.previous_links = {}    # msg key -> (parent, children) before linking
+
+    @staticmethod
+    def msgid_key(area, msg_id):
+        # MSGIDs are kept per area, crossposts share the same MSGID.
+        """
+        :type area: str
+        :type msg_id: str
+        :rtype : str
+        """
+        return '{area}:{msg_id}'.format(area=area or '', msg_id=msg_id.strip())
+
+    def link(self, staged, db_msg, msg_records):
+        # Set the parent and children of each staged record, existing
+        # records that gain a link are returned by key to be saved.
+        """
+        :type staged: list
+        :type msg_records: dict
+        :rtype : dict
+        """
+        from x84.bbs import DBProxy
+
+        linked_records = {}
+
+        def get_record(idx):
+            key = '%d' % (idx,)
+            if key in msg_records:
+                return msg_records[key]
+            if key not in linked_records:
+                record = db_msg.get(key)
+                if record is None:
+                    # Deleted from the message base.
+                    return None
+                self.previous_links[key] = (record.parent, set(record.children))
+                linked_records[key] = record
+            return linked_records[key]
+
+        def add_link(parent_idx, child_idx):
+            parent, child = get_record(parent_idx), get_record(child_idx)
+            if parent is None or child is None:
+                return
+            child.parent = parent_idx
+            parent.children.add(child_idx)
+
+        with DBProxy(FIDO_DB, table=FIDO_MSGID_TABLE, use_session=False) as db_msgid, \
+                DBProxy(FIDO_DB, table=FIDO_REPLY_PENDING_TABLE, use_session=False) as db_pending:
+
+            # Index the whole batch first, so replies in the same batch
+            # are linked whichever order they arrived in.
+            for message, store_msg in staged:
+                msg_id = find_kludge(message.kludge_lines, 'MSGID:', 'MSGID')
+                if msg_id:
+                    key = self.msgid_key(message.area, msg_id[0])
+                    if key not in self.msgids and key not in db_msgid:
+                        self.msgids[key] = store_msg.idx
+
+            for message, store_msg in staged:
+                reply = find_kludge(message.kludge_lines, 'REPLY:', 'REPLY')
+                if not reply:
+                    continue
+
+                key = self.msgid_key(message.area, reply[0])
+                parent_idx = self.msgids.get(key)
+                if parent_idx is None:
+                    parent_idx = db_msgid.get(key)
+
+                if parent_idx is None:
+                    # Parent not seen yet, wait for it.
+                    if key not in self.pending:
+                        self.previous_pending[key] = db_pending.get(key)
+                        self.pending[key] = list(self.previous_pending[key] or ())
+                    self.pending[key].append(store_msg.idx)
+                elif parent_idx != store_msg.idx:
+                    add_link(parent_idx, store_msg.idx)
+
+            # Link replies that were tossed before their parent.
+            for key, parent_idx in self.msgids.items():
+                waiting = db_pending.get(key)
+                if waiting:
+                    self.previous_pending[key] = waiting
+                    self.pending[key] = []
+                    for child_idx in waiting:
+                        add_link(parent_idx, child_idx)
+
+        return linked_records
+
+    def save(self):
+        # Write the new MSGIDs and the pending replies.
+        from x84.bbs import DBProxy
+
+        with DBProxy(FIDO_DB, table=FIDO_MSGID_TABLE, use_session=False) as db_msgid, \
+                DBProxy(FIDO_DB, table=FIDO_REPLY_PENDING_TABLE, use_session=False) as db_pending:
+            db_msgid.update(self.msgids)
+            for key, waiting in self.pending.items():
+                if waiting:
+                    db_pending[key] = waiting
+                elif key in db_pending:
+                    del db_pending[key]
+
+    def rollback(self, db_msg):
+        # Undo the links and index entries from a failed batch.
+        from x84.bbs import DBProxy
+
+        for key, (parent, children) in self.previous_links.items():
+            record = db_msg.get(key)
+            if record is not None:
+                record.parent = parent
+                record.children = children
+                db_msg[key] = record
+
+        with DBProxy(FIDO_DB, table=FIDO_MSGID_TABLE, use_session=False) as db_msgid, \
+                DBProxy(FIDO_DB, table=FIDO_REPLY_PENDING_TABLE, use_session=False) as db_pending:
+            for key, idx in self.msgids.items():
+                if db_msgid.get(key) == idx:
+                    del db_msgid[key]
+            for key, waiting in self.previous_pending.items():
+                if waiting is not None:
+                    db_pending[key] = waiting
+                elif key in db_pending:
+                    del db_pending[key]
+
+
+class ImportBatch(object):
+    # Collects parsed messages, then commits them to the x84 message base
+    # and the Fido kludge store together, one batch at a time.  If any part
+    # of a batch fails to write, everything it wrote is rolled back.
+    # With a router, echomail is forwarded to downlinks once committed.
+    def __init__(self, batch_size=None, router=None):
+        """
+        :type batch_size: int
+        :type router: OutboundRouter
+        :rtype : None
+        """
+        self.batch_size = batch_size or get_configuration().import_batch_size
+        self.router = router
+        self.dupe_index = DupeIndex()
+        self.messages = []
+        self.pending_keys = set()
+        self.total_imported = 0
+        self.total_dupes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Commit what is left on a clean exit, otherwise discard it.
+        if exc_type is None:
+            self.commit()
+        else:
+            del self.messages[:]
+            self.pending_keys.clear()
+
+    def skip_dupe(self, message):
+        # Count a dupe against its area, it is never written.
+        """
+        :type message: Message
+        """
+        track_dupe(message.area)
+        metrics.count('dupes')
+        self.total_dupes += 1
+
+    def add(self, message):
+        # Queue a parsed message, commits once the batch is full.
+        """
+        :type message: Message
+        """
+        # Same message twice in this batch, no need to check the index.
+        if message.dupe_key in self.pending_keys:
+            self.skip_dupe(message)
+            return
+
+        self.pending_keys.add(message.dupe_key)
+        self.messages.append(message)
+        if len(self.messages) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        # Write every queued message with one commit per database.
+        """
+        :rtype : int
+        """
+        from x84.bbs import DBProxy
+        from x84.bbs.msgbase import MSGDB, TAGDB
+
+        if not self.messages:
+            return 0
+
+        messages = self.messages
+        self.messages = []
+        self.pending_keys = set()
+
+        # Dupe check the whole batch before anything is written.
+        started = time.time()
+        dupes = self.dupe_index.find_dupes(message.dupe_key for message in messages)
+        metrics.observe('dupe_check', time.time() - started)
+        if dupes:
+            for message in messages:
+                if message.dupe_key in dupes:
+                    self.skip_dupe(message)
+            messages = [message for message in messages if message.dupe_key not in dupes]
+            if not messages:
+                return 0
+
+        # Build every record first, nothing is written if a message fails.
+        # Messages decoded by a toss worker already carry their record.
+        staged = [(message, message.store_msg or message.build_msg()) for message in messages]
+
+        started = time.time()
+        indexes = reserve_fido_indexes(len(staged))
+        with DBProxy(MSGDB, use_session=False) as db_msg, \
+                DBProxy(TAGDB, use_session=False) as db_tag, \
+                DBProxy(FIDO_DB, use_session=False) as db_index:
+
+            # Local posts since the last scan are added by x84 past the
+            # high water mark, reserve again until the range is free.
+            while any('%d' % (idx,) in db_msg for idx in indexes):
+                indexes = reserve_fido_indexes(len(staged))
+
+            # Messages are saved first, with Fido Data save with matching index.
+            msg_records = {}
+            fido_records = {}
+            tag_records = {}
+            previous_tags = {}
+
+            for idx, (message, store_msg) in zip(indexes, staged):
+                store_msg.idx = idx
+                msg_records['%d' % (idx,)] = store_msg
+
+                for tag in store_msg.tags:
+                    if tag not in tag_records:
+                        previous_tags[tag] = db_tag.get(tag)
+                        tag_records[tag] = set(previous_tags[tag] or ())
+                    tag_records[tag].add(idx)
+
+                # Setup and store the fido kludge data
+                fido_msg = StoredFidoInfo(idx)
+                fido_msg.status('received')
+                fido_msg.network(message.network)
+                fido_msg.kludge_lines(tuple(message.kludge_lines))
+                fido_records['%d' % (idx,)] = fido_msg
+
+            # Thread replies to their parents by MSGID.
+            reply_index = ReplyIndex()
+            linked_records = reply_index.link(staged, db_msg, msg_records)
+
+            try:
+                db_msg.update(msg_records)
+                db_msg.update(linked_records)
+                db_tag.update(tag_records)
+                db_index.update(fido_records)
+                update_status_index(fido_records, {})
+                reply_index.save()
+            except:
+                # Roll back whatever part of the batch was written.
+                for key in msg_records:
+                    if key in db_msg:
+                        del db_msg[key]
+                reply_index.rollback(db_msg)
+                for key in fido_records:
+                    if key in db_index:
+                        del db_index[key]
+                update_status_index({}, dict((key, fido_msg.check_status)
+                                             for key, fido_msg in fido_records.items()))
+                for tag, msgs in previous_tags.items():
+                    if msgs is not None:
+                        db_tag[tag] = msgs
+                    elif tag in db_tag:
+                        del db_tag[tag]
+                raise
+
+        self.dupe_index.record([message.dupe_key for message in messages])
+        metrics.observe('db_save', time.time() - started)
+
+        for message in messages:
+            metrics.count_imported(message.network, message.area)
+        metrics.count('messages_imported', len(staged))
+
+        # Only new messages are passed on, dupes never reach the links.
+        if self.router is not None:
+            for message in messages:
+                self.router.forward_echomail(message)
+
+        self.total_imported += len(staged)
+        log.debug('Imported {0} messages, Msg Index {1} - {2}'.format(
+            len(staged), indexes[0], indexes[-1]))
+        return len(staged)
+
+
+# FTS-5003 CHRS / CHARSET identifiers to Python codecs, anything
+# unknown or missing is read as CP437.
+_chrs_codecs = {
+    'ASCII': 'ascii',
+    'CP437': 'cp437',
+    'IBMPC': 'cp437',
+    'PC-8': 'cp437',
+    'CP850': 'cp850',
+    'CP852': 'cp852',
+    'CP865': 'cp865',
+    'CP866': 'cp866',
+    'CP1250': 'cp1250',
+    'CP1251': 'cp1251',
+    'CP1252': 'cp1252',
+    'LATIN-1': 'latin_1',
+    'ISO-8859-1': 'latin_1',
+    'LATIN-2': 'iso8859_2',
+    'ISO-8859-2': 'iso8859_2',
+    'KOI8-R': 'koi8_r',
+    'KOI8-U': 'koi8_u',
+    'MAC': 'mac_roman',
+    'UTF-8': 'utf_8',
+}
+_default_codec = 'cp437'
+
+# CHRS identifier -> decode function, resolved once per character set.
+_decoder_cache = {}
+
+
+def get_codec_name(charset):
+    # Python codec name for a CHRS identifier.
+    """
+    :type charset: str
+    :rtype : str
+    """
+    return _chrs_codecs.get((charset or '').upper(), _default_codec)
+
+
+def get_decoder(charset):
+    # Decode function for a CHRS identifier, cached after the first lookup.
+    """
+    :type charset: str
+    :rtype : callable
+    """
+    decoder = _decoder_cache.get(charset)
+    if decoder is None:
+        decoder = _decoder_cache[charset] = codecs.lookup(get_codec_name(charset)).decode
+    return decoder
+
+
+def decode_text(text, decoder):
+    # Most traffic is 7-bit, try the ASCII codec first and only fall
+    # back to the message's character set when there is high ascii.
+    """
+    :type text: str
+    :type decoder: callable
+    :rtype : unicode
+    """
+    try:
+        return unicode(text, 'ascii')
+    except UnicodeDecodeError:
+        return decoder(text, 'replace')[0]
+
+
+# CR with any LF around it, LF is stripped from the ends of message lines.
+_line_feed_pattern = re.compile('\n*\r\n*')
+
+
+class Message(object):
+
+    # Message Object that will be pasted into, slots keep the many
+    # messages alive during a large toss small.
+    __slots__ = ('date_time', 'user_to', 'user_from', 'subject', 'area',
+                 'tag_line', 'origin_line', 'kludge_lines', 'seen_by', 'raw_data',
+                 'message_header', 'packet_header', 'packet_address', 'network',
+                 'body', 'store_msg', 'attributes', '__dupe_key')
+
+    def __init__(self):
+        """
+        :rtype : None
+        :type self: str
+        """
+        self.date_time = None
+        self.user_to = None
+        self.user_from = None
+        self.subject = None
         self.area = None
         self.tag_line = None
         self.origin_line = None
-        self.kludge_lines = collections.OrderedDict()
+        # Flat list of (key, value) pairs in the order they were read.
+        self.kludge_lines = []
         self.seen_by = []
+        # Dropped once parse_lines() has split it.
         self.raw_data = None
         self.message_header = None
         self.packet_header = None
         self.packet_address = None
         self.network = None
-        # Clean Message Text, Split with CR, remove any LF!
-        self.message_lines = None
+        # Clean Message Text, CR separated, without any LF!
+        self.body = None
+        # x84 Msg record, when decoded ahead of the import.
+        self.store_msg = None
+        # Attribute flag names, eg. frozenset(['private', 'crash'])
+        self.attributes = frozenset()
+        self.__dupe_key = None
 
-    def import_messages(self):
+    @property
+    def dupe_key(self):
+        # Key for dupe checking, the area and MSGID kludge when there
+        # is one, otherwise a CRC of the area, from, subject and date.
+        """
+        :rtype : str
+        """
+        if self.__dupe_key is None:
+            area = self.area or ''
+            # Kludge keys keep their colon, eg. '\x01MSGID: 46:1/100 1955835b'
+            msg_id = find_kludge(self.kludge_lines, 'MSGID:', 'MSGID')
+            if msg_id:
+                self.__dupe_key = 'msgid:{area}:{msg_id}'.format(
+                    area=area, msg_id=msg_id[0].strip())
+            else:
+                crc = zlib.crc32('\x00'.join(
+                    (area, self.user_from or '', self.subject or '', self.date_time or '')))
+                self.__dupe_key = 'crc:{area}:{crc:08x}'.format(
+                    area=area, crc=crc & 0xffffffff)
+        return self.__dupe_key
+
+    def build_msg(self):
         from x84.bbs.msgbase import Msg
-        # hook into x84 and write message to default database and
-        # keep separate database for fido specific fields.
+        # Convert the parsed message into an x84 Msg record, the record
+        # is saved later on together with the rest of its ImportBatch.
+        started = time.time()
 
         # 'author': msg.author,
         # 'subject': msg.subject,
@@ -483,14 +2077,23 @@ class Message(object):
         # 'tags': [tag for tag in msg.tags if tag != network['name']],
         # 'ctime': to_utctime(msg.ctime)
         store_msg = Msg()
-        store_msg.recipient = unicode(self.user_to, 'CP437')
-        store_msg.author = unicode(self.user_from, 'CP437')
-        store_msg.subject = unicode(self.subject, 'CP437')
+
+        # Character set from the CHRS kludge, CP437 when there is none.
+        charset = self.charset
+        decoder = get_decoder(charset)
+
+        # Header fields never hold a null, decode them in one call.
+        store_msg.recipient, store_msg.author, store_msg.subject = decode_text(
+            '\x00'.join((self.user_to, self.user_from, self.subject)), decoder).split(u'\x00')
 
         # Add Check here for Private Netmail messages, this functionality will be added lateron
 
-        # Convert from CP437 for high ascii, later on read CHRS kludge for origin character set
-        store_msg.body = unicode('\r'.join(self.message_lines).replace('\x9d', ''), 'CP437')
+        # 0x9d is dropped from CP437 text, in other character sets it is
+        # a character of its own or part of one.
+        body = self.body
+        if '\x9d' in body and get_codec_name(charset) == 'cp437':
+            body = body.replace('\x9d', '')
+        store_msg.body = decode_text(body, decoder)
 
         # If area is a normal public echo, default is public
         store_msg.tags.add(u''.join('public'))
@@ -500,7 +2103,7 @@ class Message(object):
 
         # Translate the area to the tag description.
         # eg.. AGN_GEN -> general
-        area_tag = cfg.get_tag(self.network, self.area)
+        area_tag = get_configuration().get_tag(self.network, self.area)
 
         # print 'Area Tag: ' + area_tag
         if area_tag is not None:
@@ -515,132 +2118,1323 @@ class Message(object):
         # 26 Feb 15  18:04:00
         date_object = datetime.datetime.strptime(self.date_time, '%d %b %y %H:%M:%S')
 
-        # do not save this message to network, we already received
-        # it from the network, set send_net=False
-        # Also avoid sending over X84 NET
-        store_msg.save(send_net=False, ctime=date_object)
-
-        print 'Msg Index after save: {0}'.format(store_msg.idx)
-
-        # Setup and store the fido kludge data
-        fido_msg = StoredFidoInfo(store_msg.idx)
-        fido_msg.status('received')
-        fido_msg.kludge_lines(self.kludge_lines)
-        fido_msg.save()
+        # Same as Msg.save(ctime=date_object), keep the packet date
+        # as both the creation and the stored time.
+        store_msg._ctime = store_msg._stime = date_object
+        metrics.observe('decode', time.time() - started)
+        return store_msg
+
+    def decode(self):
+        # Build the x84 Msg record now, toss workers decode messages
+        # so the writer only has to save them.
+        self.store_msg = self.build_msg()
+
+    @classmethod
+    def from_msg(cls, store_msg, kludges=()):
+        # Build a message for export from an x84 Msg record, the network
+        # and area come from its tags.  None if no tag maps to an area.
+        """
+        :type kludges: tuple
+        :rtype : Message
+        """
+        cfg = get_configuration()
+        network_area = cfg.find_network_area(store_msg.tags)
+        if network_area is None:
+            return None
+
+        message = cls()
+        message.network, message.area = network_area
+        node_address = cfg.get_node_address(message.network)
+        address = format_fido_address(node_address)
+
+        message.user_to = (store_msg.recipient or u'All').encode(
+            'CP437', 'replace')[:_max_username_length - 1]
+        message.user_from = (store_msg.author or u'').encode(
+            'CP437', 'replace')[:_max_username_length - 1]
+        message.subject = (store_msg.subject or u'').encode(
+            'CP437', 'replace')[:_max_subject_length - 1]
+        message.date_time = store_msg.ctime.strftime('%d %b %y  %H:%M:%S')
+
+        # Kludges saved with the message are kept, otherwise new ones.
+        message.kludge_lines = list(iter_kludges(kludges)) or [
+            ('MSGID:', '{address} {serial:08x}'.format(
+                address=address, serial=zlib.crc32('{0} {1}'.format(
+                    store_msg.idx, message.date_time)) & 0xffffffff)),
+            ('TID:', '{0} {1}'.format(PRODUCT_NAME, __version__)),
+            ('CHRS:', 'CP437 2'),
+        ]
+
+        body = store_msg.body.encode('CP437', 'replace')
+        message.tag_line = '--- {0} {1}'.format(PRODUCT_NAME, __version__)
+        message.body = '\r'.join((body.replace('\r\n', '\r').replace('\n', '\r'), message.tag_line))
+        message.origin_line = ' * Origin: {name} ({address})'.format(
+            name=cfg.bbs_name, address=address)
+
+        # SEEN-BY and PATH are added for each link as it is sent.
+        return message
+
+    def netmail_addresses(self):
+        # (origin, destination) addresses of a netmail, from the message
+        # header and the INTL, FMPT and TOPT kludges.  None for echomail.
+        """
+        :rtype : tuple
+        """
+        if self.area is not None or self.message_header is None:
+            return None
+
+        header = self.message_header
+        origin_zone = destination_zone = 0
+        if self.packet_header is not None:
+            origin_zone = self.packet_header.origin_zone
+            destination_zone = self.packet_header.destination_zone
+        origin = (origin_zone, header.origin_network, header.origin_node, 0)
+        destination = (destination_zone, header.destination_network, header.destination_node, 0)
+
+        # Zones come from 'INTL destination origin'
+        intl = find_kludge(self.kludge_lines, 'INTL')
+        intl = intl[0].split() if intl else []
+        if len(intl) == 2:
+            destination = (parse_fido_address(intl[0]) or destination)[:3] + (0,)
+            origin = (parse_fido_address(intl[1]) or origin)[:3] + (0,)
+
+        to_point = find_kludge(self.kludge_lines, 'TOPT')
+        if to_point and to_point[0].strip().isdigit():
+            destination = destination[:3] + (int(to_point[0]),)
+        from_point = find_kludge(self.kludge_lines, 'FMPT')
+        if from_point and from_point[0].strip().isdigit():
+            origin = origin[:3] + (int(from_point[0]),)
+        return origin, destination
+
+    def add_seen_by(self, net_nodes, address_key):
+        # Replace the SEEN-BY lines with the net_nodes set, and add this
+        # system to the end of the PATH unless it is there already.
+        """
+        :type net_nodes: set
+        :type address_key: tuple
+        """
+        self.seen_by = ['SEEN-BY: ' + line for line in format_net_nodes(sorted(net_nodes))]
+
+        path = parse_net_nodes(find_kludge(self.kludge_lines, 'PATH:', 'PATH'))
+        net_node = pack_net_node(address_key)
+        if not path or path[-1] != net_node:
+            path.append(net_node)
+        self.kludge_lines = [(key, value) for key, value in self.kludge_lines
+                             if key not in ('PATH:', 'PATH')]
+        self.kludge_lines.extend(('PATH:', line) for line in format_net_nodes(path))
+
+    def add_via(self, address_key):
+        # FTS-4009 Via line for netmail passing through this system,
+        # written after the text by serialize()
+        """
+        :type address_key: tuple
+        """
+        self.kludge_lines.append(('Via', '{address} @{stamp} {product} {version}'.format(
+            address=format_fido_address(address_key),
+            stamp=datetime.datetime.utcnow().strftime('%Y%m%d.%H%M%S.UTC'),
+            product=PRODUCT_NAME, version=__version__)))
+
+    def via_addresses(self):
+        # Addresses of the systems the netmail already passed through,
+        # the first address on each Via line, older tossers put their
+        # name first.
+        """
+        :rtype : list
+        """
+        addresses = []
+        for value in find_kludge(self.kludge_lines, 'Via'):
+            for word in value.split():
+                address_key = parse_fido_address(word)
+                if address_key is not None:
+                    addresses.append(address_key)
+                    break
+        return addresses
 
-        print 'Fido Index after save: {0}'.format(fido_msg.idx)
+    def packet_origin(self):
+        # (zone, net, node, point) of the system that sent us the packet,
+        # None for messages that didn't come in a packet.
+        """
+        :rtype : tuple
+        """
+        header = self.packet_header
+        if header is None:
+            return None
+        return header.origin_zone, header.origin_network, header.origin_node, header.origin_point
+
+    def origin_address(self):
+        # Address at the end of the origin line, eg. '(46:1/140.1)', None
+        # without an origin line or a valid address in it.
+        """
+        :rtype : tuple
+        """
+        if not self.origin_line or not self.origin_line.endswith(')'):
+            return None
+        return parse_fido_address(self.origin_line[self.origin_line.rfind('(') + 1:-1])
 
-        # get message index
-        # print 'Msg Index after save: {0}'.format(store_msg.idx)
-        # del store_msg
+    def import_messages(self):
+        # hook into x84 and write message to default database and
+        # keep separate database for fido specific fields.
+        with ImportBatch(batch_size=1) as import_batch:
+            import_batch.add(self)
 
     def add_kludge(self, line):
         # Separates Kludge Lines into An Array of Fields
         key, value = line.split(None, 1)
-        key = key[1:]
-
-        if key in self.kludge_lines:
-            assert isinstance(value, object)
-            self.kludge_lines[key].append(value)
-        else:
-            self.kludge_lines[key] = [value]
+        self.kludge_lines.append((key[1:], value))
 
     def parse_lines(self):
-        # Breaks up the message data into fields
-        stage = 1
-        message_body = []
-
-        # Setup Message Lines by breaking up raw data
-        self.message_lines = [x.strip('\n') for x in self.raw_data.split('\r')]
+        # Breaks up the message data into fields in a single pass over the
+        # CR separated raw data, each line is routed on its first byte.
+        # Runs of message text are sliced out of the raw data whole and
+        # joined once, the raw data is released afterwards.
+        raw_data = self.raw_data
+        self.raw_data = None
+        if not isinstance(raw_data, str):
+            # Text still held as a buffer over a mapped packet.
+            raw_data = str(raw_data)
 
-        for line in self.message_lines:
+        # Clean Message Text, remove any LF from the ends of lines!
+        if '\n' in raw_data:
+            raw_data = _line_feed_pattern.sub('\r', raw_data).strip('\n')
 
-            if len(line) == 0:
+        stage = 1
+        body_runs = []
+        run_start = None
+        run_end = None
+        raw_length = len(raw_data)
+        start = 0
+
+        while start <= raw_length:
+            end = raw_data.find('\r', start)
+            if end == -1:
+                end = raw_length
+
+            is_text = False
+            if start == end:
                 # Empty Lines are Newlines
-                message_body.append('')
+                is_text = True
 
             elif stage == 1:
                 # Start and Middle of Message Text
-                if line.startswith('AREA:'):
+                first = raw_data[start]
+                if first == '\x01':
+                    self.add_kludge(raw_data[start:end].strip())
+
+                elif first == 'A' and raw_data.startswith('AREA:', start, end):
                     # grab description config file and translate area name
-                    self.area = line.split(':')[1].lower()
-                    # print 'Area : ' + self.area
+                    area_end = raw_data.find(':', start + 5, end)
+                    self.area = raw_data[start + 5:area_end if area_end != -1 else end].lower()
 
                     # Add count for area
                     track_area(self.area)
 
-                elif line.startswith('\x01'):
-                    self.add_kludge(line.strip())
-
-                elif line.startswith('--- '):
+                elif first == '-' and raw_data.startswith('--- ', start, end):
                     # Tracking Tag Lines might be a little much!
-                    self.tag_line = line
                     # Leave Tag Line in message text
-                    message_body.append(line)
+                    self.tag_line = raw_data[start:end]
+                    is_text = True
 
-                elif 'Origin:' in line[2:10]:
+                elif raw_data.find('Origin:', start + 2, min(end, start + 10)) != -1:
                     # note some systems like Synchronet doesn't use * for origin prefix!!
-                    # need to put range in for this!! +2, 10
-                    self.origin_line = line
-                    # Leave Tag Line in message text
-                    message_body.append(line)
+                    # Leave Origin Line in message text
+                    self.origin_line = raw_data[start:end]
+                    is_text = True
                     stage = 2
 
                 # not official, just preference to remove this invalid data record.
-                elif line.startswith('\x1ASAUCE00'):
+                elif first == '\x1a' and raw_data.startswith('\x1aSAUCE00', start, end):
                     # skip bad characters or records in messages
-                    continue
+                    pass
 
-                elif line.endswith('\x04'):
+                elif raw_data[end - 1] == '\x04':
                     # Skip SAUCE record end lines!, shouldn't be posted.
-                    # bad characters
-                    continue
+                    pass
 
                 else:
-                    message_body.append(line)
+                    is_text = True
 
-            elif stage == 2:
+            else:
                 # Stage 2 After Origin Line Only
-                if line.startswith('\x01'):
-                    self.add_kludge(line)
+                if raw_data[start] == '\x01':
+                    self.add_kludge(raw_data[start:end])
+
+                elif raw_data.startswith('SEEN-BY:', start, end):
+                    self.seen_by.append(raw_data[start:end])
 
-                elif line.startswith('SEEN-BY:'):
-                    self.seen_by.append(line)
+                else:
+                    raise ValueError('Unexpected: %s' % raw_data[start:end])
 
+            if is_text:
+                if run_start is not None and run_end == start - 1:
+                    # Line follows straight on from the last text line.
+                    run_end = end
                 else:
-                    raise ValueError('Unexpected: %s' % line)
+                    if run_start is not None:
+                        body_runs.append(raw_data[run_start:run_end])
+                    run_start, run_end = start, end
+
+            start = end + 1
+
+        if run_start is not None:
+            body_runs.append(raw_data[run_start:run_end])
 
-        self.message_lines = message_body
+        self.body = '\r'.join(body_runs)
 
-        # Import messages to x84
-        self.import_messages()
+    @property
+    def charset(self):
+        # Character set named by the CHRS / CHARSET kludge, eg. 'CP437 2'
+        """
+        :rtype : str
+        """
+        for value in find_kludge(self.kludge_lines, 'CHRS:', 'CHARSET:', 'CHRS', 'CHARSET'):
+            if value.strip():
+                return value.split()[0]
+        return None
+
+    @property
+    def message_lines(self):
+        # Message text split into lines
+        """
+        :rtype : list
+        """
+        if self.body is None:
+            return None
+        return self.body.split('\r')
 
     def __str__(self):
         # Check this, should swap \r ? -MF
         """
         :rtype : str
         """
-        return '\n'.join(self.message_lines)
+        return self.body.replace('\r', '\n')
 
     def serialize(self):
-        # Build The Message for Writing out to Packet
+        # Build The Message for Writing out to Packet, returns the
+        # CR separated message text.
+        """
+        :rtype : str
+        """
         lines = []
+        path_lines = []
+        via_lines = []
 
         if self.area:
-            lines.append('AREA:%s' % self.area)
+            lines.append('AREA:%s' % self.area.upper())
+
+        # Setup Kludge Lines, PATH goes after the SEEN-BY lines and
+        # FTS-4009 Via lines end the message.
+        for key, value in self.kludge_lines:
+            kludge = '\x01{key} {val}'.format(key=key, val=value)
+            if key in ('PATH:', 'PATH'):
+                path_lines.append(kludge)
+            elif key == 'Via':
+                via_lines.append(kludge)
+            else:
+                lines.append(kludge)
+
+        # SEEN-BY, PATH and Via follow the text, no blank lines in between.
+        trailing = self.seen_by or path_lines or via_lines
+        lines.append(self.body.rstrip('\r') if trailing else self.body)
+
+        # Imported messages keep their origin line in the text.
+        if self.origin_line and self.origin_line not in self.body:
+            lines.append(self.origin_line)
 
-        # Setup Kludge Lines
-        for key, kludge_value in self.kludge_lines.items():
-            for value in kludge_value:
-                # Check if these needs \r at end of line!!
-                lines.append('\x01{key} {val}'.format(key=key, val=value))
+        lines.extend(self.seen_by)
+        lines.extend(path_lines)
+        lines.extend(via_lines)
+        lines.append('')
+        return '\r'.join(lines)
 
-        lines.extend(self.message_lines)
 
-        if self.origin_line:
-            lines.append(self.origin_line)
+_packet_header_size = struct.calcsize(_struct_fidonet_packet)
+_message_header_size = struct.calcsize(_struct_fidonet_message_header)
+
+
+class PacketReader(object):
+    # Walks a Type-2 packet held in a single buffer with one cursor,
+    # the packet is only loaded once instead of re-read per message.
+    def __init__(self, data, file_name=None):
+        """
+        :type data: str | mmap.mmap
+        :type file_name: str
+        """
+        self.data = data
+        self.file_name = file_name
+        self.offset = 0
+        self.packet_header = None
+        self.packet_format = None
+        self.origin_domain = None
+        self.destination_domain = None
+
+    @classmethod
+    def from_file(cls, file_path):
+        # Map the packet from disk read only, large packets are paged in
+        # as they are walked instead of being read into memory.
+        with open(file_path, 'rb') as fido_object:
+            try:
+                data = mmap.mmap(fido_object.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped.
+                data = fido_object.read()
+        return cls(data, os.path.basename(file_path))
+
+    def close(self):
+        # Unmap the packet, messages must have been parsed by now.
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = ''
+
+    def read_packet_header(self):
+        # Read the Packet Header with the layout of its format, None if the
+        # packet is to short or not a Type-2 format.
+        """
+        :rtype : FidonetPacketHeader
+        """
+        if len(self.data) < _packet_header_size:
+            return None
+
+        self.packet_format = find_packet_format(self.data)
+        if self.packet_format is None:
+            return None
+
+        self.packet_header, self.origin_domain, self.destination_domain = \
+            self.packet_format.build_header(self.packet_format.header_struct.unpack_from(self.data, 0))
+        self.offset = _packet_header_size
+        return self.packet_header
+
+    def read_field(self, max_length=None):
+        # Read text up to the null terminator, then move past it.
+        field, self.offset = read_cstring(self.data, self.offset, max_length)
+        return field
+
+    def messages(self):
+        # Generator, yields each message in the packet after the header.
+        """
+        :rtype : collections.Iterable[Message]
+        """
+        if self.packet_header is None and self.read_packet_header() is None:
+            return
+
+        while True:
+            remaining = len(self.data) - self.offset
+
+            # End of File can have (2) Bytes, catch this.
+            if remaining <= 2:
+                break
+            elif remaining < _message_header_size:
+                # Read was short!
+                log.error(u'unable to read message header: {0}'.format(self.file_name))
+                metrics.count('bad_messages')
+                break
+
+            # Read the Message Header
+            started = time.time()
+            fido_message_header = FidonetMessageHeader(
+                *struct.unpack_from(_struct_fidonet_message_header, self.data, self.offset))
+            self.offset += _message_header_size
+
+            current_message = Message()
+            current_message.attributes = decode_attributes(
+                fido_message_header.attributes_flags1, fido_message_header.attributes_flags2)
+            try:
+                current_message.date_time = self.read_field(_max_date_time_length)
+                current_message.user_to = self.read_field(_max_username_length)
+                current_message.user_from = self.read_field(_max_username_length)
+                current_message.subject = self.read_field(_max_subject_length)
+            except ValueError as error:
+                # Corrupt message header, skip the rest of this packet.
+                log.error(u'{0}: {1}'.format(self.file_name, error))
+                metrics.count('bad_messages')
+                break
+
+            # We now read the entire message up to null terminator
+            current_message.raw_data, self.offset = read_message_text(self.data, self.offset)
+
+            # Packet Headers will check for source / destination address
+            # mainly dupe checking
+            current_message.packet_header = self.packet_header
+            # Message Headers will be checked for Import/Export flags etc.
+            current_message.message_header = fido_message_header
+            metrics.observe('header_parse', time.time() - started)
+            yield current_message
+
+
+class PacketWriter(object):
+    # Streams a Type-2 packet straight to disk, the header first and
+    # then each message as it is added.
+    def __init__(self, file_path, origin, destination, password=''):
+        """
+        :type file_path: str
+        :type origin: tuple
+        :type destination: tuple
+        :type password: str
+        """
+        self.file_path = file_path
+        self.origin = origin
+        self.destination = destination
+        self.size = 0
+        self.message_count = 0
+        self.fido_object = open(file_path, 'wb')
+        self.write_packet_header(password)
+
+    def write(self, data):
+        self.fido_object.write(data)
+        self.size += len(data)
+
+    def write_packet_header(self, password):
+        # Packet months are 0 - 11.
+        now = datetime.datetime.now()
+        origin_zone, origin_network, origin_node, origin_point = self.origin
+        destination_zone, destination_network, destination_node, destination_point = self.destination
+        # Type-2+, a point sends with net 0xffff and its boss's net in aux_network.
+        aux_network = 0
+        if origin_point:
+            aux_network, origin_network = origin_network, 0xffff
+        fido_header = FidonetPacketHeader(
+            origin_node=origin_node, destination_node=destination_node,
+            year=now.year, month=now.month - 1, day=now.day,
+            hour=now.hour, minute=now.minute, second=now.second,
+            baud=0, packet_type=2,
+            origin_network=origin_network, destination_network=destination_network,
+            prod_code_low=0xfe, revision_major=int(__version__.split('.')[0]),
+            password=password[:8],
+            origin_zone=origin_zone, destination_zone=destination_zone,
+            aux_network=aux_network, capWordA=_capability_type2plus << 8, prod_code_hi=0,
+            revision_minor=0, capWordB=_capability_type2plus,
+            origin_zone2=origin_zone, destination_zone2=destination_zone,
+            origin_point=origin_point, destination_point=destination_point,
+            prod_data=0)
+        self.write(struct.pack(_struct_fidonet_packet, *fido_header))
+
+    def write_message(self, message):
+        # Message header, the null terminated header fields, then the text.
+        """
+        :type message: Message
+        """
+        attributes_flags1, attributes_flags2 = encode_attributes(message.attributes)
+        # Netmail keeps its own addresses, echomail is addressed to the link.
+        origin, destination = message.netmail_addresses() or (self.origin, self.destination)
+        fido_message_header = FidonetMessageHeader(
+            message_type=2,
+            origin_node=origin[2], destination_node=destination[2],
+            origin_network=origin[1], destination_network=destination[1],
+            attributes_flags1=attributes_flags1, attributes_flags2=attributes_flags2, cost=0)
+        self.write(struct.pack(_struct_fidonet_message_header, *fido_message_header))
+        self.write('\x00'.join((message.date_time, message.user_to, message.user_from,
+                                message.subject, message.serialize(), '')))
+        self.message_count += 1
+
+    def close(self):
+        # End of packet is marked with (2) null bytes.
+        self.write('\x00\x00')
+        self.fido_object.close()
+
+    def abort(self):
+        # Discard a partly written packet.
+        self.fido_object.close()
+        os.remove(self.file_path)
+
+
+# Last packet id handed out, ids only go up so packets added to the same
+# bundle in one run never share a name.
+_last_packet_id = 0
+
+
+def new_packet_path(folder):
+    # Unique packet file name, time based so packets sort in order written.
+    """
+    :rtype : str
+    """
+    global _last_packet_id
+    packet_id = max(int(time.time() * 100) & 0xffffffff, _last_packet_id + 1) & 0xffffffff
+    while True:
+        file_path = os.path.join(folder, '{0:08x}.pkt'.format(packet_id))
+        if not os.path.exists(file_path):
+            _last_packet_id = packet_id
+            return file_path
+        packet_id = (packet_id + 1) & 0xffffffff
+
+
+def bundle_file_name(origin, destination):
+    # ArcMail style bundle name, net/node differences and day of week,
+    # eg. 0000ff9c.mo0, packets for the same day are added to one bundle.
+    # Points get their own folder named for the boss node, BinkleyTerm
+    # style, eg. 0001008c.pnt/00000003.mo0.
+    """
+    :type origin: tuple
+    :type destination: tuple
+    :rtype : str
+    """
+    day = ('mo', 'tu', 'we', 'th', 'fr', 'sa', 'su')[datetime.date.today().weekday()]
+    if destination[3]:
+        return os.path.join(
+            '{net:04x}{node:04x}.pnt'.format(net=destination[1], node=destination[2]),
+            '0000{point:04x}.{day}0'.format(point=destination[3], day=day))
+    return '{net:04x}{node:04x}.{day}0'.format(
+        net=(origin[1] - destination[1]) & 0xffff,
+        node=(origin[2] - destination[2]) & 0xffff, day=day)
+
+
+def bundle_packet(packet_path, bundle_path):
+    # Add a closed packet to the bundle, then remove it from the pack folder.
+    """
+    :type packet_path: str
+    :type bundle_path: str
+    """
+    if not os.path.isdir(os.path.dirname(bundle_path)):
+        # Point folder
+        os.makedirs(os.path.dirname(bundle_path))
+
+    mode = 'a' if os.path.exists(bundle_path) else 'w'
+    with zipfile.ZipFile(bundle_path, mode, zipfile.ZIP_DEFLATED) as zip_obj:
+        zip_obj.write(packet_path, os.path.basename(packet_path))
+    os.remove(packet_path)
+
+
+def set_fido_status(indexes, flag):
+    # Change the status of stored fido records, one commit for all of them.
+    """
+    :type indexes: list
+    :type flag: str
+    """
+    from x84.bbs import DBProxy
+
+    with DBProxy(FIDO_DB, use_session=False) as db_index:
+        fido_records = {}
+        previous_status = {}
+        for idx in indexes:
+            fido_msg = db_index.get('%d' % (idx,))
+            if fido_msg is not None:
+                previous_status['%d' % (idx,)] = fido_msg.check_status
+                fido_msg.status(flag)
+                fido_records['%d' % (idx,)] = fido_msg
+        db_index.update(fido_records)
+
+    update_status_index(fido_records, previous_status)
+
+
+def find_pending_messages(network=None):
+    # Indexes of stored fido records waiting to be exported, oldest first.
+    """
+    :type network: str
+    :rtype : list
+    """
+    return find_fido_by_status('pending', network)
 
-        lines.extend(self.seen_by)
+
+def get_scan_cursors(db_sequence, networks, last_idx):
+    # Last msgbase index scanned per network, call with the sequence
+    # table locked.  A network scanned for the first time starts at the
+    # high water mark so old messages aren't exported.
+    """
+    :type networks: list
+    :type last_idx: int
+    :rtype : dict
+    """
+    cursors = {}
+    for network in networks:
+        cursor = db_sequence.get('scan_{0}'.format(network))
+        if cursor is None:
+            cursor = {'idx': last_idx, 'ctime': None}
+            db_sequence['scan_{0}'.format(network)] = cursor
+        cursors[network] = cursor
+    return cursors
+
+
+def scan_new_messages():
+    # Mark messages posted locally since the last scan as pending.  Only
+    # msgbase indexes past the oldest network cursor are visited, messages
+    # that were tossed in already have a fido record and are skipped.
+    # Everything up to the high water mark is visited, past it x84 adds
+    # new posts one after another so the scan stops at the first big gap.
+    """
+    :rtype : int
+    """
+    from x84.bbs import DBProxy
+    from x84.bbs.msgbase import MSGDB
+
+    cfg = get_configuration()
+
+    with DBProxy(FIDO_DB, table=FIDO_SEQUENCE_TABLE, use_session=False) as db_sequence:
+        high_idx = get_fido_high_water_mark(db_sequence) - 1
+        cursors = get_scan_cursors(db_sequence, cfg.network_list, high_idx)
+        if not cursors:
+            return 0
+
+        with DBProxy(MSGDB, use_session=False) as db_msg, \
+                DBProxy(FIDO_DB, use_session=False) as db_index:
+            fido_records, last_idx, last_ctime = scan_msgbase(
+                db_msg, db_index, cursors, high_idx)
+            db_index.update(fido_records)
+            update_status_index(fido_records, {})
+
+        # Every network has now been scanned up to the last message.
+        if last_idx is not None:
+            for network, cursor in cursors.items():
+                if cursor['idx'] < last_idx:
+                    db_sequence['scan_{0}'.format(network)] = {
+                        'idx': last_idx, 'ctime': last_ctime}
+            if last_idx > high_idx:
+                db_sequence['next_idx'] = last_idx + 1
+
+    if fido_records:
+        log.info(u'Scanned {0} new messages for export'.format(len(fido_records)))
+    metrics.count('messages_scanned', len(fido_records))
+    return len(fido_records)
+
+
+def scan_msgbase(db_msg, db_index, cursors, high_idx):
+    # Fido records for the network messages past the oldest cursor, with
+    # the index of the last message found and the ctime of the last local
+    # post.  Messages that were tossed in are skipped on their fido record
+    # alone, only local posts are loaded to find their area.
+    """
+    :type cursors: dict
+    :type high_idx: int
+    :rtype : tuple
+    """
+    cfg = get_configuration()
+    fido_records = {}
+    idx = min(cursor['idx'] for cursor in cursors.values())
+    last_idx, last_ctime = None, None
+    missing = 0
+    while idx < high_idx or missing < SCAN_GAP_LIMIT:
+        idx += 1
+        key = '%d' % (idx,)
+        if key in db_index:
+            missing = 0
+            last_idx = idx
+            continue
+
+        if key not in db_msg:
+            if idx > high_idx:
+                missing += 1
+            continue
+
+        missing = 0
+        store_msg = db_msg.get(key)
+        last_idx, last_ctime = idx, store_msg.ctime
+        network_area = cfg.find_network_area(store_msg.tags)
+        if network_area is None or idx <= cursors[network_area[0]]['idx']:
+            continue
+
+        fido_msg = StoredFidoInfo(idx)
+        fido_msg.status('pending')
+        fido_msg.network(network_area[0])
+        fido_records[key] = fido_msg
+    return fido_records, last_idx, last_ctime
+
+
+class PacketExporter(object):
+    # Streams one network's outbound messages for one link into packets
+    # in the pack folder.  Each packet is added to the link's bundle in the
+    # outbound folder when it reaches the size limit, and its messages are
+    # marked sent.
+    def __init__(self, network, destination=None):
+        """
+        :type network: str
+        :type destination: tuple
+        :rtype : None
+        """
+        cfg = get_configuration()
+        self.network = network
+        self.origin = cfg.get_node_address(network)
+        self.destination = destination or cfg.get_export_address(network)
+        self.size_limit = cfg.packet_size_limit
+        self.pack_folder = cfg.pack_folder
+        self.bundle_path = os.path.join(
+            cfg.outbound_folder, bundle_file_name(self.origin, self.destination))
+        self.packet = None
+        self.packet_indexes = []
+        self.total_exported = 0
+
+    def add(self, message, idx=None):
+        # Write the message to the open packet, rolls over when full.
+        # Messages passing through have no index to mark sent.
+        """
+        :type message: Message
+        :type idx: int
+        """
+        if self.packet is None:
+            self.packet = PacketWriter(
+                new_packet_path(self.pack_folder), self.origin, self.destination)
+
+        self.packet.write_message(message)
+        if idx is not None:
+            self.packet_indexes.append(idx)
+        if self.packet.size >= self.size_limit:
+            self.close()
+
+    def close(self):
+        # Finish the open packet and move it into the bundle.
+        if self.packet is None:
+            return
+
+        self.packet.close()
+        bundle_packet(self.packet.file_path, self.bundle_path)
+        if self.packet_indexes:
+            set_fido_status(self.packet_indexes, 'sent')
+
+        log.info(u'Exported {0} messages: {1} {2} -> {3}'.format(
+            self.packet.message_count, self.network,
+            format_fido_address(self.destination), os.path.basename(self.bundle_path)))
+        metrics.count('packets_written')
+        metrics.count('messages_exported', self.packet.message_count)
+        self.total_exported += self.packet.message_count
+        self.packet = None
+        self.packet_indexes = []
+
+    def abort(self):
+        # Drop the open packet, its messages stay pending.
+        if self.packet is not None:
+            self.packet.abort()
+            self.packet = None
+            self.packet_indexes = []
+
+
+class OutboundRouter(object):
+    # Hands outbound messages to one PacketExporter per (network, next hop),
+    # so everything for the same link is packed together in one run.
+    def __init__(self):
+        self.exporters = {}
+        self.bad_packet = None
+
+    def exporter(self, network, destination=None):
+        # Exporter for the link, the network's export_address by default.
+        """
+        :type network: str
+        :type destination: tuple
+        :rtype : PacketExporter
+        """
+        if destination is None:
+            destination = get_configuration().get_export_address(network)
+
+        exporter = self.exporters.get((network, destination))
+        if exporter is None:
+            exporter = self.exporters[(network, destination)] = PacketExporter(network, destination)
+        return exporter
+
+    def route_netmail(self, message):
+        # Pack netmail that isn't addressed to this system for its next
+        # hop.  False if it is echomail or ours to import.
+        """
+        :type message: Message
+        :rtype : bool
+        """
+        addresses = message.netmail_addresses()
+        if addresses is None:
+            return False
+
+        cfg = get_configuration()
+        destination = addresses[1]
+        if cfg.find_network(destination) is not None:
+            return False
+
+        next_hop = cfg.find_next_hop(message.network, destination)
+        if next_hop is None:
+            return False
+
+        # Don't send it back where it came from, or round again if it
+        # has been through here before.
+        sender = message.packet_origin()
+        looped = next_hop == sender or any(
+            cfg.find_network(address_key) is not None for address_key in message.via_addresses())
+        if looped:
+            log.error(u'Netmail routing loop, {0} -> {1} via {2} from {3}'.format(
+                format_fido_address(addresses[0]), format_fido_address(destination),
+                format_fido_address(next_hop), format_fido_address(sender) if sender else 'local'))
+            metrics.count('netmail_looped')
+            self.quarantine(message, sender or next_hop)
+            return True
+
+        message.add_via(cfg.get_node_address(message.network))
+        self.exporter(message.network, next_hop).add(message)
+        metrics.count('netmail_routed')
+        return True
+
+    def forward_echomail(self, message, idx=None):
+        # Send echomail to each of the area's links that didn't send it
+        # to us.  Nodes are skipped when they are in the SEEN-BY, points
+        # aren't listed there and only miss out on their own messages.
+        # Returns the links sent to.
+        """
+        :type message: Message
+        :type idx: int
+        :rtype : int
+        """
+        if message.area is None:
+            return 0
+
+        cfg = get_configuration()
+        links = cfg.get_area_links(message.network, message.area)
+        seen_by = set(parse_net_nodes(message.seen_by))
+        sender = message.packet_origin()
+        if sender is not None:
+            seen_by.add(pack_net_node(sender))
+        origin = message.origin_address()
+
+        targets = [address_key for address_key in sorted(links)
+                   if address_key != sender and address_key != origin and
+                   (address_key[3] or pack_net_node(address_key) not in seen_by)]
+        if not targets:
+            return 0
+
+        node_address = cfg.get_node_address(message.network)
+        seen_by.update(pack_net_node(address_key) for address_key in targets
+                       if not address_key[3])
+        seen_by.add(pack_net_node(node_address))
+        message.add_seen_by(seen_by, node_address)
+
+        for address_key in targets:
+            self.exporter(message.network, address_key).add(message, idx)
+        metrics.count('echomail_forwarded', len(targets))
+        return len(targets)
+
+    def quarantine(self, message, sender):
+        # Keep netmail that can't be routed in a packet in the bad folder
+        # for the sysop, it is dropped if there is no bad folder.
+        """
+        :type message: Message
+        :type sender: tuple
+        """
+        cfg = get_configuration()
+        if cfg.bad_folder is None:
+            return
+
+        if self.bad_packet is None:
+            self.bad_packet = PacketWriter(
+                new_packet_path(cfg.bad_folder), sender, cfg.get_node_address(message.network))
+        self.bad_packet.write_message(message)
+
+    def close(self):
+        for exporter in self.exporters.values():
+            exporter.close()
+        if self.bad_packet is not None:
+            self.bad_packet.close()
+            self.bad_packet = None
+
+    def abort(self):
+        for exporter in self.exporters.values():
+            exporter.abort()
+        if self.bad_packet is not None:
+            self.bad_packet.abort()
+            self.bad_packet = None
+
+
+# Nodelist line keywords to the status kept in the compiled index,
+# normal nodes have an empty keyword.
+_nodelist_status = ('', 'zone', 'region', 'host', 'hub', 'pvt', 'hold', 'down', 'point')
+_nodelist_status_codes = dict((status, code) for code, status in enumerate(_nodelist_status))
+
+# Compiled nodelist, a header then fixed size node records sorted by
+# address, sysop name records sorted by name and the text they point to.
+_nodelist_magic = 'PPNL'
+_nodelist_version = 1
+_struct_nodelist_header = '<4sHHIII'
+_nodelist_header_size = struct.calcsize(_struct_nodelist_header)
+# zone, net, node, point, status, hub node, offset of the nodelist fields.
+_struct_nodelist_node = '<HHHHBxHI'
+_nodelist_node_size = struct.calcsize(_struct_nodelist_node)
+_struct_nodelist_address = '<HHHH'
+# offset of the lower case sysop name, node record number.
+_struct_nodelist_name = '<II'
+_nodelist_name_size = struct.calcsize(_struct_nodelist_name)
+
+NodelistEntry = collections.namedtuple(
+    'NodelistEntry', ['address', 'status', 'hub', 'name', 'location', 'sysop',
+                      'phone', 'baud', 'flags'])
+
+
+def read_nodelist_lines(file_path):
+    # Nodelist lines without line endings or the end of file marker.
+    """
+    :type file_path: str
+    :rtype : list
+    """
+    with open(file_path, 'rb') as nodelist_object:
+        return [line.rstrip('\r\n') for line in nodelist_object.read().split('\n')
+                if line.rstrip('\r\n\x1a')]
+
+
+def apply_nodediff(nodelist_lines, nodediff_lines):
+    # FTS-5000 nodediff, the first line has to match the first line of
+    # the nodelist it applies to.  Then 'Ann' adds the next nn lines of
+    # the diff, 'Cnn' copies and 'Dnn' deletes the next nn nodelist lines.
+    """
+    :type nodelist_lines: list
+    :type nodediff_lines: list
+    :rtype : list
+    """
+    if not nodediff_lines or not nodelist_lines or nodediff_lines[0] != nodelist_lines[0]:
+        raise ValueError('nodediff does not apply to this nodelist')
+
+    new_lines = []
+    position = 0
+    diff_lines = iter(nodediff_lines[1:])
+    for command in diff_lines:
+        if not command or command[0] not in 'ACD' or not command[1:].isdigit():
+            raise ValueError('Unexpected nodediff command: {0}'.format(command))
+
+        count = int(command[1:])
+        if command[0] == 'A':
+            for _ in xrange(count):
+                new_lines.append(next(diff_lines))
+        elif command[0] == 'C':
+            new_lines.extend(nodelist_lines[position:position + count])
+            position += count
+        else:
+            position += count
+    return new_lines
+
+
+def parse_nodelist(nodelist_lines, default_zone=None):
+    # Generator, yields (address, status, hub node, fields) for each node
+    # and point, fields is the rest of the line after the node number.
+    """
+    :type nodelist_lines: list
+    :type default_zone: int
+    :rtype : collections.Iterable[tuple]
+    """
+    zone = default_zone
+    net = None
+    hub = 0
+    boss = None
+    for line in nodelist_lines:
+        if line.startswith(';'):
+            # Comments
+            continue
+
+        parts = line.split(',', 2)
+        if len(parts) < 3 or not parts[1].isdigit():
+            if parts[0].lower() == 'boss' and len(parts) > 1:
+                # Pointlist, points that follow belong to this node.
+                boss = parse_fido_address(parts[1])
+                continue
+            log.warning(u'Unexpected nodelist line: {0}'.format(line))
+            continue
+
+        keyword, number, fields = parts[0].lower(), int(parts[1]), parts[2]
+        if keyword not in _nodelist_status_codes:
+            log.warning(u'Unexpected nodelist keyword: {0}'.format(line))
+            continue
+
+        if keyword == 'point':
+            if boss is None:
+                continue
+            yield boss[:3] + (number,), keyword, hub, fields
+            continue
+
+        boss = None
+        if keyword == 'zone':
+            zone = net = number
+            hub = 0
+            address = (zone, net, 0, 0)
+        elif keyword in ('region', 'host'):
+            net = number
+            hub = 0
+            address = (zone, net, 0, 0)
+        elif zone is None or net is None:
+            # Nodes listed before any zone or net.
+            continue
+        else:
+            if keyword == 'hub':
+                hub = number
+            address = (zone, net, number, 0)
+        yield address, keyword, hub, fields
+
+
+def compile_nodelist(nodelist_lines, index_path, default_zone=None):
+    # Compile the nodelist into the binary index looked up by NodelistIndex,
+    # written to a temporary file first so open indexes are never changed.
+    """
+    :type nodelist_lines: list
+    :type index_path: str
+    :type default_zone: int
+    :rtype : int
+    """
+    nodes = {}
+    for address, status, hub, fields in parse_nodelist(nodelist_lines, default_zone):
+        # The first listing of an address wins.
+        nodes.setdefault(address, (status, hub, fields))
+
+    strings = []
+    string_offset = [0]
+
+    def add_string(text):
+        offset = string_offset[0]
+        strings.append(text + '\x00')
+        string_offset[0] += len(text) + 1
+        return offset
+
+    node_records = []
+    names = []
+    for record_number, address in enumerate(sorted(nodes)):
+        status, hub, fields = nodes[address]
+        node_records.append(struct.pack(
+            _struct_nodelist_node, address[0], address[1], address[2], address[3],
+            _nodelist_status_codes[status], hub, add_string(fields)))
+        sysop = fields.split(',', 3)[2:3]
+        if sysop:
+            names.append((sysop[0].replace('_', ' ').lower(), record_number))
+
+    name_records = [struct.pack(_struct_nodelist_name, add_string(name), record_number)
+                    for name, record_number in sorted(names)]
+
+    names_offset = _nodelist_header_size + _nodelist_node_size * len(node_records)
+    strings_offset = names_offset + _nodelist_name_size * len(name_records)
+    header = struct.pack(_struct_nodelist_header, _nodelist_magic, _nodelist_version, 0,
+                         len(node_records), len(name_records), strings_offset)
+
+    temp_path = index_path + '.tmp'
+    with open(temp_path, 'wb') as index_object:
+        index_object.write(header)
+        index_object.write(''.join(node_records))
+        index_object.write(''.join(name_records))
+        index_object.write(''.join(strings))
+    if os.path.exists(index_path) and os.name == 'nt':
+        os.remove(index_path)
+    os.rename(temp_path, index_path)
+    return len(node_records)
+
+
+class _NodelistKeys(object):
+    # Sequence of the node addresses in a compiled nodelist, for bisect.
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.node_count
+
+    def __getitem__(self, record_number):
+        return struct.unpack_from(
+            _struct_nodelist_address, self.index.data,
+            _nodelist_header_size + record_number * _nodelist_node_size)
+
+
+class _NodelistNames(object):
+    # Sequence of the sysop names in a compiled nodelist, for bisect.
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return self.index.name_count
+
+    def __getitem__(self, name_number):
+        return self.index.read_name(name_number)[0]
+
+
+class NodelistIndex(object):
+    # Read only lookups on a compiled nodelist.  The index is mapped, so
+    # each lookup is a binary search over the fixed size records and
+    # only the entry found is decoded.
+    def __init__(self, index_path):
+        """
+        :type index_path: str
+        """
+        self.index_path = index_path
+        with open(index_path, 'rb') as index_object:
+            self.data = mmap.mmap(index_object.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, _, self.node_count, self.name_count, self.strings_offset = \
+            struct.unpack_from(_struct_nodelist_header, self.data, 0)
+        if magic != _nodelist_magic or version != _nodelist_version:
+            self.data.close()
+            raise ValueError('Not a compiled nodelist: {0}'.format(index_path))
+
+        self.names_offset = _nodelist_header_size + self.node_count * _nodelist_node_size
+        self.keys = _NodelistKeys(self)
+        self.names = _NodelistNames(self)
+
+    def close(self):
+        self.data.close()
+
+    def read_string(self, offset):
+        return read_cstring(self.data, self.strings_offset + offset)[0]
+
+    def read_name(self, name_number):
+        # (sysop name, node record number)
+        name_offset, record_number = struct.unpack_from(
+            _struct_nodelist_name, self.data, self.names_offset + name_number * _nodelist_name_size)
+        return self.read_string(name_offset), record_number
+
+    def read_entry(self, record_number):
+        # Decode the node record into a NodelistEntry
+        """
+        :rtype : NodelistEntry
+        """
+        zone, net, node, point, status, hub, fields_offset = struct.unpack_from(
+            _struct_nodelist_node, self.data, _nodelist_header_size + record_number * _nodelist_node_size)
+        fields = self.read_string(fields_offset).split(',', 5)
+        fields.extend([''] * (6 - len(fields)))
+        name, location, sysop, phone, baud, flags = fields
+        return NodelistEntry(
+            address=(zone, net, node, point), status=_nodelist_status[status],
+            hub=(zone, net, hub, 0) if hub else None,
+            name=name.replace('_', ' '), location=location.replace('_', ' '),
+            sysop=sysop.replace('_', ' '), phone=phone, baud=baud,
+            flags=tuple(flag for flag in flags.split(',') if flag))
+
+    def find_record(self, address_key):
+        # Node record number for the address, None if it isn't listed.
+        """
+        :type address_key: tuple
+        :rtype : int
+        """
+        record_number = bisect.bisect_left(self.keys, address_key)
+        if record_number < self.node_count and self.keys[record_number] == address_key:
+            return record_number
+        return None
+
+    def find_node(self, address_key):
+        # (zone, net, node, point) to its NodelistEntry, None if unlisted
+        """
+        :type address_key: tuple
+        :rtype : NodelistEntry
+        """
+        record_number = self.find_record(address_key)
+        if record_number is None:
+            return None
+        return self.read_entry(record_number)
+
+    def find_sysop(self, sysop):
+        # Every NodelistEntry run by the sysop, names are not case sensitive.
+        """
+        :type sysop: str
+        :rtype : list
+        """
+        sysop = sysop.replace('_', ' ').lower()
+        entries = []
+        name_number = bisect.bisect_left(self.names, sysop)
+        while name_number < self.name_count:
+            name, record_number = self.read_name(name_number)
+            if name != sysop:
+                break
+            entries.append(self.read_entry(record_number))
+            name_number += 1
+        return entries
+
+    def find_route(self, address_key):
+        # Address mail for the node is routed through, points through their
+        # boss node, nodes through their hub or net host.  Unlisted nets go
+        # through the zone.  None if the zone isn't listed either.
+        """
+        :type address_key: tuple
+        :rtype : tuple
+        """
+        zone, net, node, point = address_key
+        if point:
+            if self.find_record((zone, net, node, 0)) is not None:
+                return zone, net, node, 0
+
+        entry = self.find_node((zone, net, node, 0))
+        if entry is not None and entry.hub is not None and entry.hub != entry.address:
+            return entry.hub
+        for route_key in ((zone, net, 0, 0), (zone, zone, 0, 0)):
+            if self.find_record(route_key) is not None:
+                return route_key
+        return None
+
+
+def find_nodelist_file(base_path):
+    # Newest of the daily nodelist files, base_path.nnn where nnn is the
+    # day of the year, or base_path itself.  None if there aren't any.
+    """
+    :type base_path: str
+    :rtype : str
+    """
+    file_paths = [file_path for file_path in glob.glob(base_path + '.[0-9][0-9][0-9]')]
+    if not file_paths:
+        return base_path if os.path.isfile(base_path) else None
+    # Day numbers start again each year, go by the file times instead.
+    return max(file_paths, key=os.path.getmtime)
+
+
+def build_nodelist(nodelist_path, nodediff_base=None):
+    # Nodelist lines with any newer nodediffs applied in order.
+    """
+    :type nodelist_path: str
+    :type nodediff_base: str
+    :rtype : list
+    """
+    nodelist_lines = read_nodelist_lines(nodelist_path)
+    if not nodediff_base:
+        return nodelist_lines
+
+    nodelist_time = os.path.getmtime(nodelist_path)
+    nodediff_paths = sorted((os.path.getmtime(file_path), file_path)
+                            for file_path in glob.glob(nodediff_base + '.[0-9][0-9][0-9]'))
+    for nodediff_time, nodediff_path in nodediff_paths:
+        if nodediff_time <= nodelist_time:
+            continue
+        try:
+            nodelist_lines = apply_nodediff(nodelist_lines, read_nodelist_lines(nodediff_path))
+        except (ValueError, StopIteration) as error:
+            log.warning(u'nodediff skipped: {0}, {1}'.format(nodediff_path, error))
+    return nodelist_lines
+
+
+# Opened NodelistIndex per network.
+_nodelists = {}
+
+
+def get_nodelist(network_name):
+    # Compiled nodelist for the network, None if it has none.
+    """
+    :type network_name: str
+    :rtype : NodelistIndex
+    """
+    if network_name not in _nodelists:
+        index_path = get_configuration().get_nodelist_index(network_name)
+        nodelist = None
+        if index_path is not None and os.path.exists(index_path):
+            try:
+                nodelist = NodelistIndex(index_path)
+            except (ValueError, struct.error) as error:
+                log.error(u'{0}: {1}'.format(index_path, error))
+        _nodelists[network_name] = nodelist
+    return _nodelists[network_name]
+
+
+def update_nodelists():
+    # Compile the nodelist of each network when its index is missing or
+    # older than the newest nodelist or nodediff.
+    """
+    :rtype : int
+    """
+    cfg = get_configuration()
+    compiled = 0
+    for network_name in cfg.network_list:
+        index_path = cfg.get_nodelist_index(network_name)
+        if index_path is None:
+            continue
+
+        nodelist_path = find_nodelist_file(cfg.get_nodelist_path(network_name))
+        if nodelist_path is None:
+            log.error(u'no nodelist found: {0}'.format(cfg.get_nodelist_path(network_name)))
+            continue
+
+        nodediff_base = cfg.get_nodediff_path(network_name)
+        source_paths = [nodelist_path]
+        if nodediff_base:
+            source_paths.extend(glob.glob(nodediff_base + '.[0-9][0-9][0-9]'))
+        if os.path.exists(index_path) and \
+                os.path.getmtime(index_path) >= max(map(os.path.getmtime, source_paths)):
+            continue
+
+        node_address = cfg.get_node_address(network_name)
+        node_count = compile_nodelist(build_nodelist(nodelist_path, nodediff_base), index_path,
+                                      default_zone=node_address[0] if node_address else None)
+        log.info(u'Compiled nodelist: {0}, {1} nodes'.format(nodelist_path, node_count))
+
+        # Reopen on the next lookup.
+        nodelist = _nodelists.pop(network_name, None)
+        if nodelist is not None:
+            nodelist.close()
+        compiled += 1
+
+    if compiled:
+        cfg.clear_route_cache()
+    return compiled
 
 
 class ParsePackets(object):
@@ -653,6 +3447,7 @@ class ParsePackets(object):
         :type packet_processing: str
         """
         _packet_processing = packet_processing
+        metrics.reset()
         if _packet_processing in 'read':
             process_inbound()
             print_area_count()
@@ -660,6 +3455,8 @@ class ParsePackets(object):
         elif _packet_processing in 'write':
             process_outbound()
 
+        write_metrics()
+
 
 def process_outbound():
     # Scan for New Messages ready for sending out
@@ -667,21 +3464,38 @@ def process_outbound():
     :rtype : none
     """
     from x84.bbs import DBProxy
+    from x84.bbs.msgbase import get_msg
+
+    cfg = get_configuration()
+
+    # Make sure the Outbound and Pack directories are valid
+    assert os.path.isdir(cfg.outbound_folder)
+    assert os.path.isdir(cfg.pack_folder)
+
+    # Recompile any nodelists updated since the last scan.
+    update_nodelists()
 
-    print 'process_outbound()'
+    # Queue up anything posted since the last scan.
+    scan_new_messages()
 
-    # Status is a list of all Message Keys
-    status = set(int(key) for key in DBProxy(FIDO_DB).keys())
-    print status
+    # Messages are loaded and written one at a time, one exporter per link.
+    router = OutboundRouter()
+    try:
+        for idx in find_pending_messages():
+            with DBProxy(FIDO_DB, use_session=False) as db_index:
+                fido_msg = db_index.get('%d' % (idx,))
 
-    # Scan message Status.
-    with DBProxy(FIDO_DB) as fido_db:
-        for key, values in fido_db.items():
-            # print key, values.check_status
-            # print key, values.check_kludge
-            for k, v in values.check_kludge.items():
-                # Grabs Key values of all Kludges
-                print k, v
+            message = Message.from_msg(get_msg(idx), fido_msg.check_kludge)
+            if message is None:
+                log.error(u'no network area for message: {0}'.format(idx))
+                continue
+
+            router.forward_echomail(message, idx)
+
+        router.close()
+    except:
+        router.abort()
+        raise
 
     # Work out kludge lines now.
     # Example modern msg id.
@@ -696,191 +3510,407 @@ def process_outbound():
     '''
 
 
-def process_inbound():
-    # Process all packets waiting in the inbound_folder
+def check_packet(packet_reader):
+    # Validate the packet header, (network, packet address) when the
+    # packet is for this system, otherwise None.
     """
-    :rtype : none
+    :type packet_reader: PacketReader
+    :rtype : tuple
     """
+    file_name = packet_reader.file_name
+    fido_header = packet_reader.read_packet_header()
+
+    if fido_header is None:
+        # move to next packet
+        if len(packet_reader.data) < _packet_header_size:
+            log.error(u'unable to read packet header: {0}'.format(file_name))
+        else:
+            log.error(u'fido packet not Type-2: {0}'.format(file_name))
+        metrics.count('bad_packets')
+        return None
+
+    # Validate packet is addressed to this system, 4D / 3D address with
+    # the 5D domain when the packet has one.
+    address_key = (fido_header.destination_zone, fido_header.destination_network,
+                   fido_header.destination_node, fido_header.destination_point)
+    packet_address = format_fido_address(address_key)
+    if packet_reader.destination_domain:
+        packet_address = '{0}@{1}'.format(packet_address, packet_reader.destination_domain)
+
+    # If Address is not in our network, skip to next packet.
+    current_network = get_configuration().find_network(address_key)
+    if current_network is None:
+        log.error(u'packet not addressed to your node: {packet}, '
+                  .format(packet=packet_address))
+        metrics.count('bad_packets')
+        return None
+
+    log.debug(u'Type-{type} Packet Received for: {network} -> {packet}'
+              .format(type=packet_reader.packet_format.name, network=current_network,
+                      packet=packet_address))
+
+    nodelist = get_nodelist(current_network)
+    if nodelist is not None:
+        origin_key = (fido_header.origin_zone, fido_header.origin_network,
+                      fido_header.origin_node, fido_header.origin_point)
+        # Points are checked by their boss node, pointlists are optional.
+        if nodelist.find_record(origin_key[:3] + (0,)) is None:
+            log.warning(u'packet from unlisted node: {0}'.format(format_fido_address(origin_key)))
+            metrics.count('unlisted_packets')
+    metrics.count('packets')
+    return current_network, packet_address
+
+
+def parse_packet(packet_reader):
+    # Generator, validate the packet header, then parse and yield each message.
+    """
+    :type packet_reader: PacketReader
+    :rtype : collections.Iterable[Message]
+    """
+    packet = check_packet(packet_reader)
+    if packet is None:
+        return
+
+    current_network, packet_address = packet
     message_count = 0
+    for current_message in packet_reader.messages():
+        # Populated the Current Network and Address.
+        current_message.network = current_network
+        current_message.packet_address = packet_address
+
+        # First Parse the Raw Data into Message Lines and
+        # break out Kludge lines from text
+        started = time.time()
+        current_message.parse_lines()
+        metrics.observe('body_parse', time.time() - started)
+        message_count += 1
+        yield current_message
+
+    metrics.count('messages_parsed', message_count)
+    log.debug(u'Messages This Packet -> {0}: {1}'.format(message_count, packet_reader.file_name))
+
+
+def toss_packet(packet_reader, import_batch, router=None):
+    # Parse each message in the packet and queue it for import to x84,
+    # netmail for other systems is passed on through the router.
+    """
+    :type packet_reader: PacketReader
+    :type import_batch: ImportBatch
+    :type router: OutboundRouter
+    :rtype : int
+    """
+    message_count = 0
+    for current_message in parse_packet(packet_reader):
+        if router is None or not router.route_netmail(current_message):
+            import_batch.add(current_message)
+        message_count += 1
+    return message_count
 
-    for file_path_zip in glob.glob(os.path.join(cfg.inbound_folder, u'*.*')):
-        # Uncompress packet bundles, then loop to read packet/message headers/messages
-        try:
-            # unzip a clean bundle
-            with zipfile.ZipFile(file_path_zip) as zip_obj:
-                print u'Uncompress Bundle: ' + os.path.basename(file_path_zip)
-                zip_obj.extractall(cfg.unpack_folder)
 
-            # Loop and process all packets
-            for file_name in os.listdir(cfg.unpack_folder):
-                # Parse Each Packet for the Header first.
-                print u'Parsing Mail Packet: ' + file_name
+# Uncompressed packets can be left in the inbound folder as well as bundles.
+_packet_extension = '.pkt'
 
-                # Open then Parse Each Packet
-                fido_object = open(os.path.join(cfg.unpack_folder, file_name), 'rb')
 
-                try:
-                    # make Sure we don't read past the end of the file!
-                    packet_header_read = fido_object.read()[:58]
-                except EOFError:
-                    # move to next packet if were at the end.
-                    break
+def read_bundle(file_path_zip, stream=None):
+    # Generator, yields a PacketReader for each packet in the bundle.
+    # With stream_bundles each packet is read straight out of the zip,
+    # otherwise the bundle is extracted to the unpack_folder first.
+    """
+    :type file_path_zip: str
+    :type stream: bool
+    :rtype : collections.Iterable[PacketReader]
+    """
+    cfg = get_configuration()
+    if stream is None:
+        stream = cfg.stream_bundles
+
+    if file_path_zip.lower().endswith(_packet_extension):
+        # Uncompressed packet left in the inbound folder.
+        for packet_reader in read_packet_file(file_path_zip):
+            yield packet_reader
+        return
+
+    metrics.count('bundles')
+    with zipfile.ZipFile(file_path_zip) as zip_obj:
+        log.debug(u'Uncompress Bundle: ' + os.path.basename(file_path_zip))
+        if stream:
+            for zip_info in zip_obj.infolist():
+                if zip_info.filename.endswith('/'):
+                    # Skip directory entries
+                    continue
 
-                if not packet_header_read:
-                    # move to next packet, log error here
-                    print u'Error: unable to read packet header: ' + file_name
-                    break
+                started = time.time()
+                with zip_obj.open(zip_info) as packet_object:
+                    packet_data = packet_object.read()
+                metrics.observe('unzip', time.time() - started)
+                metrics.count('packet_bytes', len(packet_data))
+                yield PacketReader(packet_data, os.path.basename(zip_info.filename))
+            return
 
-                # Make sure we have correct size! Otherwise were done.
-                # print 'packet_header_read len: ' + str(len(packet_header_read))
-                if len(packet_header_read) < 58:
-                    # End of File can have (2) Bytes, catch this.
-                    break
+        # unzip a clean bundle
+        started = time.time()
+        zip_obj.extractall(cfg.unpack_folder)
+        metrics.observe('unzip', time.time() - started)
 
-                # Read the Packet Header
-                fido_header = FidonetPacketHeader(
-                    *struct.unpack(_struct_fidonet_packet, packet_header_read))
+    for file_name in os.listdir(cfg.unpack_folder):
+        # Map each packet once, then walk it with a single cursor.
+        for packet_reader in read_packet_file(os.path.join(cfg.unpack_folder, file_name)):
+            yield packet_reader
 
-                # Test the packet header
-                if fido_header.packet_type != 2:
-                    print u'Error: fido packet not Type-2: ' + file_name
-                    break
 
-                # Validate packet is addressed to this system
-                # Add 5D addresses? have @domain like @agoranet
-                if fido_header.destination_point != 0:
-                    # 4D address
-                    packet_address = '{zone}:{net}/{node}.{point}'.format(
-                        zone=fido_header.destination_zone, net=fido_header.destination_network,
-                        node=fido_header.destination_node, point=fido_header.destination_point)
-                else:
-                    # 3D Address no point.
-                    packet_address = '{zone}:{net}/{node}'.format(
-                        zone=fido_header.destination_zone, net=fido_header.destination_network,
-                        node=fido_header.destination_node)
-
-                # If Address is not in our network, skip to next packet.
-                current_network = cfg.check_network_address(packet_address)
-                if current_network is None:
-                    print u'Error: packet not addressed to your node: {packet}, '\
-                        .format(packet=packet_address)
-                    break
+def read_packet_file(file_path):
+    # Generator, yields a PacketReader over the mapped packet file and
+    # unmaps it once the packet has been tossed.
+    """
+    :type file_path: str
+    :rtype : collections.Iterable[PacketReader]
+    """
+    packet_reader = PacketReader.from_file(file_path)
+    try:
+        metrics.count('packet_bytes', len(packet_reader.data))
+        yield packet_reader
+    finally:
+        packet_reader.close()
+
+
+def bundle_chunks(file_path_zip, chunk_size):
+    # Generator, the messages of a bundle in lists of up to chunk_size.
+    # Packets are read and split into messages here, their text is parsed
+    # and decoded by the toss workers.
+    """
+    :type file_path_zip: str
+    :type chunk_size: int
+    :rtype : collections.Iterable[list]
+    """
+    for packet_reader in read_bundle(file_path_zip, stream=True):
+        log.debug(u'Parsing Mail Packet: ' + packet_reader.file_name)
+        packet = check_packet(packet_reader)
+        if packet is None:
+            continue
+
+        chunk = []
+        for current_message in packet_reader.messages():
+            current_message.network, current_message.packet_address = packet
+            # Copied out of the packet to be sent to a worker.
+            current_message.raw_data = str(current_message.raw_data)
+            chunk.append(current_message)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def bundle_jobs(bundles, chunk_size):
+    # Generator, toss worker jobs as (bundle, messages, error).  Each bundle
+    # ends with a (bundle, None, error) job, the error is the traceback when
+    # the bundle couldn't be read, otherwise None.
+    """
+    :type bundles: list
+    :type chunk_size: int
+    :rtype : collections.Iterable[tuple]
+    """
+    for file_path_zip in bundles:
+        error = None
+        try:
+            for chunk in bundle_chunks(file_path_zip, chunk_size):
+                yield file_path_zip, chunk, None
+        except Exception:
+            error = traceback.format_exc()
+        yield file_path_zip, None, error
 
-                print u'Packet Received for: {network} -> {packet}'\
-                    .format(network=current_network, packet=packet_address)
-
-                assert isinstance(fido_header, object)
-                # print fido_header
-
-                offset = struct.calcsize(_struct_fidonet_packet)
-                message_count = 0
-                while True:
-
-                    # Reset Position to right after Fido Header
-                    fido_object.seek(offset)
-
-                    # Try to parse the message header
-                    try:
-                        # make Sure we don't read past the end of the file!
-                        message_header_read = fido_object.read()[:14]
-                    except EOFError:
-                        # move to next packet if were at the end.
-                        break
-
-                    if not message_header_read:
-                        # move to next packet, log error here
-                        break
-
-                    # Make sure we have correct size! Otherwise were done.
-                    # print 'message_header_read len: ' + str(len(message_header_read))
-                    if len(message_header_read) <= 2:
-                        # End of File can have (2) Bytes, catch this.
-                        break
-                    elif len(message_header_read) < 14:
-                        # Read was short!
-                        print u'Error: unable to read message header: ' + file_name
-                        break
-
-                    # Read the Message Header
-                    fido_message_header = FidonetMessageHeader(
-                        *struct.unpack(_struct_fidonet_message_header, message_header_read))
-
-                    assert isinstance(fido_message_header, object)
-
-                    SetFlags(fido_message_header.attributes_flags1,
-                             fido_message_header.attributes_flags2)
-
-                    # Update The Offset
-                    offset += struct.calcsize(_struct_fidonet_message_header)
-
-                    # Next move back to the next position
-                    """ Next we need to parse For '\x00' terminated strings.
-                    ('20s', 'dateTime'),
-                    ('36s', 'toUsername'),
-                    ('36s', 'fromUsername'),
-                    ('72s', 'subject')
-                    """
-
-                    # Use cleaner way to keep track of offset!!
-                    date_time_string = read_cstring(fido_object, offset)
-                    offset += len(date_time_string) + 1
-
-                    username_to = read_cstring(fido_object, offset)
-                    offset += len(username_to) + 1
-
-                    username_from = read_cstring(fido_object, offset)
-                    offset += len(username_from) + 1
-
-                    subject_string = read_cstring(fido_object, offset)
-                    offset += len(subject_string) + 1
-
-                    # We now read the entire message up to null terminator
-                    message_string = read_message_text(fido_object, offset)
-                    offset += len(message_string) + 1
-
-                    # Breaks up the message and separates out kludge lines from text.
-                    # print Message(message_string, username_to, username_from, subject_string)
-                    current_message = Message()
-
-                    current_message.date_time = date_time_string
-                    current_message.user_to = username_to
-                    current_message.user_from = username_from
-                    current_message.subject = subject_string
-                    current_message.raw_data = message_string
-
-                    # Packet Headers will check for source / destination address
-                    # mainly dupe checking
-                    current_message.packet_header = fido_header
-                    # Message Headers will be checked for Import/Export flags etc.
-                    current_message.message_header = fido_message_header
-
-                    # Populated the Current Network and Address.
-                    current_message.network = current_network
-                    current_message.packet_address = packet_address
-
-                    # First Parse the Raw Data into Message Lines and
-                    # break out Kludge lines from text
-                    # if No errors then Import Message to x84
-                    current_message.parse_lines()
-                    message_count += 1
-
-                    # Cleanup
-                    # del current_message
-
-                # Cleanup for next run
-                fido_object.close()
-                print u'    Messages This Packet -> ' + str(message_count)
-                print '*' * 30
 
-        finally:
-            # Clear the unpack_folder here later on, leave for testing, just overwrites!
-            print u'End of Bundle'
-            print '*' * 60
+def toss_chunk_worker(job):
+    # Runs in a toss worker process, parses and decodes a chunk of
+    # messages and hands them back to the writer.  A chunk that fails
+    # comes back empty with the traceback.
+    """
+    :type job: tuple
+    :rtype : tuple
+    """
+    file_path_zip, messages, error = job
+    # Workers are reused, only hand back this chunk's metrics.
+    metrics.reset()
+    try:
+        for current_message in messages or ():
+            started = time.time()
+            current_message.parse_lines()
+            metrics.observe('body_parse', time.time() - started)
+            current_message.decode()
+    except Exception:
+        messages, error = [], traceback.format_exc()
+    if messages:
+        metrics.count('messages_parsed', len(messages))
+    return file_path_zip, messages, error, metrics
+
+
+def imap_window(pool, func, jobs, window):
+    # Generator, like pool.imap but only window jobs are handed out ahead
+    # of the results taken, so finished results can't pile up in memory
+    # when the workers run ahead of the writer.  Results come in job order.
+    """
+    :type pool: multiprocessing.Pool
+    :type func: callable
+    :type jobs: collections.Iterable
+    :type window: int
+    :rtype : collections.Iterable
+    """
+    pending = collections.deque()
+    for job in jobs:
+        pending.append(pool.apply_async(func, (job,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class BundleWriter(object):
+    # Commits one bundle's messages with its own ImportBatch and router,
+    # so a bundle that fails can't roll back or hold back the others.
+    def __init__(self, file_path_zip):
+        """
+        :type file_path_zip: str
+        :rtype : None
+        """
+        self.file_path_zip = file_path_zip
+        self.router = OutboundRouter()
+        self.import_batch = ImportBatch(router=self.router)
+        self.failed = False
+
+    def add(self, message):
+        # Pass on netmail for other systems, queue the rest for import.
+        """
+        :type message: Message
+        """
+        if not self.router.route_netmail(message):
+            self.import_batch.add(message)
 
+    def fail(self, error):
+        # Nothing more is committed for the bundle.
+        """
+        :type error: str
+        """
+        log.error(u'bad bundle: {0}\n{1}'.format(self.file_path_zip, error))
+        self.failed = True
+
+    def finish(self):
+        # Commit what is left and pack what was routed.  Batches committed
+        # before a failure are kept, so their mail is still passed on.
+        # Returns True when the bundle was tossed.
+        """
+        :rtype : bool
+        """
+        try:
+            if not self.failed:
+                self.import_batch.commit()
+            self.router.close()
+        except Exception:
+            self.fail(traceback.format_exc())
+            self.router.abort()
+        log.debug(u'End of Bundle: ' + os.path.basename(self.file_path_zip))
+        return not self.failed
+
+
+def toss_bundles_parallel(bundles, workers):
+    # Generator, same as toss_bundles with messages parsed by a pool of
+    # workers a few chunks ahead.  This process is the only writer and
+    # commits in bundle and packet order, same as a serial toss.  Only a
+    # window of chunks is held at a time, however large the bundles are.
+    """
+    :type bundles: list
+    :type workers: int
+    :rtype : collections.Iterable[tuple]
+    """
+    cfg = get_configuration()
+    pool = multiprocessing.Pool(workers)
+    writer = None
+    try:
+        for file_path_zip, messages, error, worker_metrics in imap_window(
+                pool, toss_chunk_worker, bundle_jobs(bundles, cfg.import_batch_size), workers * 2):
+            metrics.merge(worker_metrics)
+            if writer is None:
+                writer = BundleWriter(file_path_zip)
+            if error is not None and not writer.failed:
+                writer.fail(error)
+
+            if messages is None:
+                # End of the bundle.
+                tossed = writer.finish()
+                writer = None
+                yield file_path_zip, tossed
+                continue
+
+            if writer.failed:
+                continue
+
+            # Pop each message off the chunk so it is released once committed.
+            messages.reverse()
+            try:
+                while messages:
+                    current_message = messages.pop()
+                    # Area counts made in the worker are lost with it.
+                    track_area(current_message.area)
+                    writer.add(current_message)
+            except Exception:
+                writer.fail(traceback.format_exc())
+        pool.close()
+    except:
+        if writer is not None:
+            writer.router.abort()
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def toss_bundles(bundles):
+    # Generator, tosses each bundle and yields (bundle, tossed) as soon as
+    # it is done, tossed is False when it failed.  Netmail passing through
+    # and echomail for downlinks are packed per bundle.
+    """
+    :type bundles: list
+    :rtype : collections.Iterable[tuple]
+    """
+    cfg = get_configuration()
+    if cfg.toss_workers > 1 and bundles:
+        for result in toss_bundles_parallel(bundles, cfg.toss_workers):
+            yield result
+        return
+
+    for file_path_zip in bundles:
+        writer = BundleWriter(file_path_zip)
+        try:
+            # Uncompress packet bundles, then loop to read packet/message headers/messages,
+            # messages are committed in batches and the rest at the end of the bundle.
+            for packet_reader in read_bundle(file_path_zip):
+                # Parse Each Packet for the Header first.
+                log.debug(u'Parsing Mail Packet: ' + packet_reader.file_name)
+                toss_packet(packet_reader, writer.import_batch, writer.router)
+        except Exception:
+            writer.fail(traceback.format_exc())
+        except:
+            writer.router.abort()
+            raise
+        finally:
             # Clear out any packets before running next bundle
-            clear_files = glob.glob(os.path.join(cfg.unpack_folder, u'*.*'))
-            for file in clear_files:
-                os.remove(file)
+            if not cfg.stream_bundles:
+                clear_files = glob.glob(os.path.join(cfg.unpack_folder, u'*.*'))
+                for file in clear_files:
+                    os.remove(file)
+        yield file_path_zip, writer.finish()
+
+
+def process_inbound(bundles=None):
+    # Process all packets waiting in the inbound_folder, or only the
+    # bundles given.  Returns the bundles that failed to toss.
+    """
+    :type bundles: list
+    :rtype : list
+    """
+    cfg = get_configuration()
+    if bundles is None:
+        bundles = sorted(glob.glob(os.path.join(cfg.inbound_folder, u'*.*')))
+    return [file_path_zip for file_path_zip, tossed in toss_bundles(bundles) if not tossed]
 
 
 class TossMessages(ParsePackets):
@@ -905,9 +3935,279 @@ class ScanMessages(ParsePackets):
         super(ScanMessages, self).__init__(_packet_processing)
         
 
+# inotify events for a file finished or moved into the inbound folder.
+_inotify_watch_mask = 0x00000002 | 0x00000008 | 0x00000080 | 0x00000100
+_inotify_read_size = 4096
+
+
+def open_inotify(folder):
+    # inotify descriptor watching the folder, None when inotify isn't
+    # available and the folder has to be polled instead.
+    """
+    :type folder: str
+    :rtype : int
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+
+    if inotify_fd < 0:
+        return None
+
+    if isinstance(folder, unicode):
+        folder = folder.encode('utf-8')
+    if libc.inotify_add_watch(inotify_fd, folder, _inotify_watch_mask) < 0:
+        os.close(inotify_fd)
+        return None
+    return inotify_fd
+
+
+class InboundWatcher(object):
+    # Reports bundles in the inbound folder once they have stopped
+    # changing for the debounce time, so bundles still being written by
+    # the mailer aren't tossed.  Each bundle is only reported once for
+    # the same size and modified time.
+    def __init__(self, folder, debounce, poll_interval):
+        """
+        :type folder: str
+        :type debounce: int
+        :type poll_interval: int
+        :rtype : None
+        """
+        self.folder = folder
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.changing = {}   # path -> (size, mtime), time first seen that way
+        self.tossed = {}     # path -> (size, mtime) when it was tossed
+        self.inotify_fd = open_inotify(folder)
+        if self.inotify_fd is None:
+            log.info(u'inotify not available, polling: {0}'.format(folder))
+        # Written to by wake() so a wait returns straight away.
+        self.wake_fds = os.pipe()
+
+    def ready_bundles(self):
+        # Bundles that haven't changed for the debounce time, and the
+        # seconds until the next one could be ready, or None.
+        """
+        :rtype : tuple
+        """
+        now = time.time()
+        ready = []
+        next_ready = None
+        present = set()
+        for file_path in glob.glob(os.path.join(self.folder, u'*.*')):
+            try:
+                file_stat = os.stat(file_path)
+            except OSError:
+                continue
+            present.add(file_path)
+            stat_key = (file_stat.st_size, file_stat.st_mtime)
+            if self.tossed.get(file_path) == stat_key:
+                continue
+
+            seen = self.changing.get(file_path)
+            if seen is None or seen[0] != stat_key:
+                self.changing[file_path] = (stat_key, now)
+                waiting = self.debounce
+            else:
+                waiting = self.debounce - (now - seen[1])
+
+            if waiting <= 0:
+                ready.append(file_path)
+            elif next_ready is None or waiting < next_ready:
+                next_ready = waiting
+
+        # Forget bundles that were removed from the inbound folder.
+        for file_path in set(self.changing) - present:
+            del self.changing[file_path]
+        for file_path in set(self.tossed) - present:
+            del self.tossed[file_path]
+        return sorted(ready), next_ready
+
+    def mark_tossed(self, bundles):
+        """
+        :type bundles: list
+        """
+        for file_path in bundles:
+            stat_key, _ = self.changing.pop(file_path, (None, None))
+            if stat_key is not None:
+                self.tossed[file_path] = stat_key
+
+    def wait(self, timeout):
+        # Block until the folder changes, wake() is called or the timeout
+        # passes.
+        """
+        :type timeout: float
+        """
+        wait_fds = [self.wake_fds[0]]
+        if self.inotify_fd is None:
+            timeout = min(timeout, self.poll_interval)
+        else:
+            wait_fds.append(self.inotify_fd)
+
+        readable, _, _ = select.select(wait_fds, [], [], max(0, timeout))
+        if self.wake_fds[0] in readable:
+            os.read(self.wake_fds[0], _inotify_read_size)
+        if self.inotify_fd in readable:
+            # Only the wake up matters, the folder is rescanned.
+            try:
+                while os.read(self.inotify_fd, _inotify_read_size):
+                    pass
+            except OSError:
+                pass
+
+    def wake(self):
+        # End a wait from another thread.
+        if self.wake_fds is not None:
+            try:
+                os.write(self.wake_fds[1], 'x')
+            except OSError:
+                pass
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+        if self.wake_fds is not None:
+            wake_fds, self.wake_fds = self.wake_fds, None
+            for wake_fd in wake_fds:
+                os.close(wake_fd)
+
+
+def move_bundle(file_path, folder):
+    # Move a tossed bundle out of the inbound folder, ArcMail names repeat
+    # every week so a number is added when the name is already taken.
+    """
+    :type file_path: str
+    :type folder: str
+    :rtype : str
+    """
+    target_path = os.path.join(folder, os.path.basename(file_path))
+    suffix = 0
+    while os.path.exists(target_path):
+        suffix += 1
+        target_path = os.path.join(folder, '{0}.{1}'.format(os.path.basename(file_path), suffix))
+    shutil.move(file_path, target_path)
+    return target_path
+
+
+def reset_counts():
+    # Start a run with empty area counts and metrics.
+    area_count.clear()
+    dupe_count.clear()
+    metrics.reset()
+
+
+class MailDaemon(object):
+    # Long running tosser / scanner, new bundles are tossed as they
+    # arrive and outbound scans run on the scan_interval.  The compiled
+    # configuration is kept between runs, database connections are opened
+    # by each toss and scan.  Tossed bundles are moved to the archive
+    # folder and bundles that fail to the bad folder, so a restart only
+    # sees new bundles.
+    def __init__(self):
+        cfg = get_configuration()
+        self.scan_interval = cfg.scan_interval
+        self.archive_folder = cfg.archive_folder
+        self.bad_folder = cfg.bad_folder
+        self.watcher = InboundWatcher(cfg.inbound_folder, cfg.toss_debounce, cfg.poll_interval)
+        self.next_scan = time.time()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def toss(self, bundles):
+        # Bundles are tossed together through the toss_workers pool, and
+        # each one is moved as soon as it is done.  A bad bundle can't
+        # hold back or roll back the others.
+        """
+        :type bundles: list
+        """
+        reset_counts()
+        for file_path, tossed in toss_bundles(bundles):
+            self.done([file_path], self.archive_folder if tossed else self.bad_folder)
+
+        log.info(u'Tossed {0} bundles, {1} messages imported, {2} dupes'.format(
+            len(bundles), metrics.counters['messages_imported'], metrics.counters['dupes']))
+        write_metrics()
+
+    def done(self, bundles, folder):
+        # Move bundles out of inbound, without a folder they are left
+        # and only skipped until they change or the daemon restarts.
+        """
+        :type bundles: list
+        :type folder: str
+        """
+        for file_path in bundles:
+            if folder:
+                try:
+                    move_bundle(file_path, folder)
+                    continue
+                except (IOError, OSError) as error:
+                    log.error(u'unable to move bundle: {0}, {1}'.format(file_path, error))
+            self.watcher.mark_tossed([file_path])
+
+    def scan(self):
+        reset_counts()
+        try:
+            process_outbound()
+            write_metrics()
+        except Exception:
+            log.exception(u'scan failed')
+
+    def run_once(self):
+        # Toss any bundles that are ready, then scan if it is time to.
+        # Returns the seconds to wait before the next run.
+        """
+        :rtype : float
+        """
+        bundles, next_ready = self.watcher.ready_bundles()
+        if bundles:
+            self.toss(bundles)
+
+        if time.time() >= self.next_scan:
+            self.scan()
+            self.next_scan = time.time() + self.scan_interval
+
+        timeout = self.next_scan - time.time()
+        if next_ready is not None:
+            timeout = min(timeout, next_ready)
+        return timeout
+
+    def run(self):
+        # Run until stop() is called.
+        log.info(u'PyPacketMail daemon started')
+        try:
+            while not self.stopped.is_set():
+                self.watcher.wait(self.run_once())
+        finally:
+            self.watcher.close()
+            log.info(u'PyPacketMail daemon stopped')
+
+    def start(self):
+        # Run in a background thread, eg. inside x84's event loop.
+        """
+        :rtype : threading.Thread
+        """
+        self.thread = threading.Thread(target=self.run, name='PyPacketMail')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
+
+    def stop(self):
+        # Finishes the current toss or scan, then stops.
+        self.stopped.set()
+        self.watcher.wake()
+
+
 def main(background_daemon=False):
     # Scan for Incoming Message and Import them
-    if not background_daemon:
+    load_configuration(verbose=True)
+    if background_daemon:
+        MailDaemon().run()
+
+    else:
         # Import Message 80% Done.
         # TossMessages()
 
@@ -915,5 +4215,9 @@ def main(background_daemon=False):
         ScanMessages()
 
 if __name__ == '__main__':
-    # do not execute message polling as a background thread.
-    main(background_daemon=False)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    # --daemon is ours, x84's parse_args only knows its own options.
+    background_daemon = '--daemon' in sys.argv[1:]
+    if background_daemon:
+        sys.argv.remove('--daemon')
+    main(background_daemon=background_daemon)
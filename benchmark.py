@@ -0,0 +1,450 @@
+#!/usr/bin/env python2.7
+"""
+Benchmarks for PyPacketMail, http://github.com/m-griffin/PyMailPacket
+
+Builds deterministic synthetic Type-2 packets and bundles, then runs the
+tosser against an in-memory stand-in for x84's Msg / DBProxy so runs can
+be compared without a BBS install.  Reports messages/sec, bytes/sec,
+the time spent in each stage of the toss and the peak RSS of the staged
+and the full toss, each is run in its own child process.
+
+    python2.7 benchmark.py --messages 5000 --body-size 2048 --high-ascii 0.05
+    python2.7 benchmark.py --json results.json
+
+Same arguments and --seed always generate the same packets.
+"""
+
+import collections
+import contextlib
+import datetime
+import argparse
+import resource
+import tempfile
+import zipfile
+import shutil
+import random
+import multiprocessing
+import struct
+import json
+import time
+import traceback
+import imp
+import sys
+import os
+
+
+# Networks used by the stand-in configuration, packets are addressed to agoranet.
+_bench_node_address = (46, 1, 140, 0)
+_bench_uplink_address = (46, 1, 100, 0)
+_bench_areas = ['agn_gen', 'agn_ads', 'agn_bbs', 'agn_dev', 'agn_tst']
+
+_bench_words = ('fido', 'echomail', 'packet', 'tosser', 'scanner', 'bbs', 'sysop',
+                'node', 'hub', 'zone', 'net', 'point', 'message', 'reply', 'the',
+                'and', 'of', 'to', 'a', 'in', 'is', 'it', 'that', 'for', 'on')
+
+
+class BenchDatabases(object):
+    # In-memory tables shared by every stand-in DBProxy.
+    tables = collections.defaultdict(dict)
+
+
+class BenchDBProxy(object):
+    # Stand-in for x84.bbs.DBProxy, each (schema, table) is a dict.
+    def __init__(self, schema, table='unnamed', use_session=True):
+        self.table = BenchDatabases.tables[(schema, table)]
+
+    def __enter__(self):
+        return self.table
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class BenchMsg(object):
+    # Stand-in for x84.bbs.msgbase.Msg, only the stored fields.
+    def __init__(self, recipient=None, subject=u'', body=u''):
+        self.idx = None
+        self.author = None
+        self.recipient = recipient
+        self.subject = subject
+        self.body = body
+        self.tags = set()
+        self.parent = None
+        self.children = set()
+        self._ctime = self._stime = datetime.datetime.now()
+
+    @property
+    def ctime(self):
+        return self._ctime
+
+
+def bench_get_msg(idx=0):
+    with BenchDBProxy('msgbase') as db_msg:
+        return db_msg['%d' % (idx,)]
+
+
+def install_x84_stand_in(settings):
+    # Register stand-in x84 modules, settings is {section: {key: value}}.
+    """
+    :type settings: dict
+    """
+    def get_ini(section=None, key=None, getter='get', split=False, splitsep=None):
+        value = settings.get(section, {}).get(key)
+        if value is None:
+            return [] if split else None
+        if getter == 'getboolean':
+            return value.lower() in ('1', 'yes', 'true', 'on')
+        if getter == 'getint':
+            return int(value)
+        if split:
+            return [item.strip() for item in value.split(splitsep or ',') if item.strip()]
+        return value
+
+    x84 = imp.new_module('x84')
+    x84_bbs = imp.new_module('x84.bbs')
+    x84_ini = imp.new_module('x84.bbs.ini')
+    x84_msgbase = imp.new_module('x84.bbs.msgbase')
+    x84_cmdline = imp.new_module('x84.cmdline')
+
+    x84_bbs.DBProxy = BenchDBProxy
+    x84_ini.CFG = settings
+    x84_ini.get_ini = get_ini
+    x84_ini.init = lambda *args: None
+    x84_msgbase.Msg = BenchMsg
+    x84_msgbase.MSGDB = 'msgbase'
+    x84_msgbase.TAGDB = 'tags'
+    x84_msgbase.get_msg = bench_get_msg
+    x84_cmdline.parse_args = lambda: ()
+
+    x84.bbs = x84_bbs
+    x84.cmdline = x84_cmdline
+    x84_bbs.ini = x84_ini
+    x84_bbs.msgbase = x84_msgbase
+    sys.modules.update({
+        'x84': x84, 'x84.bbs': x84_bbs, 'x84.bbs.ini': x84_ini,
+        'x84.bbs.msgbase': x84_msgbase, 'x84.cmdline': x84_cmdline})
+
+
+def bench_settings(work_dir, options):
+    # INI settings for the stand-in, folders live in the work_dir.
+    """
+    :rtype : dict
+    """
+    return {
+        'system': {'bbsname': 'PyPacketMail Bench'},
+        'mailpacket': {
+            'inbound': os.path.join(work_dir, 'inbound'),
+            'outbound': os.path.join(work_dir, 'outbound'),
+            'pack': os.path.join(work_dir, 'pack'),
+            'unpack': os.path.join(work_dir, 'unpack'),
+            'stream_bundles': 'yes',
+            'import_batch_size': str(options.batch_size),
+            'toss_workers': str(options.workers),
+        },
+        'fido_networks': {'network_tags': 'agoranet'},
+        'agoranet': {
+            'node_address': '{0}:{1}/{2}'.format(*_bench_node_address),
+            'export_address': '{0}:{1}/{2}'.format(*_bench_uplink_address),
+            'areas': ', '.join('{0}: {1}'.format(area, area[4:]) for area in _bench_areas),
+            'default_area': _bench_areas[0],
+        },
+    }
+
+
+class PacketGenerator(object):
+    # Deterministic synthetic Type-2 packets, the same options and seed
+    # always give the same bytes.
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.message_number = 0
+        self.date_time = datetime.datetime(2015, 2, 26, 18, 4, 0)
+
+    def text(self, size):
+        # Body text of about size bytes in CR separated lines, with a share
+        # of CP437 high ascii characters.
+        words = []
+        length = 0
+        line_length = 0
+        while length < size:
+            if self.random.random() < self.options.high_ascii:
+                word = ''.join(chr(self.random.randint(0xb0, 0xdf)) for _ in xrange(4))
+            else:
+                word = self.random.choice(_bench_words)
+            if line_length + len(word) > 72:
+                words.append('\r')
+                line_length = 0
+            words.append(word)
+            words.append(' ')
+            line_length += len(word) + 1
+            length += len(word) + 1
+        return ''.join(words).rstrip()
+
+    def message(self):
+        # One message record, message header, header fields and body.
+        self.message_number += 1
+        self.date_time += datetime.timedelta(seconds=37)
+        area = self.random.choice(_bench_areas)
+        origin = _bench_uplink_address
+
+        lines = ['AREA:{0}'.format(area.upper()),
+                 '\x01MSGID: {0}:{1}/{2} {3:08x}'.format(
+                     origin[0], origin[1], origin[2], self.message_number),
+                 '\x01TZUTC: -0600',
+                 '\x01CHRS: CP437 2']
+        for number in xrange(self.options.kludges):
+            lines.append('\x01X-BENCH-{0}: {1}'.format(number, self.random.choice(_bench_words)))
+        lines.append(self.text(self.options.body_size))
+        lines.append('--- PyPacketMail Bench')
+        lines.append(' * Origin: Bench ({0}:{1}/{2})'.format(*origin))
+        for number in xrange(self.options.seen_by):
+            nodes = sorted(self.random.sample(xrange(1, 999), 12))
+            lines.append('SEEN-BY: {0}/{1}'.format(number + 1, ' '.join(str(node) for node in nodes)))
+        lines.append('\x01PATH: {0}/{1}'.format(origin[1], origin[2]))
+
+        message_header = struct.pack(
+            '<HHHHHBBH', 2, origin[2], _bench_node_address[2],
+            origin[1], _bench_node_address[1], 0, 0, 0)
+        return ''.join((message_header, '\x00'.join((
+            self.date_time.strftime('%d %b %y  %H:%M:%S'), 'All',
+            'Bench User {0}'.format(self.message_number % 50),
+            'Subject {0}'.format(self.message_number), '\r'.join(lines) + '\r', ''))))
+
+    def packet(self, message_count):
+        # Packet header, then the messages and the (2) byte end of packet.
+        destination = _bench_node_address
+        origin = _bench_uplink_address
+        packet_header = struct.pack(
+            '<HHHHHHHHHHHHBB8sHHHHBBHHHHHL',
+            origin[2], destination[2], 2015, 1, 26, 18, 4, 0, 0, 2,
+            origin[1], destination[1], 0xfe, 1, '', origin[0], destination[0],
+            0, 0, 0, 0, 0, origin[0], destination[0], 0, 0, 0)
+        return ''.join([packet_header] + [self.message() for _ in xrange(message_count)] + ['\x00\x00'])
+
+    def bundles(self, folder):
+        # Write options.bundles bundles of options.packets packets each.
+        """
+        :rtype : int
+        """
+        per_packet = max(1, self.options.messages // (self.options.bundles * self.options.packets))
+        total_bytes = 0
+        for bundle_number in xrange(self.options.bundles):
+            bundle_path = os.path.join(folder, '0000ff9c.mo{0}'.format(bundle_number))
+            with zipfile.ZipFile(bundle_path, 'w', zipfile.ZIP_DEFLATED) as zip_obj:
+                for packet_number in xrange(self.options.packets):
+                    data = self.packet(per_packet)
+                    total_bytes += len(data)
+                    zip_obj.writestr('{0:04x}{1:04x}.pkt'.format(bundle_number, packet_number), data)
+        return total_bytes
+
+
+@contextlib.contextmanager
+def quiet():
+    # The tosser logs its progress, only a verbose configuration prints,
+    # keep anything written to stdout out of the results.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+    # Linux reports ru_maxrss in KB.
+    return resource.getrusage(who).ru_maxrss
+
+
+def run_in_child(func, *args):
+    # Run one pass in a forked child so each gets its own peak RSS, returns
+    # func's result, the child's peak RSS and the largest of any toss
+    # workers it started.
+    """
+    :rtype : tuple
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def run():
+        try:
+            sender.send(((func(*args), peak_rss_kb(), peak_rss_kb(resource.RUSAGE_CHILDREN)), None))
+        except Exception:
+            sender.send((None, traceback.format_exc()))
+
+    child = multiprocessing.Process(target=run)
+    child.start()
+    sender.close()
+    try:
+        result, error = receiver.recv()
+    finally:
+        child.join()
+    if error is not None:
+        raise RuntimeError('benchmark pass failed\n{0}'.format(error))
+    return result
+
+
+def run_stages(pypacketmail, inbound_folder):
+    # Walk the toss one stage at a time over every bundle, timing each.
+    """
+    :rtype : tuple
+    """
+    cfg = pypacketmail.get_configuration()
+    timings = collections.OrderedDict(
+        (stage, 0.0) for stage in ('unzip', 'packet_parse', 'body_parse', 'decode', 'db_save'))
+    message_count = 0
+
+    for file_path_zip in sorted(os.listdir(inbound_folder)):
+        started = time.time()
+        readers = list(pypacketmail.read_bundle(
+            os.path.join(inbound_folder, file_path_zip), stream=True))
+        timings['unzip'] += time.time() - started
+
+        messages = []
+        started = time.time()
+        for packet_reader in readers:
+            fido_header = packet_reader.read_packet_header()
+            network = cfg.find_network((
+                fido_header.destination_zone, fido_header.destination_network,
+                fido_header.destination_node, fido_header.destination_point))
+            for message in packet_reader.messages():
+                message.network = network
+                messages.append(message)
+        timings['packet_parse'] += time.time() - started
+        del readers
+
+        started = time.time()
+        for message in messages:
+            message.parse_lines()
+        timings['body_parse'] += time.time() - started
+
+        started = time.time()
+        for message in messages:
+            message.decode()
+        timings['decode'] += time.time() - started
+
+        started = time.time()
+        with pypacketmail.ImportBatch() as import_batch:
+            for message in messages:
+                import_batch.add(message)
+        timings['db_save'] += time.time() - started
+        message_count += len(messages)
+
+    return timings, message_count
+
+
+def reset(pypacketmail):
+    # Empty the stand-in databases and the tosser's area counts.
+    BenchDatabases.tables.clear()
+    pypacketmail.area_count.clear()
+    pypacketmail.dupe_count.clear()
+    pypacketmail.metrics.reset()
+
+
+def stage_pass(pypacketmail, inbound_folder):
+    # Staged toss from empty databases.
+    """
+    :rtype : tuple
+    """
+    reset(pypacketmail)
+    return run_stages(pypacketmail, inbound_folder)
+
+
+def toss_pass(pypacketmail):
+    # Full process_inbound() from empty databases, with its metrics.
+    """
+    :rtype : tuple
+    """
+    reset(pypacketmail)
+    started = time.time()
+    pypacketmail.process_inbound()
+    return time.time() - started, pypacketmail.metrics.to_dict()
+
+
+def run_benchmark(options):
+    # Generate the bundles, then time a staged toss and a full
+    # process_inbound() over them, each in its own child process.
+    """
+    :rtype : dict
+    """
+    work_dir = tempfile.mkdtemp(prefix='pypacketmail-bench-')
+    try:
+        for folder in ('inbound', 'outbound', 'pack', 'unpack'):
+            os.mkdir(os.path.join(work_dir, folder))
+        inbound_folder = os.path.join(work_dir, 'inbound')
+
+        install_x84_stand_in(bench_settings(work_dir, options))
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import PyPacketMail as pypacketmail
+
+        started = time.time()
+        packet_bytes = PacketGenerator(options).bundles(inbound_folder)
+        generate_time = time.time() - started
+
+        with quiet():
+            pypacketmail.load_configuration()
+
+            (stage_timings, message_count), stage_rss, _ = run_in_child(
+                stage_pass, pypacketmail, inbound_folder)
+            (toss_time, toss_metrics), toss_rss, worker_rss = run_in_child(
+                toss_pass, pypacketmail)
+
+        return collections.OrderedDict([
+            ('options', vars(options)),
+            ('messages', message_count),
+            ('packet_bytes', packet_bytes),
+            ('generate_seconds', generate_time),
+            ('toss_seconds', toss_time),
+            ('messages_per_second', message_count / toss_time if toss_time else 0.0),
+            ('bytes_per_second', packet_bytes / toss_time if toss_time else 0.0),
+            ('stage_seconds', stage_timings),
+            ('toss_metrics', toss_metrics),
+            ('stage_peak_rss_kb', stage_rss),
+            ('toss_peak_rss_kb', toss_rss),
+            ('worker_peak_rss_kb', worker_rss),
+        ])
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def print_results(results):
+    print 'Messages       : {0}'.format(results['messages'])
+    print 'Packet bytes   : {0}'.format(results['packet_bytes'])
+    print 'Toss time      : {0:.3f}s'.format(results['toss_seconds'])
+    print 'Messages/sec   : {0:.1f}'.format(results['messages_per_second'])
+    print 'Bytes/sec      : {0:.1f}'.format(results['bytes_per_second'])
+    print 'Peak RSS       : {0} KB toss, {1} KB staged'.format(
+        results['toss_peak_rss_kb'], results['stage_peak_rss_kb'])
+    if results['options']['workers'] > 1:
+        print 'Worker RSS     : {0} KB'.format(results['worker_peak_rss_kb'])
+    print 'Stages'
+    for stage, seconds in results['stage_seconds'].items():
+        print '  {0:<13}: {1:.3f}s'.format(stage, seconds)
+
+
+def parse_options(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PyPacketMail tosser.')
+    parser.add_argument('--messages', type=int, default=2000, help='total messages generated')
+    parser.add_argument('--bundles', type=int, default=2, help='bundles in the inbound folder')
+    parser.add_argument('--packets', type=int, default=2, help='packets per bundle')
+    parser.add_argument('--body-size', type=int, default=1024, help='bytes of body text per message')
+    parser.add_argument('--kludges', type=int, default=2, help='extra kludge lines per message')
+    parser.add_argument('--seen-by', type=int, default=4, help='SEEN-BY lines per message')
+    parser.add_argument('--high-ascii', type=float, default=0.02,
+                        help='share of words made of CP437 high ascii')
+    parser.add_argument('--batch-size', type=int, default=500, help='import_batch_size')
+    parser.add_argument('--workers', type=int, default=1, help='toss_workers')
+    parser.add_argument('--seed', type=int, default=2015, help='random seed')
+    parser.add_argument('--json', help='also write the results to this file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_options(argv)
+    results = run_benchmark(options)
+    print_results(results)
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
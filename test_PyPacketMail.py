@@ -0,0 +1,711 @@
+#!/usr/bin/env python2.7
+"""
+Tests for PyPacketMail, run against the benchmark's stand-in for x84.
+
+    python2.7 -m unittest test_PyPacketMail
+"""
+
+import tempfile
+import unittest
+import shutil
+import os
+import struct
+
+import benchmark
+import PyPacketMail
+
+
+# Stand-in configuration, this system is 46:1/140 and the hub 46:1/100.
+_node_address = (46, 1, 140, 0)
+_export_address = (46, 1, 100, 0)
+
+
+def network_settings(work_dir, routes='', downlinks=''):
+    # INI settings for one network with the given routes and downlinks.
+    """
+    :rtype : dict
+    """
+    folders = dict((name, os.path.join(work_dir, name))
+                   for name in ('inbound', 'outbound', 'pack', 'unpack', 'bad'))
+    for folder in folders.values():
+        os.mkdir(folder)
+    return {
+        'system': {'bbsname': 'PyPacketMail Test'},
+        'mailpacket': folders,
+        'fido_networks': {'network_tags': 'agoranet'},
+        'agoranet': {
+            'node_address': '46:1/140',
+            'export_address': '46:1/100',
+            'areas': 'agn_gen: general, agn_ads: ads',
+            'default_area': 'agn_gen',
+            'routes': routes,
+            'downlinks': downlinks,
+        },
+    }
+
+
+def packet_header(origin):
+    # Packet header from origin, every other field zero.
+    """
+    :type origin: tuple
+    :rtype : PyPacketMail.FidonetPacketHeader
+    """
+    header = PyPacketMail.FidonetPacketHeader(*([0] * len(PyPacketMail.FidonetPacketHeader._fields)))
+    return header._replace(origin_zone=origin[0], origin_network=origin[1],
+                           origin_node=origin[2], origin_point=origin[3])
+
+
+def parse_message(raw_data, origin=_export_address):
+    # Message parsed from CR separated raw_data, as if it came from origin.
+    """
+    :type raw_data: str
+    :type origin: tuple
+    :rtype : PyPacketMail.Message
+    """
+    message = PyPacketMail.Message()
+    message.raw_data = raw_data
+    message.parse_lines()
+    message.network = 'agoranet'
+    message.packet_header = packet_header(origin)
+    return message
+
+
+class RecordingExporter(object):
+    # Stand-in for PacketExporter, keeps the text of every message added.
+    def __init__(self):
+        self.messages = []
+
+    def add(self, message, idx=None):
+        self.messages.append(message.serialize())
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class RecordingRouter(PyPacketMail.OutboundRouter):
+    # Router that records what would be packed for each link.
+    def exporter(self, network, destination=None):
+        if (network, destination) not in self.exporters:
+            self.exporters[(network, destination)] = RecordingExporter()
+        return self.exporters[(network, destination)]
+
+
+class ConfigurationTestCase(unittest.TestCase):
+    # Loads the stand-in configuration built from routes and downlinks.
+    routes = ''
+    downlinks = ''
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='pypacketmail-test-')
+        benchmark.BenchDatabases.tables.clear()
+        benchmark.install_x84_stand_in(network_settings(self.work_dir, self.routes, self.downlinks))
+        PyPacketMail._nodelists.clear()
+        self.cfg = PyPacketMail.load_configuration()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+
+class ParseLinesTest(unittest.TestCase):
+    def fields(self, raw_data):
+        message = parse_message(raw_data)
+        return (message.body, message.area, message.kludge_lines, message.seen_by,
+                message.origin_line, message.tag_line)
+
+    def test_crlf(self):
+        self.assertEqual(self.fields('AREA:AGN_GEN\r\n\x01MSGID: 46:1/100 1\r\nHello\r\n\r\nWorld\r\n'
+                                     '--- tag\r\n * Origin: Here (46:1/100)\r\nSEEN-BY: 1/100\r\n'
+                                     '\x01PATH: 1/100\r\n'),
+                         ('Hello\r\rWorld\r--- tag\r * Origin: Here (46:1/100)\r', 'agn_gen',
+                          [('MSGID:', '46:1/100 1'), ('PATH:', '1/100')], ['SEEN-BY: 1/100'],
+                          ' * Origin: Here (46:1/100)', '--- tag'))
+
+    def test_lfcr(self):
+        self.assertEqual(self.fields('AREA:AGN_GEN\n\r\x01MSGID: 46:1/100 1\n\rHello\n\r\n\rWorld\n\r'
+                                     '--- tag\n\r * Origin: Here (46:1/100)\n\rSEEN-BY: 1/100\n\r'
+                                     '\x01PATH: 1/100\n\r'),
+                         ('Hello\r\rWorld\r--- tag\r * Origin: Here (46:1/100)\r', 'agn_gen',
+                          [('MSGID:', '46:1/100 1'), ('PATH:', '1/100')], ['SEEN-BY: 1/100'],
+                          ' * Origin: Here (46:1/100)', '--- tag'))
+
+    def test_blank_lines_after_origin(self):
+        self.assertEqual(self.fields('AREA:AGN_GEN\rHello\r * Origin: Here (46:1/100)\r\r\rSEEN-BY: 1/100\r\r'),
+                         ('Hello\r * Origin: Here (46:1/100)\r\r\r\r', 'agn_gen', [],
+                          ['SEEN-BY: 1/100'], ' * Origin: Here (46:1/100)', None))
+
+    def test_sauce_lines_dropped(self):
+        self.assertEqual(self.fields('AREA:AGN_GEN\rHello\r\x1aSAUCE00 Title   Author\rend\x04\rWorld\r'
+                                     ' * Origin: Here (46:1/100)\r'),
+                         ('Hello\rWorld\r * Origin: Here (46:1/100)\r', 'agn_gen', [], [],
+                          ' * Origin: Here (46:1/100)', None))
+
+    def test_origin_without_star(self):
+        self.assertEqual(self.fields('AREA:AGN_GEN\rHello\r  Origin: Synchronet (46:1/100)\rSEEN-BY: 1/100'),
+                         ('Hello\r  Origin: Synchronet (46:1/100)', 'agn_gen', [], ['SEEN-BY: 1/100'],
+                          '  Origin: Synchronet (46:1/100)', None))
+
+    def test_trailing_cr(self):
+        self.assertEqual(self.fields('AREA:AGN_GEN\rHello\rWorld\r'),
+                         ('Hello\rWorld\r', 'agn_gen', [], [], None, None))
+
+    def test_unexpected_line_after_origin(self):
+        self.assertRaises(ValueError, parse_message, 'AREA:AGN_GEN\r * Origin: Here (46:1/100)\rtext')
+
+
+def raw_header(**fields):
+    # Type-2 packet header bytes, fields not given are zero.
+    """
+    :rtype : str
+    """
+    fields.setdefault('packet_type', 2)
+    header = packet_header((0, 0, 0, 0))._replace(password='', **fields)
+    return struct.pack(PyPacketMail._struct_fidonet_packet, *header)
+
+
+class PacketFormatTest(unittest.TestCase):
+    def read_header(self, data):
+        reader = PyPacketMail.PacketReader(data)
+        return reader, reader.read_packet_header()
+
+    def test_type2(self):
+        reader, header = self.read_header(raw_header(
+            origin_zone=46, origin_network=1, origin_node=100, origin_point=3,
+            destination_zone=46, destination_network=1, destination_node=140))
+        self.assertEqual(reader.packet_format.name, '2')
+        self.assertEqual((header.origin_zone, header.origin_network, header.origin_node, header.origin_point),
+                         (46, 1, 100, 0))
+
+    def test_not_type2(self):
+        self.assertEqual(PyPacketMail.find_packet_format(raw_header(packet_type=3)), None)
+        self.assertEqual(self.read_header(raw_header()[:40])[1], None)
+
+    def test_type22_with_domains(self):
+        header = PyPacketMail.FidonetPacketHeader22(
+            origin_node=100, destination_node=140, origin_point=3, destination_point=0,
+            reserved='', sub_version=2, packet_type=2, origin_network=1, destination_network=1,
+            prod_code=0, revision=0, password='', origin_zone=46, destination_zone=46,
+            origin_domain='AgoraNet', destination_domain='agoranet', prod_data=0)
+        reader, header = self.read_header(struct.pack(PyPacketMail._struct_fidonet_packet22, *header))
+        self.assertEqual(reader.packet_format.name, '2.2')
+        self.assertEqual((header.origin_zone, header.origin_network, header.origin_node, header.origin_point),
+                         (46, 1, 100, 3))
+        self.assertEqual((reader.origin_domain, reader.destination_domain), ('agoranet', 'agoranet'))
+
+    def test_type2plus_capability_word(self):
+        reader, header = self.read_header(raw_header(
+            capWordA=0x0100, capWordB=0x0001, origin_zone=1, origin_zone2=46, origin_network=1,
+            origin_node=100, origin_point=3))
+        self.assertEqual(reader.packet_format.name, '2+')
+        self.assertEqual((header.origin_zone, header.origin_network, header.origin_node, header.origin_point),
+                         (46, 1, 100, 3))
+
+    def test_capability_word_not_byte_swapped(self):
+        reader, header = self.read_header(raw_header(
+            capWordA=0x0001, capWordB=0x0001, origin_zone=46, origin_network=1,
+            origin_node=100, origin_point=3))
+        self.assertEqual(reader.packet_format.name, '2')
+        self.assertEqual(header.origin_point, 0)
+
+    def test_type2plus_point_aux_network(self):
+        reader, header = self.read_header(raw_header(
+            capWordA=0x0100, capWordB=0x0001, origin_zone=46, origin_network=0xffff,
+            aux_network=1, origin_node=140, origin_point=3))
+        self.assertEqual((header.origin_zone, header.origin_network, header.origin_node, header.origin_point),
+                         (46, 1, 140, 3))
+
+    def test_writer_reader_round_trip(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            file_path = os.path.join(work_dir, 'test.pkt')
+            message = parse_message('AREA:AGN_GEN\r\x01MSGID: 46:1/140.3 1\rHello\r'
+                                    ' * Origin: Here (46:1/140.3)\rSEEN-BY: 1/100 140\r\x01PATH: 1/140\r')
+            message.date_time = '26 Feb 15  18:04:00'
+            message.user_to, message.user_from, message.subject = 'All', 'Bob', 'test'
+            writer = PyPacketMail.PacketWriter(file_path, (46, 1, 140, 3), (46, 1, 100, 0), 'secret')
+            writer.write_message(message)
+            writer.close()
+
+            reader = PyPacketMail.PacketReader.from_file(file_path)
+            header = reader.read_packet_header()
+            self.assertEqual(reader.packet_format.name, '2+')
+            self.assertEqual((header.origin_zone, header.origin_network, header.origin_node, header.origin_point),
+                             (46, 1, 140, 3))
+            self.assertEqual((header.destination_zone, header.destination_network, header.destination_node),
+                             (46, 1, 100))
+            self.assertEqual(header.password.rstrip('\x00'), 'secret')
+            read_messages = list(reader.messages())
+            self.assertEqual(len(read_messages), 1)
+            read_message = read_messages[0]
+            read_message.parse_lines()
+            reader.close()
+            self.assertEqual((read_message.date_time, read_message.user_to, read_message.user_from,
+                              read_message.subject), ('26 Feb 15  18:04:00', 'All', 'Bob', 'test'))
+            self.assertEqual((read_message.area, read_message.body, read_message.kludge_lines,
+                              read_message.seen_by, read_message.origin_line),
+                             (message.area, message.body, message.kludge_lines,
+                              message.seen_by, message.origin_line))
+        finally:
+            shutil.rmtree(work_dir)
+
+
+class PacketPathTest(unittest.TestCase):
+    def test_ids_only_go_up(self):
+        # Packets already bundled are gone from the folder, names must
+        # still differ within the same hundredth of a second.
+        folder = tempfile.mkdtemp()
+        try:
+            paths = [PyPacketMail.new_packet_path(folder) for _ in range(50)]
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(len(set(paths)), 50)
+
+
+class RoutePatternTest(unittest.TestCase):
+    def test_full_address(self):
+        self.assertEqual(PyPacketMail.parse_route_pattern('46:1/145'), (46, 1, 145, 0))
+        self.assertEqual(PyPacketMail.parse_route_pattern('46:1/145.3'), (46, 1, 145, 3))
+
+    def test_wildcards(self):
+        self.assertEqual(PyPacketMail.parse_route_pattern('*'), ())
+        self.assertEqual(PyPacketMail.parse_route_pattern('46:*'), (46,))
+        self.assertEqual(PyPacketMail.parse_route_pattern('46:2/*'), (46, 2))
+        self.assertEqual(PyPacketMail.parse_route_pattern('46:1/145.*'), (46, 1, 145))
+
+    def test_invalid(self):
+        for pattern in ('', '46', '46:1', '46:*/5', 'x:1/2', '46:1/2.3.4'):
+            self.assertIsNone(PyPacketMail.parse_route_pattern(pattern), pattern)
+
+
+class NextHopTest(ConfigurationTestCase):
+    routes = ('46:1/145.* direct, 46:1/150 46:1/120, 46:2/* 46:2/0, '
+              '46:3/* nodelist, 46:2/5 direct')
+
+    def test_point_goes_direct(self):
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (46, 1, 145, 3)), (46, 1, 145, 3))
+
+    def test_point_wildcard_takes_boss_node(self):
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (46, 1, 145, 0)), (46, 1, 145, 0))
+
+    def test_exact_route(self):
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (46, 1, 150, 0)), (46, 1, 120, 0))
+
+    def test_net_wildcard(self):
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (46, 2, 7, 0)), (46, 2, 0, 0))
+
+    def test_most_specific_route_wins(self):
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (46, 2, 5, 0)), (46, 2, 5, 0))
+
+    def test_falls_back_to_export_address(self):
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (46, 4, 1, 0)), _export_address)
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (1, 154, 10, 0)), _export_address)
+
+    def test_nodelist_without_nodelist_falls_back(self):
+        self.assertEqual(self.cfg.find_next_hop('agoranet', (46, 3, 1, 0)), _export_address)
+
+    def test_decisions_are_cached(self):
+        first = self.cfg.find_next_hop('agoranet', (46, 2, 7, 0))
+        self.assertIs(self.cfg.find_next_hop('agoranet', (46, 2, 7, 0)), first)
+
+
+class NetmailLoopTest(ConfigurationTestCase):
+    routes = '46:2/* 46:2/0'
+
+    def netmail(self, destination, extra=''):
+        message = parse_message(
+            '\x01INTL {0} 46:1/100\r\x01MSGID: 46:1/100 00000001\r{1}hello\r'.format(
+                PyPacketMail.format_fido_address(destination), extra))
+        message.message_header = PyPacketMail.FidonetMessageHeader(
+            message_type=2, origin_node=100, destination_node=destination[2],
+            origin_network=1, destination_network=destination[1],
+            attributes_flags1=0, attributes_flags2=0, cost=0)
+        message.date_time = '26 Feb 15  18:04:00'
+        message.user_to, message.user_from, message.subject = 'Sysop', 'Bob', 'netmail'
+        return message
+
+    def test_routed_with_via(self):
+        router = RecordingRouter()
+        self.assertTrue(router.route_netmail(self.netmail((46, 2, 7, 0))))
+        text, = router.exporters[('agoranet', (46, 2, 0, 0))].messages
+        self.assertTrue(text.split('\r')[-2].startswith('\x01Via 46:1/140 @'))
+
+    def test_not_sent_back_to_sender(self):
+        router = RecordingRouter()
+        self.assertTrue(router.route_netmail(self.netmail((46, 4, 1, 0))))
+        self.assertEqual(router.exporters, {})
+        router.close()
+        self.assertEqual(len(os.listdir(self.cfg.bad_folder)), 1)
+
+    def test_not_routed_twice(self):
+        router = RecordingRouter()
+        message = self.netmail((46, 2, 7, 0), '\x01Via 46:1/140 @20150226.180400.UTC PyPacketMail 1\r')
+        self.assertTrue(router.route_netmail(message))
+        self.assertEqual(router.exporters, {})
+
+
+class NetNodesTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(PyPacketMail.parse_net_nodes(['SEEN-BY: 1/100 140 2/5', '3/7']),
+                         [1 << 16 | 100, 1 << 16 | 140, 2 << 16 | 5, 3 << 16 | 7])
+
+    def test_parse_skips_zones_and_points(self):
+        self.assertEqual(PyPacketMail.parse_net_nodes(['1/100 46:1/140 1/145.3 150']),
+                         [1 << 16 | 100, 1 << 16 | 150])
+
+    def test_round_trip(self):
+        lines = ['1/100 140 150 2/5 7']
+        self.assertEqual(PyPacketMail.format_net_nodes(PyPacketMail.parse_net_nodes(lines)), lines)
+
+    def test_wrapping_repeats_net(self):
+        net_nodes = [1 << 16 | node for node in xrange(1, 40)] + [2 << 16 | 5]
+        lines = PyPacketMail.format_net_nodes(net_nodes)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(all(len(line) <= 70 for line in lines))
+        self.assertTrue(lines[1].startswith('1/'))
+        self.assertEqual(PyPacketMail.parse_net_nodes(lines), net_nodes)
+
+
+class ForwardEchomailTest(ConfigurationTestCase):
+    downlinks = '46:1/150 agn_gen, 46:1/160 *, 46:2/5 agn_ads'
+
+    echomail = ('AREA:AGN_GEN\r\x01MSGID: 46:1/100 00000001\rhello\r'
+                '--- test\r * Origin: somewhere (46:1/100)\r'
+                'SEEN-BY: 1/100 140 160\r\x01PATH: 1/100\r')
+
+    def test_sent_to_links_not_seen(self):
+        router = RecordingRouter()
+        self.assertEqual(router.forward_echomail(parse_message(self.echomail)), 1)
+        self.assertEqual(list(router.exporters), [('agoranet', (46, 1, 150, 0))])
+
+    def test_seen_by_and_path(self):
+        router = RecordingRouter()
+        router.forward_echomail(parse_message(self.echomail))
+        text, = router.exporters[('agoranet', (46, 1, 150, 0))].messages
+        self.assertEqual(text.split('\r')[-3:],
+                         ['SEEN-BY: 1/100 140 150 160', '\x01PATH: 1/100 140', ''])
+
+    def test_round_trip_through_two_systems(self):
+        router = RecordingRouter()
+        router.forward_echomail(parse_message(self.echomail))
+        text, = router.exporters[('agoranet', (46, 1, 150, 0))].messages
+
+        # The downlink's copy, tossed back to us, goes nowhere new.
+        message = parse_message(text, origin=(46, 1, 150, 0))
+        self.assertEqual(PyPacketMail.parse_net_nodes(message.seen_by),
+                         [1 << 16 | 100, 1 << 16 | 140, 1 << 16 | 150, 1 << 16 | 160])
+        self.assertEqual(RecordingRouter().forward_echomail(message), 0)
+
+    def test_path_not_repeated(self):
+        message = parse_message(self.echomail.replace('PATH: 1/100', 'PATH: 1/100 140'))
+        message.add_seen_by(set(PyPacketMail.parse_net_nodes(message.seen_by)), _node_address)
+        self.assertEqual(PyPacketMail.find_kludge(message.kludge_lines, 'PATH:'), ['1/100 140'])
+
+    def test_no_new_links(self):
+        # Only 46:1/160 takes every area, and it is in the SEEN-BY.
+        message = parse_message(self.echomail.replace('AGN_GEN', 'AGN_BBS'))
+        router = RecordingRouter()
+        self.assertEqual(router.forward_echomail(message), 0)
+
+
+class PointDownlinkTest(ConfigurationTestCase):
+    # Two points of this system and a node, all taking every area.
+    downlinks = '46:1/140.1 *, 46:1/140.2 *, 46:1/150 *'
+
+    echomail = ForwardEchomailTest.echomail
+
+    def test_points_get_echomail(self):
+        router = RecordingRouter()
+        self.assertEqual(router.forward_echomail(parse_message(self.echomail)), 3)
+        self.assertEqual(sorted(router.exporters), [
+            ('agoranet', (46, 1, 140, 1)), ('agoranet', (46, 1, 140, 2)), ('agoranet', (46, 1, 150, 0))])
+
+    def test_points_not_in_seen_by(self):
+        router = RecordingRouter()
+        router.forward_echomail(parse_message(self.echomail))
+        text, = router.exporters[('agoranet', (46, 1, 140, 1))].messages
+        self.assertIn('SEEN-BY: 1/100 140 150 160', text.split('\r'))
+
+    def test_not_sent_back_to_point(self):
+        message = parse_message(
+            'AREA:AGN_GEN\r\x01MSGID: 46:1/140.1 00000001\rhello\r'
+            '--- test\r * Origin: a point (46:1/140.1)\r', origin=(46, 1, 140, 1))
+        router = RecordingRouter()
+        self.assertEqual(router.forward_echomail(message), 3)
+        self.assertEqual(sorted(router.exporters), [
+            ('agoranet', (46, 1, 100, 0)), ('agoranet', (46, 1, 140, 2)), ('agoranet', (46, 1, 150, 0))])
+
+    def test_not_sent_back_to_origin_point(self):
+        # Passed on by another system, the origin line still names the point.
+        message = parse_message(
+            'AREA:AGN_GEN\rhello\r--- test\r * Origin: a point (46:1/140.2)\r'
+            'SEEN-BY: 1/100 140\r\x01PATH: 1/140 100\r')
+        router = RecordingRouter()
+        router.forward_echomail(message)
+        self.assertEqual(sorted(router.exporters), [
+            ('agoranet', (46, 1, 140, 1)), ('agoranet', (46, 1, 150, 0))])
+
+
+def echomail(subject, msg_id=None, reply=None, area='AGN_GEN'):
+    # Echomail with the given MSGID and REPLY kludges, ready to import.
+    """
+    :rtype : PyPacketMail.Message
+    """
+    kludges = ''
+    if msg_id:
+        kludges += '\x01MSGID: 46:1/100 {0}\r'.format(msg_id)
+    if reply:
+        kludges += '\x01REPLY: 46:1/100 {0}\r'.format(reply)
+    message = parse_message('AREA:{0}\r{1}Hello\r * Origin: Here (46:1/100)\r'.format(area, kludges))
+    message.date_time = '26 Feb 15  18:04:00'
+    message.user_to, message.user_from, message.subject = 'All', 'Bob', subject
+    return message
+
+
+class ImportTestCase(ConfigurationTestCase):
+    # Imports through ImportBatch into the stand-in tables.
+    def table(self, schema, table='unnamed'):
+        return benchmark.BenchDatabases.tables[(schema, table)]
+
+    def stored(self):
+        # Subject -> stored Msg record.
+        """
+        :rtype : dict
+        """
+        return dict((record.subject, record) for record in self.table('msgbase').values())
+
+    def fail_status_index(self):
+        # Make the next commit fail after the message records are written.
+        update_status_index = PyPacketMail.update_status_index
+
+        def failing_update(fido_records, previous_status):
+            if fido_records:
+                raise IOError('disk full')
+            return update_status_index(fido_records, previous_status)
+
+        PyPacketMail.update_status_index = failing_update
+        self.addCleanup(setattr, PyPacketMail, 'update_status_index', update_status_index)
+
+    def import_messages(self, *messages):
+        with PyPacketMail.ImportBatch() as import_batch:
+            for message in messages:
+                import_batch.add(message)
+        return import_batch
+
+
+class ImportBatchTest(ImportTestCase):
+    def test_commit_writes_message_fido_and_tag_records(self):
+        self.import_messages(echomail('one', 1), echomail('two', 2))
+        stored = self.stored()
+        self.assertEqual(sorted(stored), [u'one', u'two'])
+        for record in stored.values():
+            key = '%d' % (record.idx,)
+            self.assertEqual(self.table('pymail', 'unnamed')[key].check_status, 'received')
+            self.assertTrue(key in self.table('pymail', 'status_received'))
+        self.assertEqual(self.table('tags')['general'], set(record.idx for record in stored.values()))
+
+    def test_batch_size_commits_early(self):
+        with PyPacketMail.ImportBatch(batch_size=2) as import_batch:
+            import_batch.add(echomail('one', 1))
+            import_batch.add(echomail('two', 2))
+            self.assertEqual(len(self.stored()), 2)
+            import_batch.add(echomail('three', 3))
+            self.assertEqual(len(self.stored()), 2)
+        self.assertEqual(len(self.stored()), 3)
+
+    def test_failed_commit_rolls_back(self):
+        self.import_messages(echomail('one', 1))
+        before = dict((key, dict(table)) for key, table in benchmark.BenchDatabases.tables.items())
+
+        self.fail_status_index()
+        import_batch = PyPacketMail.ImportBatch()
+        import_batch.add(echomail('two', 2))
+        import_batch.add(echomail('three', 3))
+        self.assertRaises(IOError, import_batch.commit)
+
+        self.assertEqual(sorted(self.stored()), [u'one'])
+        self.assertEqual(self.table('tags')['general'], before[('tags', 'unnamed')]['general'])
+        self.assertEqual(sorted(self.table('pymail', 'unnamed')), sorted(before[('pymail', 'unnamed')]))
+        self.assertEqual(self.table('pymail', 'status_received'), before[('pymail', 'status_received')])
+        self.assertEqual(self.table('pymail', 'dupes'), before[('pymail', 'dupes')])
+
+    def test_exception_discards_queued_messages(self):
+        try:
+            with PyPacketMail.ImportBatch() as import_batch:
+                import_batch.add(echomail('one', 1))
+                raise ValueError('bad packet')
+        except ValueError:
+            pass
+        self.assertEqual(self.stored(), {})
+
+
+class DupeTest(ImportTestCase):
+    def test_dupe_in_same_batch(self):
+        import_batch = self.import_messages(echomail('one', 1), echomail('again', 1))
+        self.assertEqual((import_batch.total_imported, import_batch.total_dupes), (1, 1))
+        self.assertEqual(sorted(self.stored()), [u'one'])
+
+    def test_dupe_in_later_batch(self):
+        self.import_messages(echomail('one', 1))
+        import_batch = self.import_messages(echomail('again', 1), echomail('two', 2))
+        self.assertEqual((import_batch.total_imported, import_batch.total_dupes), (1, 1))
+        self.assertEqual(sorted(self.stored()), [u'one', u'two'])
+
+    def test_msgid_is_per_area(self):
+        import_batch = self.import_messages(echomail('one', 1), echomail('ads', 1, area='AGN_ADS'))
+        self.assertEqual((import_batch.total_imported, import_batch.total_dupes), (2, 0))
+
+    def test_crc_without_msgid(self):
+        self.import_messages(echomail('one'))
+        import_batch = self.import_messages(echomail('one'), echomail('two'))
+        self.assertEqual((import_batch.total_imported, import_batch.total_dupes), (1, 1))
+
+    def test_rolled_back_batch_is_not_a_dupe(self):
+        self.fail_status_index()
+        import_batch = PyPacketMail.ImportBatch()
+        import_batch.add(echomail('one', 1))
+        self.assertRaises(IOError, import_batch.commit)
+        self.doCleanups()
+
+        import_batch = self.import_messages(echomail('one', 1))
+        self.assertEqual((import_batch.total_imported, import_batch.total_dupes), (1, 0))
+
+    def test_evicts_past_max_entries(self):
+        dupe_index = PyPacketMail.DupeIndex(max_entries=2)
+        dupe_index.record(['a', 'b', 'c'])
+        self.assertEqual(dupe_index.find_dupes(['a', 'b', 'c']), set(['b', 'c']))
+        self.assertEqual(sorted(self.table('pymail', 'dupe_history')), ['1', '2'])
+
+    def test_evicts_past_max_age(self):
+        dupe_index = PyPacketMail.DupeIndex(max_age=1)
+        dupe_index.record(['a'])
+        with benchmark.BenchDBProxy(PyPacketMail.FIDO_DB, PyPacketMail.FIDO_DUPE_HISTORY_TABLE) as db_history:
+            db_history['0'] = ('a', db_history['0'][1] - 2 * 86400)
+        dupe_index.record(['b'])
+        self.assertEqual(dupe_index.find_dupes(['a', 'b']), set(['b']))
+
+
+class ReplyIndexTest(ImportTestCase):
+    def links(self):
+        # Subject -> (parent subject, children subjects) of every stored Msg.
+        """
+        :rtype : dict
+        """
+        subjects = dict((record.idx, record.subject) for record in self.table('msgbase').values())
+        return dict((record.subject, (subjects.get(record.parent),
+                                      sorted(subjects[idx] for idx in record.children)))
+                    for record in self.table('msgbase').values())
+
+    def test_reply_in_same_batch(self):
+        self.import_messages(echomail('op', 1), echomail('re', 2, reply=1))
+        self.assertEqual(self.links(), {u'op': (None, [u're']), u're': (u'op', [])})
+
+    def test_reply_before_parent_in_same_batch(self):
+        self.import_messages(echomail('re', 2, reply=1), echomail('op', 1))
+        self.assertEqual(self.links(), {u'op': (None, [u're']), u're': (u'op', [])})
+
+    def test_reply_before_parent_in_earlier_batch(self):
+        self.import_messages(echomail('re', 2, reply=1))
+        self.assertEqual(self.table('pymail', 'reply_pending').keys(), ['agn_gen:46:1/100 1'])
+
+        self.import_messages(echomail('op', 1), echomail('re2', 3, reply=2))
+        self.assertEqual(self.links(), {u'op': (None, [u're']), u're': (u'op', [u're2']),
+                                        u're2': (u're', [])})
+        self.assertEqual(self.table('pymail', 'reply_pending'), {})
+
+    def test_reply_in_other_area_not_linked(self):
+        self.import_messages(echomail('op', 1), echomail('re', 2, reply=1, area='AGN_ADS'))
+        self.assertEqual(self.links(), {u'op': (None, []), u're': (None, [])})
+
+    def fail_after_save(self):
+        # Make the next commit fail once the reply index is written.
+        save = PyPacketMail.ReplyIndex.save
+
+        def failing_save(reply_index):
+            save(reply_index)
+            raise IOError('disk full')
+
+        PyPacketMail.ReplyIndex.save = failing_save
+        self.addCleanup(setattr, PyPacketMail.ReplyIndex, 'save', save)
+
+    def test_failed_commit_rolls_back_links(self):
+        self.check_rollback(self.fail_status_index)
+
+    def test_failed_commit_rolls_back_reply_index(self):
+        self.check_rollback(self.fail_after_save)
+
+    def check_rollback(self, fail):
+        self.import_messages(echomail('re', 2, reply=1), echomail('op2', 3))
+        msgids = dict(self.table('pymail', 'msgid'))
+        pending = dict(self.table('pymail', 'reply_pending'))
+
+        fail()
+        import_batch = PyPacketMail.ImportBatch()
+        import_batch.add(echomail('op', 1))
+        import_batch.add(echomail('re3', 4, reply=3))
+        import_batch.add(echomail('re4', 5, reply=6))
+        self.assertRaises(IOError, import_batch.commit)
+
+        self.assertEqual(self.links(), {u're': (None, []), u'op2': (None, [])})
+        self.assertEqual(self.table('pymail', 'msgid'), msgids)
+        self.assertEqual(self.table('pymail', 'reply_pending'), pending)
+
+
+class LoadCountingTable(dict):
+    # Message base table that counts the records loaded from it.
+    loaded = 0
+
+    def get(self, key, default=None):
+        self.loaded += 1
+        return dict.get(self, key, default)
+
+
+class ScanTest(ImportTestCase):
+    def post(self, idx, subject, tag=u'general'):
+        # Local post added by x84 at idx.
+        record = benchmark.BenchMsg(u'All', subject, u'Hello')
+        record.idx = idx
+        record.tags = set([u'public', tag])
+        self.table('msgbase')['%d' % (idx,)] = record
+
+    def test_only_local_posts_loaded(self):
+        PyPacketMail.scan_new_messages()
+        self.import_messages(echomail('one', 1), echomail('two', 2))
+        next_idx = max(record.idx for record in self.stored().values()) + 1
+        self.post(next_idx, u'local')
+        self.post(next_idx + 1, u'other', tag=u'other')
+        self.post(next_idx + 3, u'after gap')
+
+        msgbase = benchmark.BenchDatabases.tables[('msgbase', 'unnamed')] = \
+            LoadCountingTable(self.table('msgbase'))
+        self.assertEqual(PyPacketMail.scan_new_messages(), 2)
+        self.assertEqual(msgbase.loaded, 3)
+        self.assertEqual(PyPacketMail.find_pending_messages('agoranet'), [next_idx, next_idx + 3])
+
+
+class DecodeTest(ConfigurationTestCase):
+    def decode(self, chrs, body):
+        message = parse_message('AREA:AGN_GEN\r\x01CHRS: {0}\r{1}'.format(chrs, body))
+        message.date_time = '26 Feb 15  18:04:00'
+        message.user_to, message.user_from, message.subject = 'All', 'Bob', 'test'
+        return message.build_msg().body
+
+    def test_utf8_keeps_0x9d(self):
+        text = u'\u30dd\u30b9\u30c8 \u2014 \xdd'
+        self.assertEqual(self.decode('UTF-8 4', text.encode('utf-8')), text)
+
+    def test_cp1251_keeps_0x9d(self):
+        text = u'\u045c\u0430\u045c'
+        self.assertEqual(self.decode('CP1251 2', text.encode('cp1251')), text)
+
+    def test_cp437_drops_0x9d(self):
+        self.assertEqual(self.decode('CP437 2', 'a\x9db\xb0'), u'ab\u2591')
+
+    def test_forwarded_text_keeps_0x9d(self):
+        message = parse_message('AREA:AGN_GEN\ra\x9db')
+        self.assertEqual(message.body, 'a\x9db')
+
+
+if __name__ == '__main__':
+    unittest.main()